@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+# Measure how the parsing of a directory of .vcf files scales with the number of worker processes.
+# Usage: python benchmarks/ingestion.py [number of contacts] [directory]
+# If no directory is given, a synthetic address book is generated in a temporary directory.
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data import contact
+
+
+def make_synthetic_book(directory: str, contacts: int):
+  cities = [("Paris", "75002", "France"), ("Lyon", "69001", "France"),
+            ("Berlin", "10115", "Germany"), ("Montréal", "H2X 1Y4", "Canada")]
+
+  for i in range(contacts):
+    city, code, country = cities[i % len(cities)]
+    with open(os.path.join(directory, "contact-%06d.vcf" % i), "w") as f:
+      f.write("BEGIN:VCARD\r\n"
+              "VERSION:3.0\r\n"
+              "UID:%i\r\n"
+              "FN:Jöhn Doe %i\r\n"
+              "N:Doe %i;Jöhn;;;\r\n"
+              "ORG:Acme\\, Inc.;Sales\r\n"
+              "EMAIL;TYPE=INTERNET,WORK:john%i@acme.com\r\n"
+              "TEL;TYPE=CELL:+33 6 12 34 %02i %02i\r\n"
+              "ADR;TYPE=WORK:;;%i rue de la Paix;%s;;%s;%s\r\n"
+              "CATEGORIES:Clients,VIP\r\n"
+              "X-CUSTOM%i:Some value\r\n"
+              "END:VCARD\r\n" % (i, i, i, i, i % 100, i % 97, i % 50, city, code, country, i % 20))
+
+
+def run(directory: str):
+  cores = os.cpu_count() or 1
+  workers = sorted({1, 2, 4, 8, 16, cores})
+  reference = None
+
+  print("%i files, %i CPU cores" % (len(os.listdir(directory)), cores))
+  print("workers\ttime (s)\tspeed-up")
+
+  for n in workers:
+    if n > cores:
+      continue
+
+    start = time.perf_counter()
+    contact.list_vcf_in_directory(directory, workers=n)
+    duration = time.perf_counter() - start
+
+    if reference is None:
+      reference = duration
+
+    print("%i\t%.3f\t\t%.2fx" % (n, duration, reference / duration))
+
+
+if __name__ == "__main__":
+  contacts = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+  if len(sys.argv) > 2:
+    run(sys.argv[2])
+  else:
+    with tempfile.TemporaryDirectory() as directory:
+      make_synthetic_book(directory, contacts)
+      run(directory)
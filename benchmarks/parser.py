@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+# Compare the fast vCard tokenizer against vobject: time per card, fallbacks and parity of the values.
+# Usage: python benchmarks/parser.py [number of contacts] [directory]
+# If no directory is given, a synthetic address book is generated in a temporary directory.
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data import contact
+from data import vcard
+from ingestion import make_synthetic_book
+
+
+def run(directory: str):
+  files = [os.path.join(directory, file) for file in sorted(os.listdir(directory)) if file.endswith(".vcf")]
+  contents = [contact.read_vcf(path)[0] for path in files]
+
+  start = time.perf_counter()
+  reference = [vcard.from_vobject(contact._read_vobject(content)) for content in contents]
+  vobject_time = time.perf_counter() - start
+
+  start = time.perf_counter()
+  fallbacks = 0
+  fast = []
+  for content in contents:
+    try:
+      fast.append(vcard.parse_vcard(content))
+    except vcard.Unsupported:
+      fast.append(None)
+      fallbacks += 1
+  fast_time = time.perf_counter() - start
+
+  mismatches = 0
+  for path, expected, parsed in zip(files, reference, fast):
+    if parsed is not None and parsed != expected:
+      mismatches += 1
+      for key in sorted(set(expected) | set(parsed)):
+        if expected.get(key) != parsed.get(key):
+          print("%s: %s\n  vobject: %s\n  fast:    %s" % (path, key, expected.get(key), parsed.get(key)))
+
+  print("%i cards" % len(files))
+  print("vobject:\t%.1f µs/card" % (vobject_time / len(files) * 1e6))
+  print("fast:\t\t%.1f µs/card (%.1fx)" % (fast_time / len(files) * 1e6, vobject_time / fast_time))
+  print("fallbacks to vobject: %i, mismatches: %i" % (fallbacks, mismatches))
+
+
+if __name__ == "__main__":
+  contacts = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+  if len(sys.argv) > 2:
+    run(sys.argv[2])
+  else:
+    with tempfile.TemporaryDirectory() as directory:
+      make_synthetic_book(directory, contacts)
+      run(directory)
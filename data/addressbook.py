@@ -16,15 +16,33 @@
 # You should have received a copy of the GNU General Public License along with Open Contact Book.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import threading
+
 import pandas as pd
 
+from data import query as ql
+from data import search as sx
+from data import lookup as lk
+from data import geoservice as gs
+from data.text import to_text, from_text
+
+def _same(a, b) -> bool:
+  """Compare two cells, lists and missing values included"""
+  if isinstance(a, list) or isinstance(b, list):
+    return a == b
+  missing = [value is None or (isinstance(value, float) and value != value) for value in (a, b)]
+  if any(missing):
+    return all(missing)
+  return bool(a == b)
+
+
 class addressDB(pd.DataFrame):
   def __init__(self, *args, **kargs):
     super().__init__()
 
 
 class addressBook():
-  def __init__(self, *args, hidden_cols=[], **kargs):
+  def __init__(self, *args, hidden_cols=[], store=None, search_limit=500, region=None, journal=None, **kargs):
     # addressDB contains the whole contacts book as fetched on disk
     self._addressDB = addressDB(*args, **kargs)
 
@@ -34,17 +52,155 @@ class addressBook():
     # addressView contains a subset of addressDB extracted by query and manipulated in GUI
     self._addressView = self._addressDB
 
-    # text query to build the view
+    # text query to build the view, see `data.query` for the syntax, and its compiled form
     self._query = ""
+    self._compiled = None
+
+    # cache of the query masks
+    self.engine = ql.QueryEngine(self._addressDB)
 
     # columns to hide in the view
     self.hidden_cols = hidden_cols
 
+    # index of the rows edited since the last checkpoint of the snapshot
+    self.dirty = set()
+
+    # optional `SQLiteStore` holding the full-text index, and maybe the only copy of the book.
+    # Books held only in the store, with an empty addressDB, are for headless scripts:
+    # the GUI always loads the whole book, and searches the store only as a copy of it.
+    self.store = store
+
+    # optional `Journal` of the edits, for undo, history and crash recovery
+    self.journal = journal
+
+    # optional `GeocodingService` locating the contacts whose address is edited
+    self.geocoder = None
+
+    # maximum number of contacts returned by a full-text search
+    self.search_limit = search_limit
+
+    # text searched as-you-type
+    self._search_text = ""
+
+    # indexes of the book, built on first use: words for `search()`, emails and phones for `lookup()`
+    self._indexes = {"search": None, "lookup": None}
+
+    # indexes may be built in a background thread: rows edited meanwhile are indexed after
+    self._index_lock = threading.Lock()
+    self._index_pending = {name: set() for name in self._indexes}
+
+    # ISO code of the country of national phone numbers, like "FR"
+    self.region = region
+
+  def _new_index(self, name):
+    if name == "search":
+      return sx.SearchIndex()
+    return lk.LookupIndex(region=self.region)
+
+  def build_index(self, name, progress=None, killswitch=None):
+    """Build the "search" or "lookup" index of the book. Thread-safe, may be run in a Worker."""
+    data = self._addressDB
+    index = self._new_index(name)
+    index.build(data)
+
+    with self._index_lock:
+      # The book was replaced meanwhile: the index is already outdated
+      if data is not self._addressDB:
+        return
+
+      index.update(data, self._index_pending[name])
+      self._index_pending[name] = set()
+      self._indexes[name] = index
+
+  def _get_index(self, name):
+    # Build it again if the book was replaced while building
+    while self._indexes[name] is None:
+      self.build_index(name)
+    return self._indexes[name]
+
+  def update_indexes(self, rows):
+    with self._index_lock:
+      for name, index in self._indexes.items():
+        if index is None:
+          self._index_pending[name] |= set(rows)
+        else:
+          index.update(self._addressDB, rows)
+
+  def search(self, text: str) -> pd.DataFrame:
+    """Search the words of text as you type, best matches first"""
+    # Books held only in the store are searched by full text
+    if self.store is not None and self._addressDB.empty:
+      return self.store.load(self.store.search(text, limit=self.search_limit))
+
+    index = self._get_index("search")
+    with self._index_lock:
+      rows = index.search(text, limit=self.search_limit)
+    return self._addressDB.loc[rows]
+
+  def lookup(self, keys) -> list:
+    """
+    Find the contacts owning emails or phone numbers, in constant time per key. Thread-safe.
+    :param keys: list of emails and phone numbers, in any format
+    :return: for each key, the list of the index of the rows holding it
+    """
+    index = self._get_index("lookup")
+    with self._index_lock:
+      return index.lookup(keys)
+
   def make_view(self):
-    try:
-      self._addressView = self.addressDB[self._query].drop(self.hidden_cols, axis = 1)
-    except:
-      self._addressView = self.addressDB.drop(self.hidden_cols, axis = 1)
+    # Books held only in the store are searched by full text
+    if self.store is not None and self._addressDB.empty:
+      text = " ".join([self._query, self._search_text]).strip()
+      if text:
+        self._addressView = self.search(text).drop(self.hidden_cols, axis = 1, errors = "ignore")
+        return
+
+    if self._search_text:
+      # Best matches of the search first, among the rows matching the query
+      rows = self.search(self._search_text).index
+      if self._compiled is not None:
+        rows = rows[self.engine.mask(self._compiled, rows).to_numpy()]
+      self._addressView = self.addressDB.loc[rows, self.visible_cols()]
+    elif self._compiled is None:
+      self._addressView = self.addressDB.drop(self.hidden_cols, axis = 1, errors = "ignore")
+    else:
+      # Filter rows and columns at once, to copy the data only once
+      mask = self.engine.mask(self._compiled).to_numpy()
+      self._addressView = self.addressDB.loc[mask, self.visible_cols()]
+
+  def visible_cols(self) -> pd.Index:
+    return self._addressDB.columns.drop(self.hidden_cols, errors = "ignore")
+
+  def patch_view(self, rows, refresh=True):
+    """
+    Update the view for the added, modified or removed rows only, instead of filtering the whole book again
+    :param refresh: copy the values of the rows already in the view. If False, only the rows that start
+    or stop matching the query are added or removed.
+    """
+    # Search results are ranked and limited: search again
+    if self._search_text:
+      self.make_view()
+      return
+
+    rows = pd.Index(rows)
+    present = rows.intersection(self._addressDB.index)
+    matching = present[self.engine.mask(self._compiled, present).to_numpy()]
+
+    view = self._addressView
+    stale = rows.intersection(view.index)
+    if not refresh:
+      stale = stale.difference(matching)
+      matching = matching.difference(view.index)
+
+    if len(stale) == 0 and len(matching) == 0:
+      return
+
+    columns = self.visible_cols()
+    view = pd.concat([view.drop(index = stale), self._addressDB.loc[matching, columns]], axis = 0)
+
+    # Keep the order of the book
+    order = self._addressDB.index[self._addressDB.index.isin(view.index)]
+    self._addressView = view.reindex(index = order, columns = columns)
 
   # Getters/Setters for addressDB
   def get_addressDB(self):
@@ -55,12 +211,101 @@ class addressBook():
     # user interactions should only use the view
     self._addressDB = data
 
-    # Add a column to track user edits in line
-    self._addressDB["changed"] = False
+    # Add a column to track user edits in line.
+    # Edits not written back to the files yet stay flagged.
+    if "changed" in data.columns:
+      self._addressDB["changed"] = data["changed"].fillna(False).astype(bool)
+    else:
+      self._addressDB["changed"] = False
+
+    # Forget the indexes of the previous book, they are built again on their next use
+    with self._index_lock:
+      self._indexes = {name: None for name in self._indexes}
+      self._index_pending = {name: set() for name in self._indexes}
 
     # Build the view
+    self.engine.set_data(self._addressDB)
     self.make_view()
 
+  def update_addressDB(self, data, rows):
+    """
+    Replace the book by a newer version where only some rows were added, modified or removed,
+    as after a sync of files, and patch the view accordingly
+    :param rows: index of the added, modified and removed rows
+    """
+    # Keep the edit flags of the unchanged rows
+    if "changed" in data.columns:
+      data["changed"] = data["changed"].fillna(False).astype(bool)
+    else:
+      data["changed"] = False
+
+    with self._index_lock:
+      self._addressDB = data
+    self.engine.update(rows, data)
+    self.update_indexes(rows)
+    self.patch_view(rows)
+
+  def merge_rows(self, data, rows, base):
+    """
+    Merge the rows added, modified or removed by a worker in its copy of the book, as a sync of files
+    or a write-back. Cells edited in the book since the copy was made are kept, and their row stays flagged
+    as changed. The other rows of the book are kept as they are now.
+    :param data: the book returned by the worker
+    :param rows: index of the rows added, modified or removed by the worker
+    :param base: the copy of the book given to the worker
+    :return: index of the rows edited meanwhile
+    """
+    live = self._addressDB
+    rows = pd.Index(rows)
+    updated = rows.intersection(data.index)
+    removed = rows.difference(data.index).intersection(live.index)
+
+    merged = data.loc[updated]
+    edited = []
+    for row in updated.intersection(live.index).intersection(base.index):
+      cols = [col for col in live.columns
+              if col != "changed" and not _same(live.at[row, col], base.at[row, col] if col in base.columns else None)]
+      if not cols:
+        continue
+      if not edited:
+        merged = merged.copy()
+      edited.append(row)
+      for col in cols:
+        value = live.at[row, col]
+        if col not in merged.columns:
+          merged[col] = None
+        elif isinstance(merged[col].dtype, pd.CategoricalDtype) and isinstance(value, str) \
+                and value not in merged[col].cat.categories:
+          merged[col] = merged[col].cat.add_categories([value])
+        merged._set_value(row, col, value)
+      # Locations are not edits of the user
+      if any(not col.startswith("z-") for col in cols):
+        merged._set_value(row, "changed", True)
+
+    # Keep the order of the book, new rows last
+    kept = live.index[~live.index.isin(rows)]
+    order = live.index[~live.index.isin(removed)].append(updated.difference(live.index))
+    data = pd.concat([live.loc[kept], merged], axis=0).reindex(order)
+
+    for col in live.columns:
+      if isinstance(live[col].dtype, pd.CategoricalDtype) and not isinstance(data[col].dtype, pd.CategoricalDtype):
+        data[col] = data[col].astype("category")
+
+    self.update_addressDB(data, rows)
+    return pd.Index(edited)
+
+  def merge_committed(self, data, base):
+    """
+    Merge the book returned by `contact.commit_vcf_changes`, run on a copy of the book.
+    Rows edited again while they were written stay flagged as changed, with their new values.
+    :param base: the copy of the book given to the commit
+    :return: index of the rows written to their file
+    """
+    written = ~data["changed"].reindex(base.index, fill_value=True).astype(bool)
+    rows = base.index[base["changed"].astype(bool) & written]
+    self.merge_rows(data, rows, base)
+    return rows
+
   def del_addressDB(self):
     del self._addressDB
 
@@ -80,6 +325,8 @@ class addressBook():
     return self._query
 
   def set_query(self, query):
+    # Raises `QueryError` on syntax errors, keeping the current view
+    self._compiled = ql.compile(query)
     self._query = query
     self.make_view()
 
@@ -88,11 +335,140 @@ class addressBook():
 
   query = property(get_query, set_query, del_query)
 
-  def set_value(self, row, col, value):
-    # set both view and data
-    self._addressView._set_value(row, col, value)
-    self._addressDB._set_value(row, col, value)
+  # Getters/Setters for the as-you-type search
+  def get_search_text(self):
+    return self._search_text
 
-    # set the changed flag on the row
+  def set_search_text(self, text):
+    self._search_text = text
+    self.make_view()
+
+  search_text = property(get_search_text, set_search_text)
+
+  def set_value(self, row, col, value, record=True):
+    """
+    Edit a cell from the view, flag the row as changed and journal the edit
+    :param record: False to not journal the edit, when it is an undo or redo already journaled
+    """
+    # The view may hold rows read from the store only
+    resident = row in self._addressDB.index
+    source = self._addressDB if resident else self._addressView
+    previous = source.at[row, col] if col in source.columns else None
+
+    # Multi-valued cells are edited as comma-separated text
+    if isinstance(value, str):
+      value = from_text(value, col)
+
+    if record and self.journal is not None:
+      self.journal.record(row, source.at[row, "z-file"] if "z-file" in source.columns else None,
+                          col, previous, value)
+
+    # Properties no contact had yet: list cells need a column of objects
+    for frame in (self._addressView, self._addressDB):
+      if col not in frame.columns:
+        frame[col] = pd.Series(None, index=frame.index, dtype=object)
+
+    # Categories of compacted columns only accept known values
+    for frame in (self._addressView, self._addressDB):
+      column = frame[col] if col in frame.columns else None
+      if column is not None and isinstance(column.dtype, pd.CategoricalDtype) \
+              and isinstance(value, str) and value not in column.cat.categories:
+        frame[col] = column.cat.add_categories([value])
+
+    # set both view and data, and the changed flag on the row
+    self._addressView._set_value(row, col, value)
     self._addressView._set_value(row, "changed", True)
-    self._addressDB._set_value(row, "changed", True)
+
+    if resident:
+      self._addressDB._set_value(row, col, value)
+      self._addressDB._set_value(row, "changed", True)
+
+      # The row may not match the query anymore, or the other way around
+      self.engine.update([row])
+      self.update_indexes([row])
+      self.patch_view([row], refresh = False)
+
+    self.dirty.add(row)
+
+    if self.store is not None:
+      self.store.set_value(row, col, value)
+      self.store.set_value(row, "changed", True)
+
+    # The location of the contact is outdated, find it first
+    if col.startswith("adr-") and resident and "z-geoupdate" in self._addressDB.columns:
+      self._addressDB._set_value(row, "z-geoupdate", True)
+      if self.geocoder is not None:
+        self.geocoder.submit(self._addressDB, [row], priority=gs.EDITED)
+
+  def set_locations(self, results):
+    """
+    Store the locations found by the geocoding of contacts. They are not edits of the user:
+    they are not journaled, and don't flag the contacts as changed.
+    :param results: list of tuple(row, z-geohint, z-geoID, z-exactlocation)
+    :return: the rows updated
+    """
+    results = [result for result in results if result[0] in self._addressDB.index]
+    if not results:
+      return []
+
+    # Drop the results of contacts whose address changed since they were queued
+    current = gs.address_hints(self._addressDB, [result[0] for result in results])
+    results = [result for result in results if current[result[0]] == result[1]]
+    if not results:
+      return []
+
+    rows, hints, geoIDs, exact = (list(values) for values in zip(*results))
+    for col, values, default in (("z-geohint", hints, ""), ("z-geoID", geoIDs, None),
+                                 ("z-exactlocation", exact, False), ("z-geoupdate", False, True)):
+      if col not in self._addressDB.columns:
+        self._addressDB[col] = default
+      self._addressDB.loc[rows, col] = values
+
+    if self.store is not None:
+      self.store.write(self._addressDB, rows)
+
+    self.dirty |= set(rows)
+    self.patch_view(rows)
+    return rows
+
+  def _replay(self, change):
+    # Apply a change returned by the journal, if its contact is still there
+    if change is None:
+      return None
+
+    row = change["r"]
+    source = self._addressDB if row in self._addressDB.index else self._addressView
+    if row not in source.index or ("z-file" in source.columns and source.at[row, "z-file"] != change["f"]):
+      return None
+
+    self.set_value(row, change["c"], change["n"], record=False)
+    return row
+
+  def undo(self):
+    """
+    Revert the last edit
+    :return: the index of the row edited, or None if there was nothing to undo or its contact is gone
+    """
+    return self._replay(self.journal.undo()) if self.journal is not None else None
+
+  def redo(self):
+    """
+    Apply again the last reverted edit
+    :return: the index of the row edited, or None if there was nothing to redo or its contact is gone
+    """
+    return self._replay(self.journal.redo()) if self.journal is not None else None
+
+  def restore_contact(self, row, when: float):
+    """
+    Set back the cells of a contact to their value at some point in time.
+    The restoration is an edit like any other, it can be undone.
+    :param when: UNIX time
+    :return: list of the restored columns
+    """
+    if self.journal is None:
+      return []
+
+    values = self.journal.values_at(row, when)
+    for col, value in values.items():
+      self.set_value(row, col, value)
+    return list(values)
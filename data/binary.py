@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import base64
+import re
+
+from data import vcard
+from data.cache import hash_buffer
+
+# binary:<hash>:<offset>:<length>:<path>, the path last since it may contain colons
+PREFIX = "binary:"
+REFERENCE = re.compile(r"^binary:([0-9a-f]+):(\d+):(\d+):(.+)$", re.DOTALL)
+WHITESPACE = re.compile(rb"\s+")
+
+
+def make_reference(path: str, offset: int, length: int, hash: str) -> str:
+  return "%s%s:%i:%i:%s" % (PREFIX, hash, offset, length, path)
+
+
+def is_reference(value) -> bool:
+  return isinstance(value, str) and value.startswith(PREFIX)
+
+
+def parse_reference(reference: str) -> tuple:
+  """:return: tuple(path, offset, length, hash)"""
+  match = REFERENCE.match(reference)
+  if match is None:
+    raise ValueError("Invalid binary reference %s" % reference)
+  hash, offset, length, path = match.groups()
+  return path, int(offset), int(length), hash
+
+
+def references(content: str, path: str, offset=0) -> dict:
+  """
+  Build references to the inline binary values of a card, instead of keeping their base64 text
+  :param content: text of the card
+  :param offset: byte offset of the card in the file, for cards imported from multi-card files
+  :return: dict of lower-case property name -> references separated by new lines, like `vcard.flatten`
+  """
+  spans = vcard.binary_spans(content)
+  if not spans:
+    return dict()
+
+  result = dict()
+  position = 0
+  start_byte = offset
+  for start, end, key in sorted((start, end, key) for key, key_spans in spans.items() for start, end in key_spans):
+    # Byte offset in the file, the text before may not be ASCII
+    start_byte += len(content[position:start].encode("utf-8"))
+    position = start
+
+    raw = content[start:end].encode("utf-8")
+    reference = make_reference(path, start_byte, len(raw), hash_buffer(raw))
+    result[key] = result[key] + "\n" + reference if key in result else reference
+
+  return result
+
+
+def read_binary(reference: str) -> bytes:
+  """
+  Read and decode the value referenced, from its file
+  :raise ValueError: if the file changed since the reference was made
+  :raise OSError: if the file can't be read
+  """
+  path, offset, length, hash = parse_reference(reference)
+  with open(path, "rb") as f:
+    f.seek(offset)
+    raw = f.read(length)
+
+  if hash_buffer(raw) != hash:
+    raise ValueError("%s changed since it was read, reload it first" % path)
+
+  # Remove the folding
+  return base64.b64decode(WHITESPACE.sub(b"", raw))
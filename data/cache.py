@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+# Helpers shared by the modules keeping data in memory or on disk: the hash detecting
+# the changes of files and binary values, and a cache of the last used values.
+# They don't depend on the other modules, which may all import them.
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+try:
+  import xxhash
+except ImportError:
+  xxhash = None
+
+
+def hash_buffer(buffer) -> str:
+  """
+  Compute the hash of a bytes-like object, to detect file changes.
+  Use the non-cryptographic xxHash if available, else BLAKE2.
+  """
+  if xxhash is not None:
+    return xxhash.xxh3_128_hexdigest(buffer)
+  return hashlib.blake2b(buffer, digest_size=16).hexdigest()
+
+
+class LRUCache():
+  """
+  Thread-safe cache of the last used values, like decoded images or their thumbnails,
+  holding at most maxsize items
+  """
+
+  def __init__(self, maxsize=256):
+    self.maxsize = maxsize
+    self._items = OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self._items)
+
+  def __contains__(self, key):
+    return key in self._items
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
+
+  def get(self, key, compute):
+    """
+    Return the cached value of key, or compute it with compute(key) and cache it.
+    Errors of compute are not cached.
+    """
+    with self._lock:
+      if key in self._items:
+        self._items.move_to_end(key)
+        self.hits += 1
+        return self._items[key]
+      self.misses += 1
+
+    value = compute(key)
+
+    with self._lock:
+      self._items[key] = value
+      self._items.move_to_end(key)
+      while len(self._items) > self.maxsize:
+        self._items.popitem(last=False)
+
+    return value
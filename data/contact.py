@@ -20,36 +20,62 @@ import os
 import pandas as pd
 import re
 import unidecode
-import requests
 import json
-import hashlib
+import mmap
 import country_list
+import multiprocessing
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 
 import vobject as vo
-from data.nominatim import Nominatim
+from data.nominatim import Nominatim, GeocodingError
+from data.manifest import FileManifest
 from data.spellcheck import GeoSpellChecker
+from data import vcard
+from data import binary
+from data.cache import hash_buffer
 from urllib.parse import urlencode
 
 
+# Files larger than this are memory-mapped instead of read in a buffer
+MMAP_THRESHOLD = 1 << 20
+
+
+def read_vcf(path: str):
+    """
+    Read a file once and return its decoded content along with its hash,
+    both computed from the same bytes.
+    :return: tuple(str, str) of content and hash
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            # Hash and decode straight from the page cache, without intermediate copy
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                return str(buffer, "utf-8", errors="replace"), hash_buffer(buffer)
+
+        buffer = f.read()
+
+    return buffer.decode("utf-8", errors="replace"), hash_buffer(buffer)
+
+
 def hash_file(path):
     """Open a file and compute its hash"""
-    BLOCK_SIZE = 65536
-    file_hash = hashlib.sha256()
+    return read_vcf(path)[1]
 
-    with open(path, 'rb') as f:
-        fb = (f.read(BLOCK_SIZE))
-        while len(fb) > 0:
-            file_hash.update(fb)
-            fb = (f.read(BLOCK_SIZE))
 
-    return file_hash.hexdigest()
+# Parser used by default: "fast" tokenizes the cards directly and falls back to vobject
+# for the cards it can't handle, "vobject" always uses vobject.
+PARSER_BACKENDS = ("fast", "vobject")
+DEFAULT_BACKEND = "fast"
 
 
-def parse_vcf(content, path: str):
+def _read_vobject(content: str) -> dict:
     # Remove accentuated characters in vCard tags
     # Otherwise it makes some vobject fail (actually, the codec lib it uses)
     # Also… what stupid vCard app allows them ???
-    regex = r"^([A-ZÉÈÊÀÃ\-\;]+):"
+    regex = r"^([A-ZÉÈÊÀÃ\-\;]+):"
     matches = re.finditer(regex, content, re.MULTILINE)
 
     for matchNum, match in enumerate(matches):
@@ -57,150 +83,730 @@ def parse_vcf(content, path: str):
         content = content.replace(tag, unidecode.unidecode(tag))
 
     # Get the inner of the vcard as a Python dict
-    parsed = vo.readOne(content).contents
+    return vo.readOne(content).contents
+
+
+def parse_vcf(content, path: str, hash=None, backend=DEFAULT_BACKEND, offset=0):
+    """
+    Parse the content of a .vcf file.
+    Inline binary values, like photos, are replaced by references to their place in the file,
+    see `binary.read_binary`.
+    :param content: decoded text of the file
+    :param path: path of the file
+    :param hash: hash of the file content, as returned by `read_vcf`. Computed from the file if None.
+    :param backend: one of `PARSER_BACKENDS`
+    :param offset: byte offset of the card in the file, for multi-card files
+    """
+    if backend not in PARSER_BACKENDS:
+        raise ValueError("Unknown parser backend %s" % backend)
+
+    parsed = None
+    if backend == "fast":
+        try:
+            parsed = vcard.parse_vcard(content)
+        except vcard.Unsupported:
+            pass
+
+    if parsed is None:
+        parsed = vcard.from_vobject(_read_vobject(content))
+
+    parsed = vcard.flatten(parsed)
+    parsed.update({key: reference for key, reference in binary.references(content, path, offset).items()
+                   if key in parsed})
     parsed["z-file"] = path
-    parsed["z-hash"] = hash_file(path)
+    parsed["z-hash"] = hash if hash is not None else hash_file(path)
     parsed["z-geoupdate"] = True
 
     return parsed
 
 
-def list_vcf_in_directory(directory: str, progress=None, killswitch=None):
+def _parse_vcf_files(paths: list, backend=DEFAULT_BACKEND):
+    """
+    Read and parse a chunk of .vcf files.
+    This is the unit of work sent to the worker processes of `list_vcf_in_directory`,
+    so it needs to stay a module-level function to be picklable.
+    """
+    contacts = []
+    for path in paths:
+        content, hash = read_vcf(path)
+        contacts.append(parse_vcf(content, path, hash, backend))
+
+    return contacts
+
+
+def list_vcf_in_directory(directory: str, progress=None, killswitch=None, workers=1, chunksize=64, manifest=None,
+                          backend=DEFAULT_BACKEND):
     """
     Thread-safe address book building
     :param progress: Qt Worker Signal to emit progress info
     :param killswitch: Thread-safe boolean stopping the process if == True
+    :param workers: number of processes parsing files in parallel. 1 parses sequentially
+    in the current thread, None uses all the CPU cores.
+    :param chunksize: number of files sent at once to each worker process
+    :param manifest: optional `FileManifest` recording the state of the parsed files,
+    for later use by `sync_vcf_in_directory`
+    :param backend: parser backend, one of `PARSER_BACKENDS`
     """
-    contacts = []
-    all_files = os.listdir(directory)
+    all_files = [os.path.join(directory, file)
+                 for file in sorted(os.listdir(directory)) if file.endswith(".vcf")]
     files_number = len(all_files)
-    current_file = 0
 
-    # Walk the directory to find al files
-    for file in sorted(all_files):
+    # Stat the files before reading them: if they change in-between, the next sync will catch it
+    if manifest is not None:
+        stats = {path: os.stat(path) for path in all_files}
 
-        # Update the progress bar if any
-        if progress is not None:
-            progress.emit((current_file, 0, files_number,
-                          "Parsing files", "Reading directory"))
-            current_file += 1
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # Split the file list in chunks of consecutive files.
+    # Chunks are processed as a whole, so they need to be large enough
+    # to amortize the inter-process communication
+    chunks = [all_files[i:i + chunksize] for i in range(0, files_number, chunksize)]
+
+    if workers > 1 and len(chunks) > 1:
+        contacts = _list_vcf_parallel(chunks, files_number, workers, backend, progress, killswitch)
+    else:
+        contacts = _list_vcf_sequential(chunks, files_number, backend, progress, killswitch)
+
+    if manifest is not None:
+        for parsed in contacts:
+            manifest.update(parsed["z-file"], stats[parsed["z-file"]], parsed["z-hash"])
+
+    if progress is not None:
+        progress.emit((files_number, 0, files_number,
+                      "Parsing files", "Reading directory"))
+
+    # Collapse this into a database, aka Pandas DataFrame
+    return pd.DataFrame(contacts)
+
+
+def _list_vcf_sequential(chunks: list, files_number: int, backend=DEFAULT_BACKEND, progress=None, killswitch=None):
+    contacts = []
+    current_file = 0
 
+    for chunk in chunks:
         # Abort and update the progress bar on killswitch
         if killswitch is not None and killswitch.is_set():
             if progress is not None:
                 progress.emit((current_file, 0, current_file,
-                              files_number, "cancel", "Reading directory"))
+                              "cancel", "Reading directory"))
             break
 
-        if file.endswith(".vcf"):
-            path = os.path.join(directory, file)
-            f = open(path, "r")
-            content = f.read()
-            f.close()
-            contacts.append(parse_vcf(content, path))
+        contacts += _parse_vcf_files(chunk, backend)
+        current_file += len(chunk)
 
-    if progress is not None:
-        progress.emit((current_file, files_number, files_number,
-                      "Parsing files", "Reading directory"))
+        # Update the progress bar if any
+        if progress is not None:
+            progress.emit((current_file, 0, files_number,
+                          "Parsing files", "Reading directory"))
 
-    # Collapse this into a database, aka Pandas DataFrame
-    data = pd.DataFrame(contacts)
+    return contacts
 
-    return data.astype(str)
 
+def _list_vcf_parallel(chunks: list, files_number: int, workers: int, backend=DEFAULT_BACKEND,
+                       progress=None, killswitch=None):
+    # Use spawned processes: forking a process that runs Qt threads is not safe
+    context = multiprocessing.get_context("spawn")
+    contacts = []
+    current_file = 0
 
-def update_vcf_in_directory(directory: str, data: pd.DataFrame, progress=None, killswitch=None):
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        # Submit everything at once, the executor queues the chunks.
+        # Results are collected in submission order to keep the files sorted.
+        futures = [executor.submit(_parse_vcf_files, chunk, backend) for chunk in chunks]
+
+        for future, chunk in zip(futures, chunks):
+            # Wait for the chunk while polling the killswitch,
+            # so cancelling doesn't have to wait for a whole chunk to finish
+            while not future.done():
+                if killswitch is not None and killswitch.is_set():
+                    break
+                wait([future], timeout=0.1)
+
+            # Abort the outstanding chunks and update the progress bar on killswitch
+            if killswitch is not None and killswitch.is_set():
+                executor.shutdown(wait=False, cancel_futures=True)
+                if progress is not None:
+                    progress.emit((current_file, 0, current_file,
+                                  "cancel", "Reading directory"))
+                break
+
+            contacts += future.result()
+            current_file += len(chunk)
+
+            # Update the progress bar if any
+            if progress is not None:
+                progress.emit((current_file, 0, files_number,
+                              "Parsing files", "Reading directory"))
+
+    return contacts
+
+
+def update_vcf_in_directory(directory: str, data: pd.DataFrame, progress=None, killswitch=None, manifest=None,
+                            backend=DEFAULT_BACKEND, paths=None, store=None):
     """
     Thread-safe address book building
     :param progress: Qt Worker Signal to emit progress info
     :param killswitch: Thread-safe boolean stopping the process if == True
+    :param manifest: `FileManifest` of the files state at the time of the last parsing
+    :param backend: parser backend, one of `PARSER_BACKENDS`
+    :param paths: optional list of the only files to check, as reported by a `DirectoryWatcher`
+    :param store: optional `SQLiteStore` to update with the changes
     """
-    all_files = os.listdir(directory)
-    files_number = len(all_files)
-    current_file = 0
+    data, changes = sync_vcf_in_directory(directory, data, manifest=manifest, backend=backend, paths=paths,
+                                          store=store, progress=progress, killswitch=killswitch)
+    return data
+
+
+def sync_vcf_in_directory(directory: str, data: pd.DataFrame, manifest=None, backend=DEFAULT_BACKEND,
+                          paths=None, store=None, progress=None, killswitch=None):
+    """
+    Incrementally update the address book from the .vcf files in directory.
+
+    Files whose inode, size and modification time match the manifest are skipped without
+    being read. Other files are hashed and parsed again only if their hash changed.
+    Rows of deleted files are removed.
+
+    If paths is given, only those files are checked, which is what a filesystem watcher reports.
+    Otherwise the whole directory is walked.
+
+    Rows with unsaved edits, flagged "changed", are kept as they are when their file was modified
+    on disk meanwhile, and reported as conflicts. Their file stays out of the manifest, and their hash
+    is not updated, so `commit_vcf_changes` refuses to overwrite the file. Parsed rows are not "changed".
+
+    :param manifest: `FileManifest` of the files state at the time of the last parsing.
+    It is updated in place. If None, all files are hashed.
+    :param backend: parser backend, one of `PARSER_BACKENDS`
+    :param paths: optional list of the only files to check
+    :param store: optional `SQLiteStore` updated with the added, modified and deleted rows only
+    :param progress: Qt Worker Signal to emit progress info
+    :param killswitch: Thread-safe boolean stopping the process if == True
+    :return: tuple(data, changes) where changes is a dict with "added", "modified",
+    "deleted" and "conflicts" lists of file paths.
+    """
+    if manifest is None:
+        manifest = FileManifest()
 
     if "z-file" not in data.columns:
         raise ValueError(
             "No file entry was found in the database. This should not happen")
 
-    # Walk the directory to find al files
-    for file in sorted(all_files):
+    # Index the DB by file path once, instead of filtering the whole DB for each file.
+    # Cards imported from multi-card files are managed by `import_vcf_file`, not synced here.
+    files = data["z-file"]
+    imported = set()
+    if "z-offset" in data.columns:
+        from_import = _imported_rows(data)
+        imported = set(files[from_import])
+        files = files[~from_import]
+
+    if files.duplicated().any():
+        # We have more than one line for some file
+        # Someone tampered with our database
+        raise ValueError(
+            "Undefined behaviour: we have more than one record in database for %s, this should never happen"
+            % files[files.duplicated()].iloc[0])
+
+    rows = dict(zip(files, data.index))
+    hashes = dict(zip(files, data.loc[files.index, "z-hash"])) if "z-hash" in data.columns else dict()
+    edited = set(files[data.loc[files.index, "changed"].fillna(False).astype(bool)]) \
+        if "changed" in data.columns else set()
+
+    if paths is None:
+        all_files = [os.path.join(directory, file)
+                     for file in sorted(os.listdir(directory)) if file.endswith(".vcf")]
+    else:
+        all_files = sorted(set(path for path in paths if path.endswith(".vcf")))
+    files_number = len(all_files)
+    current_file = 0
+    completed = True
+
+    changes = {"added": [], "modified": [], "deleted": [], "conflicts": []}
+    added = []
+    modified = []
+    modified_index = []
+    seen = set()
+
+    # Walk the directory to find all files
+    for path in all_files:
+        if path in imported:
+            continue
 
         # Update the progress bar if any
-        if progress is not None:
+        if progress is not None and current_file % 256 == 0:
             progress.emit((current_file, 0, files_number,
                           "Parsing files", "Reading directory"))
-            current_file += 1
+        current_file += 1
 
         # Abort and update the progress bar on killswitch
         if killswitch is not None and killswitch.is_set():
             if progress is not None:
                 progress.emit((current_file, 0, current_file,
-                              files_number, "cancel", "Reading directory"))
+                              "cancel", "Reading directory"))
+            completed = False
             break
 
-        if file.endswith(".vcf"):
-            path = os.path.join(directory, file)
-            f = open(path, "r")
-            content = f.read()
-            f.close()
-
-            # Look if the file is already in DB
-            query = data[data["z-file"] == path]
-
-            if len(query.index) == 1:
-                # File already in DB : check for changes
-                hash = hash_file(path)
-                if(hash != query.iloc[0]["z-hash"]):
-                    print("updating", path)
-
-                    # Create a new dataframe with one row at the same index as the DB match
-                    new_line = pd.DataFrame(
-                        parse_vcf(content, path), index=query.index).astype(str)
-
-                    # Merge the new line within DB: this will not update the actual line
-                    # but will add the relevant columns in case your updated entry uses more Vcard tags than the DB
-                    data = pd.merge(data, new_line, how="left")
-
-                    # Now, data is guaranteed to have as many cols as new_line
-                    # update the line for real
-                    data.loc[query.index] = new_line
-
-                else:
-                    pass
-                    # nothing to do, file didn't change
-
-            elif len(query.index) == 0:
-                print("adding", path)
-                # File not found in DB : add it now
-                # Create a new dataframe with one row and new index
-                new_line = pd.DataFrame(parse_vcf(content, path)).astype(str)
-
-                # Append the new line within DB and add a new global column
-                # in DB if a new tag is found in the .vcf
-                data = pd.concat([data, new_line], axis=0, ignore_index=True)
-
-            else:
-                # We have more than one line for this file
-                # Someone tampered with our database
-                raise ValueError(
-                    "Undefined behaviour: we have more than one record in database for %s, this should never happen" % path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            # Reported by a watcher, but deleted since
+            continue
+
+        seen.add(path)
+
+        # Fast path: the file metadata didn't change since the DB row was built from it
+        if path in rows and manifest.is_unchanged(path, stat) \
+                and manifest.get_hash(path) == hashes.get(path):
+            continue
+
+        content, hash = read_vcf(path)
+
+        if path in rows and hash == hashes.get(path):
+            # The file was touched but its content didn't change
+            manifest.update(path, stat, hash)
+            continue
+
+        if path in edited:
+            # Don't lose the edits not written back to the file yet
+            print("keeping the unsaved edits of", path, "modified on disk since")
+            changes["conflicts"].append(path)
+            continue
+
+        parsed = parse_vcf(content, path, hash, backend)
+        manifest.update(path, stat, hash)
+
+        if path in rows:
+            print("updating", path)
+            changes["modified"].append(path)
+            modified.append(parsed)
+            modified_index.append(rows[path])
+        else:
+            print("adding", path)
+            changes["added"].append(path)
+            added.append(parsed)
+
+    # Files removed from the directory since the last sync.
+    # If the sync was aborted, we don't know which files remain to be seen.
+    if completed:
+        if paths is None:
+            changes["deleted"] = [path for path in rows if path not in seen]
+        else:
+            changes["deleted"] = [path for path in all_files if path in rows and path not in seen]
+
+        for path in changes["deleted"]:
+            print("removing", path)
+            manifest.remove(path)
+
+        if changes["deleted"]:
+            data = data.drop([rows[path] for path in changes["deleted"]])
+
+    if modified:
+        # Create a new dataframe with the updated rows at the same index as the DB matches
+        new_lines = pd.DataFrame(modified, index=modified_index)
+        if "changed" in data.columns:
+            new_lines["changed"] = False
+
+        # Swap the old lines for the new ones and restore the original order.
+        # This adds the relevant columns in case the updated entries use more vCard tags than the DB,
+        # and resets to missing the tags removed from the updated entries.
+        order = data.index
+        data = pd.concat([data.drop(index=modified_index), new_lines], axis=0).reindex(order)
+
+    if added:
+        # Append the new lines within DB and add a new global column
+        # in DB if a new tag is found in the .vcf
+        # New lines get new indices so the existing rows keep theirs
+        start = data.index.max() + 1 if len(data.index) > 0 else 0
+        new_lines = pd.DataFrame(added, index=pd.RangeIndex(start, start + len(added)))
+        if "changed" in data.columns:
+            new_lines["changed"] = False
+        data = pd.concat([data, new_lines], axis=0)
 
     if progress is not None:
-        progress.emit((current_file, files_number, files_number,
+        progress.emit((files_number, 0, files_number,
                       "Parsing files", "Reading directory"))
 
-    return data
+    if store is not None:
+        store.sync(data, changes)
+
+    return data, changes
+
+
+def _imported_rows(data: pd.DataFrame):
+    """Boolean mask of the rows imported from multi-card files, which have a byte offset"""
+    if "z-offset" not in data.columns:
+        return pd.Series(False, index=data.index)
+    return ~(data["z-offset"].isna() | data["z-offset"].isin(["nan", ""]))
 
 
-def cleanup_contact(data: pd.DataFrame, progress=None, killswitch=None):
+def write_vcf(path: str, content: str) -> str:
     """
-    Thread-safe address book building
+    Atomically replace the content of a file: write a temporary file in the same directory,
+    flush it to disk and rename it over the original. Readers see either the old or the new file, never a partial one.
+    :return: hash of the new content, as computed by `read_vcf`
+    """
+    buffer = content.encode("utf-8")
+    directory = os.path.dirname(path) or "."
+
+    # Not ending with .vcf, so the directory sync and watchers ignore it
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(buffer)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            os.chmod(temp_path, os.stat(path).st_mode & 0o7777)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return hash_buffer(buffer)
+
+
+def _fsync_directory(directory: str):
+    # Make the renames durable. Not supported on Windows, where renames are journaled anyway.
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _commit_vcf(path: str, row: dict, hash: str, backend=DEFAULT_BACKEND):
+    """
+    Patch a single .vcf file with the values of its row
+    :param hash: hash of the file when the row was parsed
+    :return: tuple(new hash, os.stat_result, dict of the binary references moved in the file)
+    """
+    content, current_hash = read_vcf(path)
+    if hash is not None and current_hash != hash:
+        raise RuntimeError("the file was modified on disk since it was read, reload it first")
+
+    parsed = None
+    if backend == "fast":
+        try:
+            parsed = vcard.parse_vcard(content)
+        except vcard.Unsupported:
+            pass
+
+    if parsed is None:
+        parsed = vcard.from_vobject(_read_vobject(content))
+
+    # Binary values are not loaded, their references mean they are unchanged
+    original = vcard.flatten(parsed)
+    row = {key: original.get(key) if binary.is_reference(value) else value for key, value in row.items()}
+
+    new_content = vcard.patch_vcard(content, row, parsed)
+    if new_content == content:
+        return current_hash, os.stat(path), dict()
+
+    # Lines before the binary values may have changed length
+    references = {key: reference for key, reference in binary.references(new_content, path).items()
+                  if binary.is_reference(row.get(key)) or key in original}
+
+    return write_vcf(path, new_content), os.stat(path), references
+
+
+def commit_vcf_changes(data: pd.DataFrame, manifest=None, workers=8, backend=DEFAULT_BACKEND,
+                       progress=None, killswitch=None):
+    """
+    Write the rows flagged as "changed" back to their .vcf file.
+
+    Only the properties that differ from the file are rewritten, other lines are kept as-is.
+    Files are replaced atomically by `write_vcf`, from a pool of threads since the time is spent
+    waiting for the disk. Files modified on disk since they were parsed are not overwritten.
+
+    The new hashes are stored in the rows and in the manifest, so the next `sync_vcf_in_directory`
+    doesn't parse the written files again.
+
+    :param manifest: `FileManifest` updated in place with the written files
+    :param workers: number of threads writing files
+    :param backend: parser backend reading the files before patching them, one of `PARSER_BACKENDS`
+    :param progress: Qt Worker Signal to emit progress info
+    :param killswitch: Thread-safe boolean stopping the process if == True
+    :return: tuple(data, failures) where data has updated "z-hash" and "changed" columns for the written rows,
+    and failures is a dict of file path -> error message. Rows that failed stay flagged as changed.
+    """
+    if "changed" not in data.columns or "z-file" not in data.columns:
+        return data, dict()
+
+    changed = data.index[data["changed"].fillna(False).astype(bool)]
+    failures = dict()
+    if len(changed) == 0:
+        return data, failures
+
+    if is_legacy_frame(data):
+        raise ValueError("The address book was built by an older version, reload it from the files first")
+
+    # Cards imported from multi-card files have no file of their own to write
+    imported = _imported_rows(data).loc[changed]
+    for path in data.loc[imported[imported].index, "z-file"]:
+        failures[path] = "cards imported from multi-card files can't be written back"
+    changed = imported.index[~imported]
+
+    columns = data.columns.tolist()
+    has_hash = "z-hash" in data.columns
+    hashes = dict()
+    references = dict()
+    files_number = len(changed)
+    current_file = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict()
+        for index, values in zip(changed, data.loc[changed].itertuples(index=False, name=None)):
+            row = dict(zip(columns, values))
+            hash = row.get("z-hash") if has_hash and isinstance(row.get("z-hash"), str) else None
+            futures[executor.submit(_commit_vcf, row["z-file"], row, hash, backend)] = index
+
+        for future in as_completed(futures):
+            index = futures[future]
+            path = data.at[index, "z-file"]
+
+            if killswitch is not None and killswitch.is_set():
+                # Files already being written complete, the others are not started
+                for pending in futures:
+                    pending.cancel()
+
+            if future.cancelled():
+                continue
+
+            try:
+                hash, stat, moved = future.result()
+            except Exception as error:
+                failures[path] = str(error)
+                continue
+
+            hashes[index] = hash
+            for key, reference in moved.items():
+                references.setdefault(key, dict())[index] = reference
+            if manifest is not None:
+                manifest.update(path, stat, hash)
+
+            if progress is not None and current_file % 64 == 0:
+                progress.emit((current_file, 0, files_number,
+                              "Saving files", "Writing contacts"))
+            current_file += 1
+
+    for directory in set(os.path.dirname(path) for path in data.loc[list(hashes), "z-file"]):
+        _fsync_directory(directory or ".")
+
+    if progress is not None:
+        progress.emit((files_number, 0, files_number,
+                      "Saving files", "Writing contacts"))
+
+    if hashes:
+        # Don't modify the frame held by the caller
+        written = pd.Index(list(hashes))
+        data = data.copy()
+        if has_hash:
+            data.loc[written, "z-hash"] = pd.Series(hashes)
+        data.loc[written, "changed"] = False
+        for key, values in references.items():
+            if key in data.columns:
+                data.loc[list(values), key] = pd.Series(values)
+
+    return data, failures
+
+
+def iter_vcf_cards(path: str):
+    """
+    Lazily split a .vcf file holding any number of cards.
+    Nothing is kept in memory but the current card.
+    :return: generator of tuple(int, bytes): byte offset of the card in the file, and raw card
+    """
+    with open(path, "rb") as f:
+        offset = 0
+        start = None
+        lines = []
+        depth = 0
+
+        for line in f:
+            tag = line.strip().upper()
+
+            if tag == b"BEGIN:VCARD":
+                if depth == 0:
+                    start = offset
+                    lines = []
+                depth += 1
+
+            if start is not None:
+                lines.append(line)
+
+            # Nested cards (AGENT) stay inside their parent
+            if tag == b"END:VCARD" and start is not None:
+                depth -= 1
+                if depth == 0:
+                    yield start, b"".join(lines)
+                    start = None
+                    lines = []
+
+            offset += len(line)
+
+
+def stream_vcf_file(path: str, batch_size=1000, start_index=0, backend=DEFAULT_BACKEND, progress=None, killswitch=None):
+    """
+    Parse a .vcf file holding any number of cards, typically a bulk export,
+    and yield the contacts as DataFrames of at most batch_size rows.
+    Each row references its file in "z-file" and its byte offset in "z-offset".
+    :param start_index: index of the first row, following rows are numbered consecutively
+    :param backend: parser backend, one of `PARSER_BACKENDS`
+    :param progress: Qt Worker Signal to emit progress info
+    :param killswitch: Thread-safe boolean stopping the process if == True
+    """
+    file_size = os.path.getsize(path)
+    contacts = []
+    index = start_index
+
+    for offset, card in iter_vcf_cards(path):
+        # Abort and update the progress bar on killswitch
+        if killswitch is not None and killswitch.is_set():
+            if progress is not None:
+                progress.emit((offset, 0, offset, "cancel", "Importing file"))
+            break
+
+        # Each card gets parsed on its own and dropped once flattened in the batch
+        parsed = parse_vcf(card.decode("utf-8", errors="replace"), path, hash_buffer(card), backend, offset)
+        parsed["z-offset"] = offset
+        contacts.append(parsed)
+
+        # Update the progress bar if any
+        if progress is not None:
+            progress.emit((offset + len(card), 0, file_size,
+                          "Parsing card %i" % (index + len(contacts)), "Importing file"))
+
+        if len(contacts) == batch_size:
+            yield pd.DataFrame(contacts, index=pd.RangeIndex(index, index + len(contacts)))
+            index += len(contacts)
+            contacts = []
+
+    if contacts:
+        yield pd.DataFrame(contacts, index=pd.RangeIndex(index, index + len(contacts)))
+
+
+def import_vcf_file(path: str, data=None, batch_size=1000, backend=DEFAULT_BACKEND, progress=None, killswitch=None):
+    """
+    Thread-safe import of all the cards of a .vcf file into an address book.
+
+    Streaming bounds the memory of the parsing to one batch of cards, not the memory of the result:
+    the peak is the address book with all the imported cards, plus about 10 % while the batches
+    are concatenated, since they share their strings with the result and only their arrays of cells are copied.
+    :param data: address book to append the cards to. Cards previously imported from
+    the same file are replaced.
+    :param batch_size: number of cards parsed before appending them to the address book
+    :param backend: parser backend, one of `PARSER_BACKENDS`
     :param progress: Qt Worker Signal to emit progress info
+    :param killswitch: Thread-safe boolean stopping the process if == True
+    """
+    batches = []
+
+    if data is not None and len(data.index) > 0:
+        if "z-offset" in data.columns:
+            data = data[~((data["z-file"] == path) & _imported_rows(data))]
+        batches.append(data)
+        start_index = data.index.max() + 1 if len(data.index) > 0 else 0
+    else:
+        start_index = 0
+
+    for batch in stream_vcf_file(path, batch_size, start_index, backend, progress, killswitch):
+        batches.append(batch)
+
+    if progress is not None:
+        file_size = os.path.getsize(path)
+        progress.emit((file_size, 0, file_size, "Parsing cards", "Importing file"))
+
+    if not batches:
+        return pd.DataFrame()
+
+    # Append all batches at once, concatenating them one by one is quadratic
+    # and would not lower the peak memory, reached by the last concatenation anyway
+    return pd.concat(batches, axis=0)
+
+
+# Precompiled patterns cleaning the stringified vobject content lines of older address books
+# Tags with nested types : <adr{'TYPE': ['HOME']} value>, -> {'TYPE': ['HOME']} value;
+VOBJECT_TAG = re.compile(r"\<[\w\-]+(\{[^\}]*\})([^\>]+)\>\,?")
+# Leading empty elements separated by comas, then multiple spaces
+VOBJECT_SPACES = re.compile(r"^\s*,\s*[^\S]*|[ ]{2,}")
+
+
+def is_vobject_repr(column: pd.Series) -> bool:
     """
+    Check if a column holds the stringified vobject content lines ("[<FN{}name>]")
+    produced by older versions, instead of typed values.
+    """
+    if column.name is not None and (str(column.name).startswith("z-") or column.name == "changed"):
+        return False
+    if not (column.dtype == object or pd.api.types.is_string_dtype(column.dtype)):
+        return False
+    return bool(column.str.startswith("[<", na=False).any())
+
+
+def clean_vobject_repr(column: pd.Series) -> pd.Series:
+    """
+    Make the stringified vobject content lines of a column readable:
+    [<adr{'TYPE': ['HOME']}value>] -> {'TYPE': ['HOME']}value;
+    Empty cells are skipped.
+    """
+    mask = column.str.len() > 0
+    values = column[mask]
+
+    # 1. Remove outer brackets : [<fn{} name>] -> <fn{} name>
+    brackets = values.str.startswith("[") & values.str.endswith("]")
+    values = values.where(~brackets, values.str.slice(1, -1))
+    # 2. Tags with nested types : <adr{'TYPE': ['HOME']} value> -> {'TYPE': ['HOME']} value;
+    values = values.str.replace(VOBJECT_TAG, r"\1\2;", regex=True)
+    # 3. Remove leading empty elements separated by comas and multiple spaces
+    values = values.str.replace(VOBJECT_SPACES, " ", regex=True)
+
+    column = column.copy()
+    column[mask] = values
+    return column
+
+
+def is_legacy_frame(data: pd.DataFrame) -> bool:
+    """Check if an address book was built by older versions, from stringified vobject content lines"""
+    return any(is_vobject_repr(data[col]) for col in ("fn", "n", "email", "tel", "adr") if col in data.columns)
+
+
+def explode_property(data: pd.DataFrame, name: str) -> pd.DataFrame:
+    """
+    Explode a multi-valued property stored as lists, like "email" or "tel",
+    into a child table with one row per value, indexed by the contact index.
+    The TYPE parameters are stored as categories.
+    """
+    if name not in data.columns:
+        return pd.DataFrame(columns=[name, "type"])
+
+    types = data[name + "-type"] if name + "-type" in data.columns else None
+    index = []
+    values = []
+    value_types = []
+
+    for row, row_values in data[name].dropna().items():
+        row_types = types[row] if types is not None and isinstance(types[row], list) else []
+        for i, value in enumerate(row_values):
+            index.append(row)
+            values.append(value)
+            value_types.append(row_types[i] if i < len(row_types) else None)
+
+    return pd.DataFrame({name: values, "type": pd.Categorical(value_types)}, index=pd.Index(index))
+
 
-    # Force string type
-    data = data.astype(str)
+def cleanup_contact(data: pd.DataFrame, progress=None, killswitch=None, workers=1):
+    """
+    Thread-safe address book building
+    :param progress: Qt Worker Signal to emit progress info
+    :param workers: number of processes cleaning columns in parallel, for address books
+    from older versions. None uses all the CPU cores.
+    """
 
     # Backup the file names as-is
     files = data["z-file"]
@@ -208,27 +814,35 @@ def cleanup_contact(data: pd.DataFrame, progress=None, killswitch=None):
     if progress is not None:
         progress.emit((0, 0, 3, "Formatting the database", "Prepare data"))
 
-    # Replace NaN by empty string to not pollute the view
-    data.replace(to_replace="nan", value="", inplace=True)
-
     # Cleanup fully empty columns
-    data.dropna(axis=1, how="all", inplace=True)
+    data = data.dropna(axis=1, how="all")
 
     if progress is not None:
         progress.emit((1, 0, 3, "Cleaning tags", "Prepare data"))
 
-    # Cleanup the Vcard tags
-    # 1. Remove outer brackets : [<fn{} name>] -> <fn{} name>
-    data.replace(to_replace="^\[([\s\S]*)\]$",
-                 value=r"\1", regex=True, inplace=True)
-    # 2. Tags with nested types : [<adr{'TYPE': ['HOME']} value>] -> HOME: value
-    data.replace(to_replace="\<[\w\-]+(\{[^\}]*\})([^\>]+)\>\,?",
-                 value=r"\1\2;", regex=True, inplace=True)
-    # 3. Remove multiple spaces
-    data.replace(to_replace="[ ]{2,}", value=" ", regex=True, inplace=True)
-    # 4. Remove leading empty elements separated by comas
-    data.replace(to_replace="^\s*,\s*[^\S]*",
-                 value=" ", regex=True, inplace=True)
+    # Books built by older versions stored the repr() of the vobject content lines.
+    # Make them readable. Typed columns are left as-is.
+    if is_legacy_frame(data):
+        # Everything was forced to string: replace the "nan" strings by real missing values
+        text_cols = [col for col in data.columns
+                     if data[col].dtype == object or pd.api.types.is_string_dtype(data[col].dtype)]
+        data[text_cols] = data[text_cols].mask(data[text_cols] == "nan")
+
+        # Only columns holding vCard tags need the regex passes
+        legacy_cols = [col for col in text_cols if is_vobject_repr(data[col])]
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        if workers > 1 and len(legacy_cols) > 1:
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+                cleaned = list(executor.map(clean_vobject_repr, [data[col] for col in legacy_cols]))
+        else:
+            cleaned = [clean_vobject_repr(data[col]) for col in legacy_cols]
+
+        for col, column in zip(legacy_cols, cleaned):
+            data[col] = column
 
     if progress is not None:
         progress.emit((2, 0, 3, "Sorting data", "Prepare data"))
@@ -239,8 +853,15 @@ def cleanup_contact(data: pd.DataFrame, progress=None, killswitch=None):
     # 3. fill the middle with the rest of default VCard fields
 
     original_cols = sorted(list(data.columns.tolist()))
+
+    # Address books from older versions have a single ADR column
+    if "adr" in original_cols:
+        address_cols = ["adr"]
+    else:
+        address_cols = ["adr-street", "adr-locality", "adr-region", "adr-postcode", "adr-country"]
+
     forced_cols_start = ["categories", "fn", "n",
-                         "org", "role", "email", "adr", "tel"]
+                         "org", "role", "email"] + address_cols + ["tel"]
 
     for elem in forced_cols_start:
         if elem in original_cols:
@@ -252,184 +873,386 @@ def cleanup_contact(data: pd.DataFrame, progress=None, killswitch=None):
     # Restore files
     data["z-file"] = files
 
+    data = compact_columns(data)
+
     if progress is not None:
         progress.emit((3, 0, 3, "Sorted", "Prepare data"))
 
     return data
 
 
-def get_geoID(data: pd.DataFrame, progress=None, killswitch=None):
+# Flag columns and their value for missing cells
+FLAG_COLUMNS = {"changed": False, "z-geoupdate": True}
+
+# Text columns set by the applications writing the cards, with few distinct values, stored as categories.
+# Other columns are written by the edits, the sync or the geocoding, and categories only accept known values.
+CATEGORY_COLUMNS = {"version", "prodid", "kind"}
+
+# Columns having less distinct values than this share of the contacts are stored as categories
+CATEGORY_RATIO = 0.5
+
+
+def compact_columns(data: pd.DataFrame) -> pd.DataFrame:
     """
-    Thread-safe address book building
-    :param progress: Qt Worker Signal to emit progress info
+    Shrink the memory used by the address book:
+    - flags are booleans,
+    - the `CATEGORY_COLUMNS` with few distinct values, like VERSION or KIND, are categories:
+      each cell is a 1 or 2 bytes code, missing cells included,
+    - the TYPE parameters and categories held in lists share the same string objects.
+    Missing cells stay real missing values. Other columns stored as categories,
+    by older versions, are turned back to text.
     """
+    data = data.copy(deep=False)
 
-    entries = len(data.index)
+    for col, missing in FLAG_COLUMNS.items():
+        if col in data.columns and data[col].dtype != bool:
+            data[col] = data[col].fillna(missing).astype(bool)
 
-    if progress is not None:
-        progress.emit(
-            (0, 0, entries, "Downloading GPS coordinates from nominatim.org…", "Fetch geolocation data"))
+    for col in data.columns:
+        column = data[col]
+        if col in FLAG_COLUMNS:
+            continue
 
-    # Try to see if https://nominatim.openstreetmap.org/search is available
-    # If not, the DB will be unavailable
-    try:
-        response = requests.get('https://nominatim.openstreetmap.org/search')
-    except:
-        if progress is not None:
-            progress.emit(
-                (0, 0, entries, "nominatim.org can't be reached, geolocation will use the local cache if possible", "Fetch geolocation data"))
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            if col not in CATEGORY_COLUMNS:
+                data[col] = column.astype(object)
+            continue
 
-    # Get the OSM area ID
-    # This can be slow and long since we need to download info from the Nominatim DB
-    # However, results are cached, so the next time will run faster
-    # To be able to re-use the cache, we actually need to process that single-threaded and sequentially.
-    # Also, it wouldn't be nice to DoS the free OSM servers with too many requests per second.
-    # See conditions of service use : https://operations.osmfoundation.org/policies/nominatim/
-    nominatim = Nominatim()
+        if column.dtype == object and pd.api.types.infer_dtype(column, skipna=True) != "string":
+            # Lists: intern the repeated labels
+            if col.endswith("-type") or col == "categories":
+                data[col] = column.map(lambda value: [sys.intern(elem) if isinstance(elem, str) else elem
+                                                      for elem in value] if isinstance(value, list) else value)
+            continue
 
-    # Quick way for reference:
-    # Since it's not purely data processing in here, there is no point doing that
-    #data['geoID'] = data.apply(lambda row : nominatim.query(re.sub(r"\[[A-Z]+:?\s?\n?([\s\S]*)\]", r"\1", row['adr'].replace("\n", ""))).toJSON(), axis = 1)
+        if col in CATEGORY_COLUMNS and (pd.api.types.is_string_dtype(column.dtype) or column.dtype == object) \
+                and column.nunique() < CATEGORY_RATIO * len(column.index):
+            data[col] = column.astype("category")
 
-    # Get a clean location hint
-    data['z-geohint'] = data['adr'].replace(
-        to_replace="\{[^\}]+\}", value="", regex=True)
+    return data
 
-    # Remove content into parenthesis because it's usually precisions and Nominatim will not be able to parse it
-    data['z-geohint'].replace(to_replace="(?:\(|\@ESCAPEDLEFTPARENTHESIS\@).*(?:\)|\@ESCAPEDRIGHTPARENTHESIS\@)",
-                              value=" ", regex=True, inplace=True)
 
-    # Replace dashes and special characters by spaces
-    data['z-geohint'].replace(to_replace="[\-\[\]\{\}]+",
-                              value=" ", regex=True, inplace=True)
-    data['z-geohint'].replace(to_replace="[\n\r]+",
-                              value=", ", regex=True, inplace=True)
+def memory_report(data: pd.DataFrame, compacted=None) -> pd.DataFrame:
+    """
+    Bytes used by each column of the address book, strings and lists included
+    :param compacted: optional compacted version of data, see `compact_columns`, to compare with
+    :return: DataFrame of the "dtype" and "bytes" of each column, and the same for compacted,
+    sorted by decreasing size. The "total" row sums all columns and the index.
+    """
+    def usage(frame):
+        bytes = frame.memory_usage(deep=True)
+        dtypes = frame.dtypes.astype(str)
+        dtypes["Index"] = str(frame.index.dtype)
+        return pd.DataFrame({"dtype": dtypes, "bytes": bytes})
 
-    # Factorize multiple spaces
-    data['z-geohint'].replace(to_replace="\s+", value=" ", regex=True)
+    report = usage(data)
+    if compacted is not None:
+        report = report.join(usage(compacted), how="outer", rsuffix=" compacted")
+
+    report = report.sort_values("bytes", ascending=False)
+    report.loc["total"] = report.sum(numeric_only=True)
+    return report
+
+
+def address_hint(box, extended, street, locality, region, postcode, country) -> str:
+    """
+    Write the addresses of a contact as text for geocoding, from the lists of ADR components.
+    Addresses are separated by ";", components by ",".
+    """
+    if not isinstance(street, list):
+        return ""
+
+    addresses = []
+    for i in range(len(street)):
+        parts = [_component(extended, i), _component(street, i), _component(locality, i),
+                 (_component(region, i) + " " + _component(postcode, i)).strip(), _component(country, i)]
+        address = ", ".join(part for part in parts if part)
+        if address:
+            addresses.append(address)
 
+    return ";".join(addresses)
+
+
+def _component(values, i: int) -> str:
+    if isinstance(values, list) and i < len(values) and isinstance(values[i], str):
+        # Multi-line street addresses
+        return values[i].replace("\n", ", ").strip()
+    return ""
+
+
+# Stop geolocating after the server failed for this many addresses in a row, retries included
+MAX_GEOCODING_FAILURES = 3
+
+# Regex passes cleaning the address texts before geocoding, in order
+GEOHINT_PASSES = [
+    # Remove content into parenthesis because it's usually precisions and Nominatim will not be able to parse it
+    (r"(?:\(|\@ESCAPEDLEFTPARENTHESIS\@).*(?:\)|\@ESCAPEDRIGHTPARENTHESIS\@)", " "),
+    # Replace dashes and special characters by spaces
+    (r"[\-\[\]\{\}]+", " "),
+    (r"[\n\r]+", ", "),
     # Remove leading empty elements separated by comas
-    data['z-geohint'].replace(to_replace="^\s*,\s*[^\S]",
-                              value="", regex=True, inplace=True)
+    (r"^\s*,\s*[^\S]", ""),
+    # Factorize multiple spaces
+    (r"\s+", " "),
+]
 
-    # Finally, apply some spell checking
-    GeoSpellCheck = GeoSpellChecker(["fr", "en"])
+# Addresses normalized from the address texts, by hash of the text,
+# so the unchanged contacts are not normalized again on the next runs
+geohints = dict()
+GEOHINTS_SIZE = 65536
 
-    # Ensure index matches the number of rows, otherwise iterating over rows may not produce the expected result
-    data.reset_index(drop=True, inplace=True)
 
-    # Go the slow way to be able to output the progress
-    for index, row in data.iterrows():
-        if progress is not None:
-            progress.emit(
-                (index, 0, entries, "Downloading GPS coordinates from nominatim.org…", "Fetch geolocation data"))
+def _geocoding_addresses(hint: str) -> tuple:
+    """Split a cleaned address text into the addresses to query"""
+    # Decode Unicode
+    decoded = unidecode.unidecode(hint, errors="ignore")
 
-        # Abort and update the progress bar on killswitch
-        if killswitch is not None and killswitch.is_set():
-            if progress is not None:
-                progress.emit((index, 0, index, "cancel",
-                              "Fetch geolocation data"))
-            break
+    # Remove illegal characters left-over from bad encodings
+    decoded = decoded.replace("\"", "")
+    decoded = decoded.replace("(c)", "")
+    decoded = decoded.replace("@", "")
+
+    # We may have more than one address per contact (home, office, etc.)
+    addresses = []
+    for elem in decoded.split(";"):
+        elem = elem.strip(" \n\r.;,:").lower()
+
+        # Factorize multiple or orphaned commas
+        elem = re.sub(r"(\s?\,)+", ",", elem)
+
+        if elem:
+            addresses.append(elem)
+
+    return tuple(addresses)
+
+
+def normalize_hints(hints: pd.Series) -> pd.Series:
+    """
+    Clean the address texts of the contacts for geocoding, each distinct text once.
+    :param hints: address texts, like written by `address_hint`
+    :return: tuples of the addresses of each contact, lower-cased and ASCII, in the same index
+    """
+    hints = hints.fillna("").astype(object)
+    unique = pd.Series(hints.unique(), dtype=object)
+    keys = [hash_buffer(hint.encode("utf-8")) for hint in unique]
+
+    if len(geohints) + len(keys) > GEOHINTS_SIZE:
+        geohints.clear()
+
+    missing = [i for i, key in enumerate(keys) if key not in geohints]
+    if missing:
+        cleaned = unique.iloc[missing]
+        for pattern, value in GEOHINT_PASSES:
+            cleaned = cleaned.str.replace(pattern, value, regex=True)
+        for i, text in zip(missing, cleaned):
+            geohints[keys[i]] = _geocoding_addresses(text)
+
+    return hints.map(dict(zip(unique, (geohints[key] for key in keys))))
+
+
+def contact_addresses(data: pd.DataFrame, rows) -> pd.Series:
+    """
+    :param rows: index of the contacts
+    :return: tuples of the normalized addresses of each contact, see `normalize_hints`
+    """
+    if "adr-street" in data.columns:
+        # One line per address of the contact, separated by ";"
+        columns = [data.loc[rows, col] if col in data.columns else pd.Series(None, index=rows)
+                   for col in vcard.ADDRESS_COLUMNS]
+        hints = pd.Series([address_hint(*components) for components in zip(*columns)], index=rows, dtype=object)
+    else:
+        # Address books from older versions have the stringified vobject ADR
+        hints = data.loc[rows, 'adr'].replace(to_replace=r"\{[^\}]+\}", value="", regex=True)
+
+    return normalize_hints(hints)
+
+
+def contact_location(found: list) -> tuple:
+    """
+    :param found: tuple(location, exact) of each address of a contact, as returned by `geocode_address`
+    :return: tuple(z-geoID, z-exactlocation)
+    """
+    result = [location for location, _ in found if location is not None]
+    return (json.dumps(result) if result else "not found"), any(flag for _, flag in found)
+
+
+def _geocoding_query(**params) -> str:
+    query = urlencode(dict(params, format="json"))
+    return re.sub(r"[\+]+", "+", query).strip("+")
+
+
+def geocode_address(nominatim: Nominatim, spellcheck: GeoSpellChecker, address: str) -> tuple:
+    """
+    Find the location of an address, trying less and less precise variants of it until one is found.
+    The outcome is cached, so the variants are not tried again until it expires.
+    :return: tuple(location, exact) with the first Nominatim result or None, and whether the full address was found
+    :raise GeocodingError: if the server failed to answer. Nothing is cached then.
+    """
+    outcome = nominatim.cache.get_outcome(address)
+    if outcome is not None:
+        return outcome
+
+    location, exact = _geocode_cascade(nominatim, spellcheck, address)
+    nominatim.cache.put_outcome(address, location, exact)
+    return location, exact
+
+
+def _geocode_cascade(nominatim: Nominatim, spellcheck: GeoSpellChecker, address: str) -> tuple:
+    try:
+        # We found an exact match
+        return nominatim.fetch_cache_or_web(_geocoding_query(q=address))[0], True
+    except IndexError:
+        pass
+
+    # Third guess: try to remove the country name and replace it by the ISO code
+    # Nominatim fails if the country name is not in the same language as the rest
+    # of the address,
+    # Note: It's not accurate.
+    # Ex 1: US State "Georgia" may get identified as the country.
+    # Ex 2: If the streetname is a country, the address may also fall in the wrong country
+    (country_code, filtered) = spellcheck.get_country_code_from_text(address)
+
+    try:
+        return nominatim.fetch_cache_or_web(_geocoding_query(q=filtered, countrycodes=country_code))[0], False
+    except IndexError:
+        pass
+
+    # Sometimes, the query fails for being too specific
+    # In that case, we retry all combinations of the n last elements
+    sub_elems = filtered.split(",")
+    for i in range(0, len(sub_elems) - 1, 1):
+        q = sub_elems[-1].strip()
+        # Build sub-query with the n-th last elements
+        # n = length - i > 1
+        for j in range(2, len(sub_elems) - i, +1):
+            q = sub_elems[-j].strip() + "," + q
+
+        try:
+            return nominatim.fetch_cache_or_web(_geocoding_query(q=q, countrycodes=country_code))[0], False
+        except IndexError:
+            continue
+
+    try:
+        # Try with just the first element
+        return nominatim.fetch_cache_or_web(_geocoding_query(q=sub_elems[0].strip(), countrycodes=country_code))[0], False
+    except IndexError:
+        # Just using one element is simply too risky
+        # Abort here
+        print(address, "not found")
+        return None, False
 
-        # If geolocation has already been found
-        if "z-geoupdate" in data.columns:
-            if data.loc[index, "z-geoupdate"] == "False":
+
+def resolve_addresses(nominatim: Nominatim, spellcheck: GeoSpellChecker, addresses: list,
+                      progress=None, killswitch=None) -> dict:
+    """
+    Geocode distinct addresses, as many at once as the backend of nominatim accepts
+    :return: dict of address -> tuple(location, exact), without the addresses the server failed to answer for
+    """
+    title = "Fetch geolocation data"
+
+    # address -> tuple(location, exact)
+    locations = dict()
+
+    # Consecutive addresses the server failed to answer for
+    failures = 0
+
+    with ThreadPoolExecutor(max_workers=nominatim.concurrency) as executor:
+        futures = {executor.submit(geocode_address, nominatim, spellcheck, address): address
+                   for address in addresses}
+
+        for i, future in enumerate(as_completed(futures)):
+            if progress is not None:
+                progress.emit((i, 0, len(addresses), "Downloading GPS coordinates…", title))
+
+            # Abort and update the progress bar on killswitch
+            if killswitch is not None and killswitch.is_set():
+                executor.shutdown(wait=False, cancel_futures=True)
+                if progress is not None:
+                    progress.emit((i, 0, i, "cancel", title))
+                break
+
+            try:
+                locations[futures[future]] = future.result()
+            except GeocodingError as error:
+                # The server failed, not the address: leave its contacts to the next run
+                print(error)
+                failures += 1
+                if failures >= MAX_GEOCODING_FAILURES:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    if progress is not None:
+                        progress.emit((i, 0, i, "The geocoding server can't be reached, try again later", title))
+                    break
                 continue
 
-        result = []
-
-        # Decode Unicode
-        decoded = unidecode.unidecode(row['z-geohint'], errors="ignore")
-
-        # Remove illegal characters left-over from bad encodings
-        decoded = decoded.replace("\"", "")
-        decoded = decoded.replace("(c)", "")
-        decoded = decoded.replace("@", "")
-
-        # We may have more than one address per contact (home, office, etc.)
-        split = decoded.split(";")
-
-        flag_accurate = False
-
-        for elem in split:
-            elem = elem.strip(" \n\r.;,:").lower()
-
-            # Factorize multiple or orphaned commas
-            elem = re.sub(r"(\s?\,)+", ",", elem)
-
-            if len(str(elem)) != 0:
-                try:
-                    query = urlencode({'q': elem,
-                                       'format': 'json'})
-                    query = re.sub(r"[\+]+", "+", query).strip("+")
-                    out = nominatim.fetch_cache_or_web(query)[0]
-                    result.append(out)
-
-                    # We found an exact match
-                    flag_accurate = True
-                except:
-                    # Third guess: try to remove the country name and replace it by the ISO code
-                    # Nominatim fails if the country name is not in the same language as the rest
-                    # of the address,
-                    # Note: It's not accurate.
-                    # Ex 1: US State "Georgia" may get identified as the country.
-                    # Ex 2: If the streetname is a country, the address may also fall in the wrong country
-                    (country_code, filtered) = GeoSpellCheck.get_country_code_from_text(
-                        elem)
-
-                    try:
-                        query = urlencode({'q': filtered,
-                                           'countrycodes': country_code,
-                                           'format': 'json'})
-                        query = re.sub(r"[\+]+", "+", query).strip("+")
-                        out = nominatim.fetch_cache_or_web(query)[0]
-                        result.append(out)
-                    except:
-                        # Sometimes, the query fails for being too specific
-                        # In that case, we retry all combinations of the n last elements
-                        sub_elems = filtered.split(",")
-                        found = False
-                        for i in range(0, len(sub_elems) - 1, 1):
-                            q = sub_elems[-1].strip()
-                            # Build sub-query with the n-th last elements
-                            # n = length - i > 1
-                            for j in range(2, len(sub_elems) - i, +1):
-                                q = sub_elems[-j].strip() + "," + q
-
-                            try:
-                                query = urlencode({'q': q,
-                                                   'countrycodes': country_code,
-                                                   'format': 'json'})
-                                query = re.sub(r"[\+]+", "+", query).strip("+")
-                                out = nominatim.fetch_cache_or_web(query)[0]
-                                result.append(out)
-                                found = True
-                                break
-                            except:
-                                continue
-
-                        if not found:
-                            try:
-                                # Try with just the first and last element
-                                query = urlencode({'q': sub_elems[0].strip(),
-                                                   'countrycodes': country_code,
-                                                   'format': 'json'})
-                                query = re.sub(r"[\+]+", "+", query).strip("+")
-                                out = nominatim.fetch_cache_or_web(query)[0]
-                                result.append(out)
-                            except:
-                                # Just using one element is simply too risky
-                                # Abort here
-                                print(elem, "not found")
-        if result:
-            data.loc[index, "z-geoID"] = json.dumps(result)
-        else:
-            data.loc[index, "z-geoID"] = "not found"
-        data.loc[index, "z-exactlocation"] = flag_accurate
-        data.loc[index, "z-geoupdate"] = False
+            failures = 0
+
+    return locations
+
+
+def get_geoID(data: pd.DataFrame, progress=None, killswitch=None, nominatim=None):
+    """
+    Thread-safe geolocation of the contacts to update, in stages:
+    normalize their addresses, resolve each distinct address once, then join the locations back to the contacts.
+    Contacts sharing an address cost a single lookup.
+    :param progress: Qt Worker Signal to emit progress info
+    :param killswitch: Thread-safe boolean stopping the process if == True
+    :param nominatim: `Nominatim` client, defaults to the public server with the cache of the preferences
+    """
+
+    title = "Fetch geolocation data"
+
+    # Contacts never located, or whose address changed since
+    if "z-geoupdate" in data.columns:
+        rows = data.index[~data["z-geoupdate"].isin([False, "False"]).to_numpy(dtype=bool)]
+    else:
+        rows = data.index
+
+    if progress is not None:
+        progress.emit((0, 0, len(rows), "Preparing the addresses of %i contacts…" % len(rows), title))
+
+    # Stage 1: get clean location hints
+    addresses = contact_addresses(data, rows)
+
+    # Columns of the results, with their value for the contacts not located yet
+    for col, default in (("z-geohint", ""), ("z-geoID", None), ("z-exactlocation", False), ("z-geoupdate", True)):
+        if col not in data.columns:
+            data[col] = default
+
+    if len(rows):
+        data.loc[rows, "z-geohint"] = [";".join(elems) for elems in addresses]
+
+    # Stage 2: collapse them to the distinct addresses, in order of appearance
+    queries = list(dict.fromkeys(address for elems in addresses for address in elems))
+
+    # Stage 3: resolve each address once
+    # This can be slow and long since we need to download info from the Nominatim DB
+    # However, results are cached, so the next time will run faster.
+    # Also, it wouldn't be nice to DoS the free OSM servers with too many requests per second:
+    # the public backend sends one request at a time, spaced by one second.
+    # See conditions of service use : https://operations.osmfoundation.org/policies/nominatim/
+    if nominatim is None:
+        nominatim = Nominatim()
+    locations = resolve_addresses(nominatim, GeoSpellChecker(["fr", "en"]), queries, progress, killswitch)
+
+    # Stage 4: join the locations back to the contacts whose addresses are all resolved
+    resolved = []
+    geoIDs = []
+    exact = []
+    for row, elems in addresses.items():
+        if not all(address in locations for address in elems):
+            continue
+
+        geoID, flag = contact_location([locations[address] for address in elems])
+        resolved.append(row)
+        geoIDs.append(geoID)
+        exact.append(flag)
+
+    if resolved:
+        data.loc[resolved, "z-geoID"] = geoIDs
+        data.loc[resolved, "z-exactlocation"] = exact
+        data.loc[resolved, "z-geoupdate"] = False
 
     if progress is not None:
-        progress.emit((index, entries, entries, "cancel",
-                      "Fetch geolocation data"))
+        progress.emit((len(queries), len(queries), len(queries), "cancel", title))
 
     return data
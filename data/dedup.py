@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+# Duplicate contacts detection.
+#
+# Comparing all pairs of contacts is O(N²). Instead, only pairs of candidates are compared:
+# - contacts sharing an email, a phone number or the phonetic key of their name (blocking),
+# - contacts whose name, organization and address are similar, found by MinHash LSH.
+# Candidate pairs are then scored at once with numpy, and linked into groups.
+
+import re
+
+import numpy as np
+import pandas as pd
+
+from data import vcard
+from data.text import column_text, normalize_series
+from data.lookup import normalize_email, normalize_phone
+
+# Number of MinHash permutations, split in LSH bands of rows.
+# Pairs of Jaccard similarity s become candidates with probability 1 - (1 - s^ROWS)^BANDS,
+# which is 50 % around s = 0.7
+PERMUTATIONS = 48
+BANDS = 8
+ROWS = PERMUTATIONS // BANDS
+
+# Blocks or LSH buckets larger than this are too common to mean anything (empty name, company switchboard…)
+MAX_BLOCK = 50
+
+# Confidence brought by each evidence of duplication
+EMAIL_CONFIDENCE = 0.9
+PHONE_CONFIDENCE = 0.8
+NAME_CONFIDENCE = 0.3
+
+WORD = re.compile(r"[a-z0-9]+")
+
+# Soundex codes of letters: vowels separate repeated codes, h and w don't
+SOUNDEX = str.maketrans("aeiouybfpvcgjkqsxzdtlmnr", "000000111122222222334556", "hw")
+
+
+def soundex(word: str) -> str:
+  """American Soundex code of an ASCII lower-case word"""
+  if not word:
+    return ""
+
+  code = word[0]
+  previous = word[0].translate(SOUNDEX)
+  for digit in word[1:].translate(SOUNDEX):
+    if digit != previous and digit != "0":
+      code += digit
+    previous = digit
+
+  return (code + "000")[:4]
+
+
+def phonetic_key(name: str) -> str:
+  """
+  Soundex of the words of a name, sorted so "Doe John" and "John Doe" get the same key
+  :param name: name normalized by `text.normalize()`
+  """
+  return " ".join(sorted(soundex(word) for word in WORD.findall(name) if len(word) > 1 and word.isalpha()))
+
+
+def _values(value) -> list:
+  if isinstance(value, list):
+    return value
+  if isinstance(value, str) and value:
+    return value.split(",")
+  return []
+
+
+def _name(data: pd.DataFrame) -> pd.Series:
+  """Normalized name of the contacts"""
+  name = data["fn"] if "fn" in data.columns else pd.Series("", index=data.index)
+  if "n" in data.columns:
+    name = name.where(name.notna() & (name != ""), data["n"])
+  return normalize_series(name.fillna("").astype(object))
+
+
+def _profile(data: pd.DataFrame, names: pd.Series) -> pd.Series:
+  """
+  Normalized name, organization and address of each contact, for the fuzzy similarity
+  :param names: normalized names
+  """
+  # Normalize columns separately: their values repeat, unlike whole profiles
+  columns = [normalize_series(column_text(data[col]).astype(object))
+             for col in ("org",) + vcard.ADDRESS_COLUMNS[2:] + ("adr", ) if col in data.columns]
+  text = names.str.cat(columns, sep=" ") if columns else names
+  return text.str.replace(r"[^a-z0-9]+", " ", regex=True).str.strip()
+
+
+def _block_pairs(keys: pd.Series) -> np.ndarray:
+  """
+  Pairs of positions of the rows sharing a key.
+  :param keys: Series of keys indexed by row position, one line per key of each row
+  """
+  keys = keys[keys != ""]
+  return _sorted_pairs(_pairs_in_groups(keys))
+
+
+def _pairs_in_groups(keys: pd.Series) -> np.ndarray:
+  """All the pairs of index values sharing a key, in groups of at most MAX_BLOCK"""
+  rows = keys.index.to_numpy()
+  codes = pd.factorize(keys.to_numpy())[0]
+
+  # Sort by key to find the runs of equal keys
+  order = np.argsort(codes, kind="stable")
+  bounds = np.flatnonzero(np.diff(codes[order])) + 1
+  starts = np.concatenate([[0], bounds])
+  ends = np.concatenate([bounds, [len(codes)]])
+  sizes = ends - starts
+  selected = (sizes > 1) & (sizes <= MAX_BLOCK)
+
+  # Most groups are pairs already
+  couples = selected & (sizes == 2)
+  pairs = [np.stack([rows[order[starts[couples]]], rows[order[starts[couples] + 1]]], axis=1)]
+
+  for start, end in zip(starts[selected & ~couples], ends[selected & ~couples]):
+    members = rows[order[start:end]]
+    first, second = np.triu_indices(len(members), k=1)
+    pairs.append(np.stack([members[first], members[second]], axis=1))
+
+  return np.concatenate(pairs).astype(np.int64)
+
+
+def _sorted_pairs(pairs: np.ndarray) -> np.ndarray:
+  """Unique pairs (a, b) with a < b"""
+  pairs = np.sort(pairs, axis=1)
+  pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+  if len(pairs) == 0:
+    return pairs
+
+  # Sort pairs as single integers
+  width = pairs.max() + 1
+  codes = np.unique(pairs[:, 0] * width + pairs[:, 1])
+  return np.stack([codes // width, codes % width], axis=1)
+
+
+def _exploded_keys(data: pd.DataFrame, col: str, normalize) -> pd.Series:
+  if col not in data.columns:
+    return pd.Series([], dtype=object)
+  values = data[col].reset_index(drop=True).map(_values).explode().dropna()
+  return values.map(lambda value: normalize(str(value)))
+
+
+def minhash(texts: pd.Series, seed=0) -> np.ndarray:
+  """
+  MinHash signatures of the sets of character 3-grams of ASCII texts
+  :return: array of shape (len(texts), PERMUTATIONS). Texts shorter than 3 characters
+  get the maximal value everywhere.
+  """
+  # Read all the texts as one buffer of bytes, and the 3-grams as 24 bits integers
+  buffer = np.frombuffer("".join(texts).encode("ascii", "replace"), dtype=np.uint8).astype(np.uint32)
+  lengths = texts.str.len().to_numpy(dtype=np.int64)
+  if len(buffer) >= 3:
+    grams = (buffer[:-2] << 16) | (buffer[1:-1] << 8) | buffer[2:]
+  else:
+    grams = np.zeros(0, dtype=np.uint32)
+
+  # Keep the 3-grams starting and ending in the same text
+  counts = np.maximum(lengths - 2, 0)
+  offsets = np.cumsum(lengths) - lengths
+  valid = np.repeat(offsets, counts) + (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts))
+  grams = grams[valid].astype(np.uint64)
+
+  # reduceat needs increasing starts within the 3-grams: reduce the texts having some only,
+  # each up to the start of the next one
+  filled = counts > 0
+  starts = (np.cumsum(counts) - counts)[filled]
+
+  rng = np.random.default_rng(seed)
+  a = rng.integers(0, np.iinfo(np.uint64).max, size=PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+  b = rng.integers(0, np.iinfo(np.uint64).max, size=PERMUTATIONS, dtype=np.uint64)
+
+  signatures = np.full((len(texts), PERMUTATIONS), np.iinfo(np.uint64).max, dtype=np.uint64)
+  if len(grams) == 0:
+    return signatures
+
+  for k in range(PERMUTATIONS):
+    # Multiply-shift hashing: overflowing is part of it
+    signatures[filled, k] = np.minimum.reduceat((a[k] * grams + b[k]) >> np.uint64(32), starts)
+
+  return signatures
+
+
+def _lsh_pairs(signatures: np.ndarray) -> np.ndarray:
+  valid = signatures[:, 0] != np.iinfo(np.uint64).max
+  pairs = []
+
+  for band in range(BANDS):
+    # Combine the rows of the band into a single key (FNV-like)
+    keys = np.zeros(len(signatures), dtype=np.uint64)
+    for column in signatures[:, band * ROWS:(band + 1) * ROWS].T:
+      keys = (keys * np.uint64(0x100000001b3)) ^ column
+    pairs.append(_pairs_in_groups(pd.Series(keys)[valid]))
+
+  return _sorted_pairs(np.concatenate(pairs))
+
+
+def _contains(pairs: np.ndarray, subset: np.ndarray) -> np.ndarray:
+  """Boolean mask of the pairs found in subset"""
+  if len(subset) == 0 or len(pairs) == 0:
+    return np.zeros(len(pairs), dtype=bool)
+  width = max(pairs.max(), subset.max()) + 1
+  return np.isin(pairs[:, 0] * width + pairs[:, 1], subset[:, 0] * width + subset[:, 1])
+
+
+def find_duplicate_pairs(data: pd.DataFrame, region=None, progress=None, killswitch=None) -> pd.DataFrame:
+  """
+  Find the pairs of rows likely to be the same contact
+  :param region: ISO code of the country of national phone numbers, like "FR"
+  :return: DataFrame of the candidate pairs, with columns "row_a" and "row_b" (index of the rows),
+  "email", "phone", "name" (bool, whether they share one), "similarity" (estimated Jaccard similarity
+  of their names, organizations and addresses) and "confidence" (0 to 1).
+  """
+  steps = 5
+  if progress is not None:
+    progress.emit((0, 0, steps, "Blocking on emails and phones", "Finding duplicates"))
+
+  emails = _block_pairs(_exploded_keys(data, "email", normalize_email))
+  phones = _block_pairs(_exploded_keys(data, "tel", lambda number: normalize_phone(number, region)))
+
+  if progress is not None:
+    progress.emit((1, 0, steps, "Blocking on names", "Finding duplicates"))
+
+  names = _name(data)
+  keys = names.reset_index(drop=True)
+  name_pairs = _block_pairs(keys.map({name: phonetic_key(name) for name in keys.unique()}))
+
+  if killswitch is not None and killswitch.is_set():
+    return pd.DataFrame(columns=["row_a", "row_b", "email", "phone", "name", "similarity", "confidence"])
+
+  if progress is not None:
+    progress.emit((2, 0, steps, "Hashing names, organizations and addresses", "Finding duplicates"))
+
+  signatures = minhash(_profile(data, names))
+
+  if progress is not None:
+    progress.emit((3, 0, steps, "Finding similar contacts", "Finding duplicates"))
+
+  similar = _lsh_pairs(signatures)
+  pairs = _sorted_pairs(np.concatenate([emails, phones, name_pairs, similar]))
+
+  if progress is not None:
+    progress.emit((4, 0, steps, "Scoring candidates", "Finding duplicates"))
+
+  # Score all candidates at once
+  similarity = (signatures[pairs[:, 0]] == signatures[pairs[:, 1]]).mean(axis=1) if len(pairs) else np.zeros(0)
+  email = _contains(pairs, emails)
+  phone = _contains(pairs, phones)
+  name = _contains(pairs, name_pairs)
+
+  doubt = (1. - EMAIL_CONFIDENCE * email) * (1. - PHONE_CONFIDENCE * phone) * \
+          (1. - NAME_CONFIDENCE * name) * (1. - similarity)
+
+  result = pd.DataFrame({"row_a": data.index[pairs[:, 0]], "row_b": data.index[pairs[:, 1]],
+                         "email": email, "phone": phone, "name": name,
+                         "similarity": similarity, "confidence": 1. - doubt})
+
+  if progress is not None:
+    progress.emit((steps, 0, steps, "Scoring candidates", "Finding duplicates"))
+
+  return result.sort_values("confidence", ascending=False, ignore_index=True)
+
+
+def find_duplicates(data: pd.DataFrame, threshold=0.75, region=None, progress=None, killswitch=None) -> pd.DataFrame:
+  """
+  Group the rows likely to be the same contact.
+  Pairs of rows above the confidence threshold are linked, and linked rows form groups.
+  :param threshold: minimal confidence of the pairs, from 0 to 1
+  :param region: ISO code of the country of national phone numbers, like "FR"
+  :return: DataFrame indexed like data, holding only the duplicated rows, with columns "group"
+  (number of the group, groups sorted by decreasing confidence) and "confidence"
+  (the highest confidence of the pairs linking the row to its group).
+  """
+  pairs = find_duplicate_pairs(data, region=region, progress=progress, killswitch=killswitch)
+  pairs = pairs[pairs["confidence"] >= threshold]
+
+  # Union-find of the linked rows
+  parents = dict()
+
+  def find(row):
+    root = row
+    while parents.get(root, root) != root:
+      root = parents[root]
+    while row != root:
+      parents[row], row = root, parents.get(row, row)
+    return root
+
+  for a, b in zip(pairs["row_a"], pairs["row_b"]):
+    root_a, root_b = find(a), find(b)
+    if root_a != root_b:
+      parents[root_b] = root_a
+
+  confidence = pd.concat([pairs[["row_a", "confidence"]].rename(columns={"row_a": "row"}),
+                          pairs[["row_b", "confidence"]].rename(columns={"row_b": "row"})])
+  confidence = confidence.groupby("row")["confidence"].max()
+
+  groups = pd.DataFrame({"root": [find(row) for row in confidence.index], "confidence": confidence},
+                        index=confidence.index)
+
+  # Number the groups by decreasing confidence
+  order = groups.groupby("root")["confidence"].max().sort_values(ascending=False)
+  groups["group"] = groups["root"].map(pd.Series(range(len(order)), index=order.index))
+  groups.index.name = None
+
+  return groups.sort_values(["group", "confidence"], ascending=[True, False])[["group", "confidence"]]
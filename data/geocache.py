@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+# Persistent cache of the geocoding responses.
+# Usage: python -m data.geocache [stats|evict|clear] [path of the cache]
+
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlencode
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS geocache (
+  key TEXT PRIMARY KEY,
+  response TEXT NOT NULL,
+  created INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS outcomes (
+  key TEXT PRIMARY KEY,
+  location TEXT,
+  exact INTEGER NOT NULL,
+  expires INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+  name TEXT PRIMARY KEY,
+  value TEXT
+);
+"""
+
+# Columns added to the caches of previous versions
+COLUMNS = {
+  "expires": "INTEGER NOT NULL DEFAULT 0",
+  "accessed": "INTEGER NOT NULL DEFAULT 0",
+  "hits": "INTEGER NOT NULL DEFAULT 0",
+  "size": "INTEGER NOT NULL DEFAULT 0",
+}
+
+# Number of responses kept in memory in front of the database
+MEMORY_SIZE = 4096
+
+# Responses are refreshed after 60 days, and removed if not used for another TTL
+TTL = 60 * 24 * 3600
+
+# Empty responses, for addresses not found, are refreshed sooner since the map data improves
+NEGATIVE_TTL = 7 * 24 * 3600
+
+# Bounds of the cache, None for no bound
+MAX_ENTRIES = 200000
+MAX_BYTES = None
+
+# Eviction policies, removing the least recently used, or the least used
+POLICIES = ("lru", "lfu")
+
+# Access times and hit counts are written to the database by batches
+FLUSH_ACCESSES = 256
+
+COUNTERS = ("hits", "misses", "stale", "evictions", "expirations")
+
+SPACES = re.compile(r"\s+")
+# Files of the cache of older versions: <url-encoded query>_<UNIX time>
+LEGACY_FILE = re.compile(r"^(.+)_(\d+)$")
+
+
+def normalize_address(address: str) -> str:
+  return SPACES.sub(" ", address).strip().lower()
+
+
+def normalize_key(query: str) -> str:
+  """
+  Make the key of a URL-encoded query string: parameters sorted,
+  values lower-cased with spaces collapsed, so equivalent queries share their cache entry
+  """
+  params = sorted((name.lower(), SPACES.sub(" ", value).strip().lower())
+                  for name, value in parse_qsl(query, keep_blank_values=True))
+  return urlencode(params)
+
+
+class GeoCache():
+  """
+  Persistent cache of the geocoding responses, in a SQLite table indexed by the normalized query,
+  with the last used responses kept in memory.
+
+  Each entry expires after its TTL, or its negative TTL if the response is empty: it is still returned, but its query is listed by `stale_queries()`
+  to be fetched again in the background. Entries not used for a TTL after they expired are removed.
+  Beyond `max_entries` or `max_bytes`, the least recently ("lru") or least frequently ("lfu")
+  used entries are evicted.
+
+  The outcomes of the geocoding of whole addresses, through several queries, are cached
+  next to the responses until they expire, see `get_outcome()`.
+
+  Hits, misses, stale hits and evictions are counted in the database across sessions, see `stats()`.
+  """
+
+  def __init__(self, path=":memory:", memory_size=MEMORY_SIZE, ttl=TTL, negative_ttl=NEGATIVE_TTL,
+               max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, policy="lru"):
+    if policy not in POLICIES:
+      raise ValueError("Unknown eviction policy %s" % policy)
+
+    self.path = path
+    self.memory_size = memory_size
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.policy = policy
+
+    # key -> tuple(response, expires)
+    self._memory = OrderedDict()
+    # key -> tuple(last access, number of hits) not written yet
+    self._accesses = dict()
+    # key -> query of the stale entries used
+    self._stale = dict()
+    self._counters = dict.fromkeys(COUNTERS, 0)
+
+    self._lock = threading.Lock()
+    self._connection = sqlite3.connect(path, check_same_thread=False)
+    self._connection.execute("PRAGMA journal_mode=WAL")
+    self._connection.execute("PRAGMA synchronous=NORMAL")
+    self._connection.executescript(SCHEMA)
+
+    existing = {row[1] for row in self._connection.execute("PRAGMA table_info(geocache)")}
+    with self._connection:
+      for column, definition in COLUMNS.items():
+        if column not in existing:
+          self._connection.execute("ALTER TABLE geocache ADD COLUMN %s %s" % (column, definition))
+      if "expires" not in existing:
+        # Entries of previous versions expire from their creation time,
+        # but count as used now so they are refreshed before being removed
+        self._connection.execute("UPDATE geocache SET expires = created + ?, accessed = ?, "
+                                 "size = LENGTH(response)", (self.ttl, int(time.time())))
+      self._connection.execute("CREATE INDEX IF NOT EXISTS geocache_accessed ON geocache(accessed)")
+      self._connection.execute("CREATE INDEX IF NOT EXISTS geocache_expires ON geocache(expires)")
+
+  def close(self):
+    with self._lock:
+      self._flush()
+      self._connection.close()
+
+  def __len__(self):
+    with self._lock:
+      return self._connection.execute("SELECT COUNT(*) FROM geocache").fetchone()[0]
+
+  def _remember(self, key: str, response, expires: int):
+    self._memory[key] = (response, expires)
+    self._memory.move_to_end(key)
+    while len(self._memory) > self.memory_size:
+      self._memory.popitem(last=False)
+
+  def _access(self, key: str, now: int):
+    hits = self._accesses.get(key, (0, 0))[1]
+    self._accesses[key] = (now, hits + 1)
+    if len(self._accesses) >= FLUSH_ACCESSES:
+      self._flush()
+
+  def _flush(self):
+    # Write the access times, hit counts and counters gathered since the last flush
+    with self._connection:
+      self._connection.executemany("UPDATE geocache SET accessed = ?, hits = hits + ? WHERE key = ?",
+                                   [(accessed, hits, key) for key, (accessed, hits) in self._accesses.items()])
+      for name, value in self._counters.items():
+        if value:
+          self._connection.execute(
+            "INSERT INTO meta (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = CAST(value AS INTEGER) + excluded.value",
+            ("counter:" + name, value))
+    self._accesses.clear()
+    self._counters = dict.fromkeys(COUNTERS, 0)
+
+  def flush(self):
+    with self._lock:
+      self._flush()
+
+  def get(self, query: str):
+    """
+    :return: the cached response of the query, or None.
+    Expired responses are returned too, and their query queued for `stale_queries()`.
+    """
+    key = normalize_key(query)
+    now = int(time.time())
+
+    with self._lock:
+      if key in self._memory:
+        self._memory.move_to_end(key)
+        response, expires = self._memory[key]
+      else:
+        record = self._connection.execute("SELECT response, expires FROM geocache WHERE key = ?",
+                                          (key, )).fetchone()
+        if record is None:
+          self._counters["misses"] += 1
+          return None
+        response, expires = json.loads(record[0]), record[1]
+        self._remember(key, response, expires)
+
+      self._counters["hits"] += 1
+      if expires <= now:
+        self._counters["stale"] += 1
+        self._stale[key] = query
+      self._access(key, now)
+      return response
+
+  def put(self, query: str, response, created: int, ttl=None):
+    """
+    Cache the response of a query
+    :param created: UNIX time of the response
+    :param ttl: time to live of the response in seconds, defaults to the TTL of the cache,
+      or its negative TTL for empty responses
+    """
+    key = normalize_key(query)
+    text = json.dumps(response)
+    if ttl is None:
+      ttl = self.ttl if response else self.negative_ttl
+    expires = int(created + ttl)
+
+    with self._lock:
+      with self._connection:
+        self._connection.execute(
+          "INSERT OR REPLACE INTO geocache (key, response, created, expires, accessed, hits, size) "
+          "VALUES (?, ?, ?, ?, ?, COALESCE((SELECT hits FROM geocache WHERE key = ?), 0), ?)",
+          (key, text, int(created), expires, int(created), key, len(text)))
+      self._remember(key, response, expires)
+      self._stale.pop(key, None)
+
+  def get_outcome(self, address: str):
+    """
+    :return: tuple(location, exact) of the last geocoding of the address, location None if not found,
+    or None if the address was not geocoded or its outcome expired
+    """
+    with self._lock:
+      record = self._connection.execute("SELECT location, exact FROM outcomes WHERE key = ? AND expires > ?",
+                                        (normalize_address(address), int(time.time()))).fetchone()
+    if record is None:
+      return None
+    return (json.loads(record[0]) if record[0] is not None else None), bool(record[1])
+
+  def put_outcome(self, address: str, location, exact: bool, created=None):
+    """
+    Cache the outcome of the geocoding of an address, for the TTL of the cache,
+    or its negative TTL if the address was not found
+    :param location: the location found, or None
+    """
+    created = int(time.time()) if created is None else created
+    expires = created + (self.ttl if location is not None else self.negative_ttl)
+
+    with self._lock, self._connection:
+      self._connection.execute(
+        "INSERT OR REPLACE INTO outcomes (key, location, exact, expires) VALUES (?, ?, ?, ?)",
+        (normalize_address(address), json.dumps(location) if location is not None else None, int(exact), expires))
+
+  def stale_queries(self, limit=None) -> list:
+    """
+    Take the queries of the expired responses used since the cache was opened, to fetch them again.
+    :param limit: maximum number of queries taken, the others stay queued
+    """
+    with self._lock:
+      keys = list(self._stale)[:limit]
+      return [self._stale.pop(key) for key in keys]
+
+  def evict(self, now=None) -> int:
+    """
+    Remove the entries unused for a TTL since they expired,
+    then the least used ones beyond the bounds of the cache
+    :return: number of entries removed
+    """
+    now = int(time.time()) if now is None else now
+    order = "accessed ASC" if self.policy == "lru" else "hits ASC, accessed ASC"
+
+    with self._lock:
+      self._flush()
+      with self._connection:
+        expired = self._connection.execute(
+          "DELETE FROM geocache WHERE MAX(expires, accessed) + ? < ?", (self.ttl, now)).rowcount
+        # Expired outcomes are found again from the responses
+        self._connection.execute("DELETE FROM outcomes WHERE expires <= ?", (now, ))
+
+        evicted = 0
+        count, size = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM geocache").fetchone()
+
+        if self.max_entries is not None and count > self.max_entries:
+          evicted += self._connection.execute(
+            "DELETE FROM geocache WHERE key IN (SELECT key FROM geocache ORDER BY %s LIMIT ?)" % order,
+            (count - self.max_entries, )).rowcount
+          size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM geocache").fetchone()[0]
+
+        if self.max_bytes is not None and size > self.max_bytes:
+          # Find how many of the least used entries free enough bytes
+          excess = size - self.max_bytes
+          freed = 0
+          keys = []
+          for key, entry_size in self._connection.execute("SELECT key, size FROM geocache ORDER BY %s" % order):
+            keys.append((key, ))
+            freed += entry_size
+            if freed >= excess:
+              break
+          self._connection.executemany("DELETE FROM geocache WHERE key = ?", keys)
+          evicted += len(keys)
+
+      self._counters["expirations"] += expired
+      self._counters["evictions"] += evicted
+      self._flush()
+
+      # Forget the evicted entries kept in memory
+      self._memory.clear()
+
+    return expired + evicted
+
+  def stats(self) -> dict:
+    """:return: dict of the number of entries, their bytes, how many are expired, and the counters since creation"""
+    with self._lock:
+      self._flush()
+      count, size, expired = self._connection.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(expires <= ?), 0) FROM geocache",
+        (int(time.time()), )).fetchone()
+      outcomes = self._connection.execute("SELECT COUNT(*) FROM outcomes").fetchone()[0]
+      counters = dict(self._connection.execute("SELECT name, CAST(value AS INTEGER) FROM meta "
+                                               "WHERE name LIKE 'counter:%'"))
+
+    result = {"entries": count, "bytes": size, "expired entries": expired, "addresses": outcomes}
+    result.update({name: counters.get("counter:" + name, 0) for name in COUNTERS})
+    lookups = result["hits"] + result["misses"]
+    result["hit ratio"] = round(result["hits"] / lookups, 3) if lookups else 0.
+    return result
+
+  def clear(self):
+    with self._lock, self._connection:
+      self._connection.execute("DELETE FROM geocache")
+      self._connection.execute("DELETE FROM outcomes")
+      self._memory.clear()
+      self._accesses.clear()
+      self._stale.clear()
+
+  def migrate(self, directory: str) -> int:
+    """
+    Import once the cache of older versions, one JSON file per query named <query>_<UNIX time>.
+    The newest file of each query wins. The files are left in place.
+    :return: number of files imported
+    """
+    with self._lock:
+      if self._connection.execute("SELECT value FROM meta WHERE name = 'migrated'").fetchone() is not None:
+        return 0
+
+    records = []
+    if os.path.isdir(directory):
+      for file in os.listdir(directory):
+        match = LEGACY_FILE.match(file)
+        if match is None:
+          continue
+        try:
+          with open(os.path.join(directory, file), "r") as f:
+            response = json.loads(f.read())
+        except (OSError, ValueError):
+          continue
+        records.append((int(match.group(2)), normalize_key(match.group(1)), json.dumps(response)))
+
+    # Oldest first, so the newest replaces them.
+    # They count as used now, so the expired ones are refreshed before being removed.
+    records.sort()
+    now = int(time.time())
+    with self._lock, self._connection:
+      self._connection.executemany(
+        "INSERT OR REPLACE INTO geocache (key, response, created, expires, accessed, hits, size) "
+        "VALUES (?, ?, ?, ?, ?, 0, ?)",
+        [(key, response, created, created + self.ttl, now, len(response))
+         for created, key, response in records])
+      self._connection.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('migrated', ?)",
+                               (str(len(records)), ))
+
+    return len(records)
+
+
+if __name__ == "__main__":
+  command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+
+  if len(sys.argv) > 2:
+    path = sys.argv[2]
+  else:
+    from data import nominatim
+    path = nominatim.geocache_file
+
+  cache = GeoCache(path)
+  if command == "evict":
+    print("%i entries removed" % cache.evict())
+  elif command == "clear":
+    cache.clear()
+  elif command != "stats":
+    print("Usage: python -m data.geocache [stats|evict|clear] [path of the cache]")
+    sys.exit(1)
+
+  for name, value in cache.stats().items():
+    print("%s:\t%s" % (name, value))
+  cache.close()
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+# Backends answering the geocoding queries, and a local stand-in of a Nominatim server.
+# Usage: python -m data.geocoders serve [port] [JSON file of address -> results]
+
+import abc
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import urllib3
+from urllib3.util import Retry, Timeout
+
+PUBLIC_SERVER = "https://nominatim.openstreetmap.org/search?"
+HEADERS = {
+  "Accept": "application/json",
+  "User-Agent": "Open Contact book experimental"
+}
+
+# Seconds to connect and to read a response
+CONNECT_TIMEOUT = 5.
+READ_TIMEOUT = 20.
+
+# Retries of failed connections and of the responses with a status in RETRY_STATUS,
+# waiting BACKOFF * 2^(n - 1) s before the n-th retry, or longer if the server asks so in Retry-After.
+# Each retry also waits for its turn in the rate limit of the server, like any request.
+RETRIES = 4
+BACKOFF = 1.
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Rate limits of the servers, in requests per second and number of requests allowed in a burst.
+# Servers not listed get one request per second.
+RATE_LIMITS = {
+  "nominatim.openstreetmap.org": (1., 1),
+}
+
+# The usage policy of the public server: https://operations.osmfoundation.org/policies/nominatim/
+PUBLIC_RATE_LIMIT = (1., 1)
+
+# Defaults of the self-hosted servers
+CONCURRENCY = 8
+RATE = 100.
+
+# Rate limiters of the servers, shared by all the clients of the process
+_limiters = dict()
+_limiters_lock = threading.Lock()
+
+
+class GeocodingError(Exception):
+  """The server could not be reached or failed to answer: the address may exist, try again later"""
+  pass
+
+
+class TokenBucket():
+  """
+  Thread-safe rate limiter: each request takes a token, and tokens come back at `rate` per second,
+  up to `burst` tokens. Requests are spaced by 1 / rate seconds on average, at most `burst` at once.
+  """
+
+  def __init__(self, rate: float, burst=1):
+    self.rate = rate
+    self.burst = burst
+    self._tokens = float(burst)
+    self._updated = time.monotonic()
+    self._lock = threading.Lock()
+
+  def acquire(self, killswitch=None) -> bool:
+    """
+    Wait for a token
+    :param killswitch: Thread-safe boolean stopping the wait if == True
+    :return: False if the wait was stopped by the killswitch
+    """
+    while True:
+      with self._lock:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1.:
+          self._tokens -= 1.
+          return True
+        delay = (1. - self._tokens) / self.rate
+
+      if killswitch is None:
+        time.sleep(delay)
+      elif killswitch.wait(delay):
+        return False
+
+
+def _host(url: str) -> str:
+  return urlsplit(url).netloc.lower()
+
+
+def rate_limiter(url: str) -> TokenBucket:
+  """:return: the rate limiter shared by the requests to the server of url"""
+  host = _host(url)
+  with _limiters_lock:
+    if host not in _limiters:
+      _limiters[host] = TokenBucket(*RATE_LIMITS.get(host, (1., 1)))
+    return _limiters[host]
+
+
+def set_rate_limit(url: str, rate: float, burst=1):
+  """
+  Change the rate limit of the server of url, for the requests to come
+  :raise ValueError: if the limit exceeds the usage policy of the public server
+  """
+  host = _host(url)
+  if host == _host(PUBLIC_SERVER) and (rate > PUBLIC_RATE_LIMIT[0] or burst > PUBLIC_RATE_LIMIT[1]):
+    raise ValueError("%s allows one request per second at most" % host)
+
+  with _limiters_lock:
+    RATE_LIMITS[host] = (rate, burst)
+    _limiters[host] = TokenBucket(rate, burst)
+
+
+def search_url(base_url: str) -> str:
+  """Make the URL of the search API of a server, from its base URL like "http://localhost:8080" """
+  url = base_url.rstrip("?").rstrip("/")
+  if not url.endswith("/search"):
+    url += "/search"
+  return url + "?"
+
+
+class Geocoder(abc.ABC):
+  """
+  Backend answering the geocoding queries of `Nominatim`.
+  It accepts up to `concurrency` queries at once, from as many threads, so bulk geocoding can fan out.
+  """
+  concurrency = 1
+
+  @abc.abstractmethod
+  def search(self, query: str) -> list:
+    """
+    :param query: URL-encoded query of the Nominatim search API, like "q=paris&format=json"
+    :return: the list of the results, empty if nothing was found
+    :raise GeocodingError: if the backend failed to answer
+    """
+
+  def close(self):
+    pass
+
+
+class HTTPGeocoder(Geocoder):
+  """
+  Nominatim search API over HTTP, through a pool of `concurrency` connections kept alive,
+  with the rate limit of the server shared by all its clients.
+  """
+
+  def __init__(self, url: str, concurrency=1, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+               retries=RETRIES, backoff=BACKOFF):
+    """
+    :param url: URL of the search API, ending with "?"
+    :param concurrency: number of requests sent at once
+    :param connect_timeout: seconds to connect to the server
+    :param read_timeout: seconds to read a response
+    :param retries: number of retries of failed requests, see `RETRY_STATUS`
+    :param backoff: base of the exponential waiting time between retries, in seconds
+    """
+    self.url = url
+    self.concurrency = concurrency
+    self.limiter = rate_limiter(url)
+    self.retries = retries
+    self.backoff = backoff
+
+    # Retries are made by `search()`, through the rate limiter: urllib3 would send them at once.
+    # Threads wait for a free connection rather than opening more.
+    self.http = urllib3.PoolManager(num_pools=1, maxsize=concurrency, block=True, headers=HEADERS, retries=False,
+                                    timeout=Timeout(connect=connect_timeout, read=read_timeout))
+
+  def _delay(self, attempt: int, response=None) -> float:
+    """Seconds to wait before retrying a failed attempt, counted from 0"""
+    delay = self.backoff * 2 ** attempt
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+      try:
+        delay = max(delay, Retry().parse_retry_after(retry_after))
+      except urllib3.exceptions.InvalidHeader:
+        pass
+    return delay
+
+  def search(self, query: str) -> list:
+    for attempt in range(self.retries + 1):
+      if attempt > 0:
+        time.sleep(delay)
+
+      # Wait for our turn, to comply with the conditions of use of the API
+      self.limiter.acquire()
+
+      try:
+        r = self.http.request('GET', self.url + query)
+      except urllib3.exceptions.HTTPError as error:
+        if attempt == self.retries:
+          raise GeocodingError("Request failed for query %s: %s" % (query, error)) from error
+        delay = self._delay(attempt)
+        continue
+
+      if r.status == 200:
+        break
+      if r.status not in RETRY_STATUS or attempt == self.retries:
+        raise GeocodingError("Server answered %i for query %s" % (r.status, query))
+      delay = self._delay(attempt, r)
+
+    try:
+      return json.loads(r.data.decode('utf-8'))
+    except ValueError as error:
+      raise GeocodingError("Invalid response for query %s" % query) from error
+
+  def close(self):
+    self.http.clear()
+
+
+class PublicNominatim(HTTPGeocoder):
+  """
+  The public server of OpenStreetMap: one connection and one request per second, as its usage policy requires.
+  See https://operations.osmfoundation.org/policies/nominatim/
+  """
+
+  def __init__(self, **kwargs):
+    super().__init__(PUBLIC_SERVER, concurrency=1, **kwargs)
+
+
+class SelfHostedNominatim(HTTPGeocoder):
+  """A Nominatim server of your own, without the limits of the public one"""
+
+  def __init__(self, url: str, concurrency=CONCURRENCY, rate=RATE, burst=None, **kwargs):
+    """
+    :param url: base URL of the server, like "http://localhost:8080"
+    :param concurrency: number of requests sent at once
+    :param rate: maximum number of requests per second
+    :param burst: maximum number of requests sent at once after a pause, defaults to concurrency
+    :raise ValueError: for the public server, which is limited to `PublicNominatim`
+    """
+    url = search_url(url)
+    set_rate_limit(url, rate, concurrency if burst is None else burst)
+    super().__init__(url, concurrency=concurrency, **kwargs)
+
+
+class FakeGeocoder(Geocoder):
+  """
+  In-process backend for tests: answers from a dict of addresses (the "q" parameter, lower-case)
+  to their results, or with a function of the dict of the query parameters.
+  The queries received are kept in `queries`.
+  """
+
+  def __init__(self, responses=None, concurrency=1, failures=0):
+    """
+    :param failures: number of the next queries failing with `GeocodingError`, like a server down
+    """
+    self.responses = responses if responses is not None else dict()
+    self.concurrency = concurrency
+    self.failures = failures
+    self.queries = []
+    self._lock = threading.Lock()
+
+  def search(self, query: str) -> list:
+    with self._lock:
+      self.queries.append(query)
+      if self.failures > 0:
+        self.failures -= 1
+        raise GeocodingError("Server failed for query %s" % query)
+
+    params = dict(parse_qsl(query))
+    if callable(self.responses):
+      return self.responses(params)
+    return list(self.responses.get(params.get("q", "").lower(), []))
+
+
+def make_geocoder(settings=None) -> Geocoder:
+  """
+  Create the backend set in the preferences under "geocoder", as a dict:
+  `{"backend": "public"}`, the default, or
+  `{"backend": "self-hosted", "url": "http://localhost:8080", "concurrency": 8, "rate": 100}`
+  """
+  settings = settings or dict()
+  backend = settings.get("backend", "public")
+
+  if backend == "public":
+    return PublicNominatim()
+  if backend == "self-hosted":
+    return SelfHostedNominatim(settings["url"], concurrency=int(settings.get("concurrency", CONCURRENCY)),
+                               rate=float(settings.get("rate", RATE)), burst=settings.get("burst"))
+  raise ValueError("Unknown geocoder backend %s" % backend)
+
+
+class StandInServer():
+  """
+  Local HTTP server standing in for Nominatim, answering the search API from a `Geocoder`,
+  typically a `FakeGeocoder`, to test the HTTP backends without network.
+  Statuses put in `statuses` are answered first, one per request, with `retry_after` seconds
+  in the Retry-After header of the 429 and 503.
+
+    with StandInServer(FakeGeocoder({"paris": [{"lat": "48.85", "lon": "2.35"}]})) as server:
+      backend = SelfHostedNominatim(server.url)
+  """
+
+  def __init__(self, geocoder: Geocoder, port=0, statuses=(), retry_after=0):
+    self.geocoder = geocoder
+    self.statuses = list(statuses)
+    self.retry_after = retry_after
+    self.requests = 0
+    # time.monotonic() of the requests received
+    self.times = []
+    self._lock = threading.Lock()
+
+    stand_in = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = "HTTP/1.1"
+      # Headers and body are written separately: don't delay the body
+      disable_nagle_algorithm = True
+
+      def do_GET(self):
+        with stand_in._lock:
+          stand_in.requests += 1
+          stand_in.times.append(time.monotonic())
+          status = stand_in.statuses.pop(0) if stand_in.statuses else 200
+
+        body = b"[]"
+        if status == 200:
+          split = urlsplit(self.path)
+          if split.path.rstrip("/") != "/search":
+            status = 404
+          else:
+            try:
+              body = json.dumps(stand_in.geocoder.search(split.query)).encode("utf-8")
+            except GeocodingError:
+              status = 503
+
+        try:
+          self.send_response(status)
+          self.send_header("Content-Type", "application/json")
+          self.send_header("Content-Length", str(len(body)))
+          if status in (429, 503):
+            self.send_header("Retry-After", str(stand_in.retry_after))
+          self.end_headers()
+          self.wfile.write(body)
+        except ConnectionError:
+          # The client timed out meanwhile
+          self.close_connection = True
+
+      def log_message(self, format, *args):
+        pass
+
+    self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    self.server.daemon_threads = True
+    self.url = "http://127.0.0.1:%i" % self.server.server_address[1]
+    self._thread = None
+
+  def start(self):
+    self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *args):
+    self.stop()
+
+
+if __name__ == "__main__":
+  if len(sys.argv) < 2 or sys.argv[1] != "serve":
+    print("Usage: python -m data.geocoders serve [port] [JSON file of address -> results]")
+    sys.exit(1)
+
+  port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
+  responses = dict()
+  if len(sys.argv) > 3:
+    with open(sys.argv[3], "r") as f:
+      responses = {address.lower(): results for address, results in json.load(f).items()}
+
+  server = StandInServer(FakeGeocoder(responses), port=port)
+  print("Serving %s/search" % server.url)
+  try:
+    server.server.serve_forever()
+  except KeyboardInterrupt:
+    server.server.server_close()
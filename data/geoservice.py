@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from data import contact
+from data.cache import LRUCache
+from data.nominatim import Nominatim, GeocodingError
+from data.spellcheck import GeoSpellChecker
+
+# Priorities of the contacts to geocode, the lowest first
+EDITED = 0
+VISIBLE = 1
+BACKGROUND = 2
+
+# Results are handed to the address book by batches of this many contacts,
+# or when the oldest waited this long (seconds)
+CHECKPOINT_SIZE = 50
+CHECKPOINT_DELAY = 5.
+
+# Number of addresses whose location is kept in memory, the others are read from the `GeoCache`
+LOCATIONS_SIZE = 4096
+
+# Pause after the server failed for `contact.MAX_GEOCODING_FAILURES` addresses in a row (seconds)
+RETRY_DELAY = 300.
+
+
+def address_hints(data: pd.DataFrame, rows) -> pd.Series:
+  """:return: the normalized addresses of the contacts as z-geohint text, to check results are still current"""
+  return contact.contact_addresses(data, rows).map(";".join)
+
+
+class GeocodingService():
+  """
+  Geocode contacts in a dedicated thread, outside the mutex of the workers,
+  so the rate-limited lookups don't hold back the other background tasks.
+
+  Contacts are queued by priority: edited ones first, then the ones visible in the view,
+  then the rest of the book. Their locations are handed by batches to `callback`,
+  as a list of tuple(row, z-geohint, z-geoID, z-exactlocation), from the service thread.
+
+  The outcome of each address is cached by the `GeoCache` as soon as it is found,
+  so after a restart, the contacts still flagged with "z-geoupdate" are queued again
+  and the addresses already found are not looked up again.
+
+  Contacts are located as many at once as the backend accepts.
+
+  When the queue is empty, the expired responses of the cache are refreshed,
+  until new contacts are queued.
+  """
+
+  def __init__(self, callback, nominatim=None, backend=None, checkpoint_size=CHECKPOINT_SIZE,
+               checkpoint_delay=CHECKPOINT_DELAY, refresh=600):
+    """
+    :param callback: function taking the list of the results of a batch
+    :param nominatim: `Nominatim` client, created in the service thread by default
+    :param backend: `Geocoder` of the client created by default
+    :param refresh: maximum number of expired responses refreshed when idle, 0 to disable
+    """
+    self.callback = callback
+    self.nominatim = nominatim
+    self.backend = backend
+    self.checkpoint_size = checkpoint_size
+    self.checkpoint_delay = checkpoint_delay
+    self.refresh = refresh
+
+    # Heap of tuple(priority, order, row), and row -> tuple(priority, order, addresses) of the queued rows.
+    # Rows queued again keep their older heap entry, which is skipped when popped.
+    self._heap = []
+    self._queued = dict()
+    self._order = itertools.count()
+    self._condition = threading.Condition()
+
+    # Set to stop the service, and to interrupt the refresh when contacts are queued
+    self._stop = threading.Event()
+    self._interrupt = threading.Event()
+
+    # address -> tuple(location, exact) of the addresses found last
+    self._locations = LRUCache(LOCATIONS_SIZE)
+
+    # Results not handed to the callback yet.
+    # Once stopping, they are kept for `stop()` until it returned them.
+    self._results = []
+    self._results_since = None
+    self._drained = False
+
+    self._thread = None
+
+  def __len__(self):
+    with self._condition:
+      return len(self._queued)
+
+  def start(self):
+    self._stop.clear()
+    self._drained = False
+    self._thread = threading.Thread(target=self._run, name="geocoding", daemon=True)
+    self._thread.start()
+
+  def stop(self, timeout=5.) -> list:
+    """
+    Stop the service after the current lookups
+    :param timeout: seconds to wait for the current lookups. The results of the ones still running
+    after that are handed to the callback when they end.
+    :return: the results not handed to the callback yet
+    """
+    self._stop.set()
+    self._interrupt.set()
+    with self._condition:
+      self._condition.notify_all()
+    if self._thread is not None:
+      self._thread.join(timeout)
+
+    with self._condition:
+      results = self._results
+      self._results = []
+      self._results_since = None
+      self._drained = True
+    return results
+
+  def submit(self, data: pd.DataFrame, rows, priority=BACKGROUND):
+    """
+    Queue the contacts flagged with "z-geoupdate" among rows.
+    Must be called from the thread owning the data, their addresses are read at once.
+    Contacts already queued are moved up if the priority is more urgent,
+    and their addresses are updated.
+    """
+    rows = pd.Index(rows).intersection(data.index)
+    if "z-geoupdate" in data.columns:
+      rows = rows[~data.loc[rows, "z-geoupdate"].isin([False, "False"]).to_numpy(dtype=bool)]
+    if len(rows) == 0:
+      return
+
+    addresses = contact.contact_addresses(data, rows)
+
+    with self._condition:
+      for row, elems in addresses.items():
+        current = self._queued.get(row)
+        if current is not None and current[0] <= priority:
+          self._queued[row] = (current[0], current[1], elems)
+          continue
+
+        order = next(self._order)
+        self._queued[row] = (priority, order, elems)
+        heapq.heappush(self._heap, (priority, order, row))
+
+      self._interrupt.set()
+      self._condition.notify_all()
+
+  def clear(self):
+    """Forget the queued contacts, when the book is closed"""
+    with self._condition:
+      self._heap = []
+      self._queued = dict()
+
+  def _pop(self, count: int, timeout: float) -> list:
+    # Return tuple(row, addresses, priority) of the count most urgent contacts, or nothing after timeout
+    items = []
+    with self._condition:
+      if not self._queued:
+        self._condition.wait(timeout)
+
+      while self._heap and len(items) < count:
+        priority, order, row = heapq.heappop(self._heap)
+        current = self._queued.get(row)
+        if current is not None and current[1] == order:
+          del self._queued[row]
+          items.append((row, current[2], priority))
+
+      if not self._queued:
+        self._interrupt.clear()
+      return items
+
+  def _requeue(self, row, addresses, priority):
+    with self._condition:
+      if row not in self._queued:
+        order = next(self._order)
+        self._queued[row] = (priority, order, addresses)
+        heapq.heappush(self._heap, (priority, order, row))
+
+  def _checkpoint(self, force=False):
+    # Hand the results to the callback once the batch is full or old enough
+    with self._condition:
+      if not self._results or (self._stop.is_set() and not self._drained):
+        return
+      if not force and len(self._results) < self.checkpoint_size \
+              and time.monotonic() - self._results_since < self.checkpoint_delay:
+        return
+      results = self._results
+      self._results = []
+      self._results_since = None
+
+    self.callback(results)
+
+  def _locate(self, addresses: tuple, spellcheck: GeoSpellChecker) -> list:
+    return [self._locations.get(address, lambda address: contact.geocode_address(self.nominatim, spellcheck, address))
+            for address in addresses]
+
+  def _run(self):
+    if self.nominatim is None:
+      self.nominatim = Nominatim(backend=self.backend)
+    spellcheck = GeoSpellChecker(["fr", "en"])
+
+    # Consecutive contacts the server failed to answer for
+    failures = 0
+    refreshed = False
+
+    with ThreadPoolExecutor(max_workers=self.nominatim.concurrency) as executor:
+      while not self._stop.is_set():
+        items = self._pop(self.nominatim.concurrency, self.checkpoint_delay)
+
+        if not items:
+          self._checkpoint(force=True)
+
+          # Idle: refresh the expired responses, once per session, until new contacts are queued
+          if not refreshed and self.refresh:
+            refreshed = True
+            self.nominatim.refresh(limit=self.refresh, killswitch=self._interrupt)
+          continue
+
+        # Fan out the contacts over the connections of the backend
+        futures = [(item, executor.submit(self._locate, item[1], spellcheck)) for item in items]
+
+        for (row, addresses, priority), future in futures:
+          try:
+            found = future.result()
+          except GeocodingError as error:
+            # The server failed, not the address: queue the contact again
+            print(error)
+            self._requeue(row, addresses, priority)
+            failures += 1
+            continue
+
+          failures = 0
+          geoID, exact = contact.contact_location(found)
+
+          with self._condition:
+            self._results.append((row, ";".join(addresses), geoID, exact))
+            if self._results_since is None:
+              self._results_since = time.monotonic()
+
+        if failures >= contact.MAX_GEOCODING_FAILURES:
+          print("The geocoding server can't be reached, trying again in %i s" % RETRY_DELAY)
+          self._checkpoint(force=True)
+          self._stop.wait(RETRY_DELAY)
+          failures = 0
+
+        self._checkpoint()
+
+    # Lookups that ended after `stop()` returned
+    self._checkpoint(force=True)
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+
+# Records are fsynced by groups: after this many records, or when the oldest waited this long (seconds)
+GROUP_SIZE = 64
+GROUP_DELAY = 1.
+
+# Compact the journal on snapshots once it holds this many records,
+# keeping the changes of the last `RETENTION` seconds
+COMPACT_RECORDS = 10000
+RETENTION = 90 * 24 * 3600
+
+
+def _plain(value):
+  """Convert a cell to a JSON value: NaN to None, numpy scalars to Python"""
+  if isinstance(value, (list, tuple)):
+    return [_plain(elem) for elem in value]
+  if value is None:
+    return None
+  try:
+    if pd.isna(value):
+      return None
+  except (TypeError, ValueError):
+    pass
+  if hasattr(value, "item"):
+    return value.item()
+  return value
+
+
+class Journal():
+  """
+  Append-only journal of the edits of the address book, one JSON line per changed cell:
+  sequence number "s", time "t", row "r", file "f", column "c", old value "o" and new value "n".
+  Undo and redo are journaled as changes too, with "op" and the sequence number of the change they revert in "of".
+
+  Marks record the sequence number up to which the edits are in the `Snapshot` ("snapshot")
+  or were written back to each file ("commit"). The edits after them are replayed by `recover()`
+  after a crash.
+
+  Records are written at once but fsynced by groups, see `GROUP_SIZE` and `GROUP_DELAY`.
+  """
+
+  def __init__(self, path: str):
+    self.path = path
+    self._lock = threading.Lock()
+    self._file = None
+    self._pending = 0
+    self._pending_since = None
+    self._read()
+    self._file = open(self.path, "ab")
+
+  def _clear(self):
+    self.seq = 0
+    self.records = 0
+    # seq -> change
+    self._changes = dict()
+    # row -> seqs of its changes, in order
+    self._rows = dict()
+    self._undo = []
+    self._redo = []
+    # Sequence numbers of the last snapshot, and of the last commit of each file
+    self.snapshot_seq = 0
+    self._commits = dict()
+
+  def _read(self):
+    self._clear()
+    if not os.path.isfile(self.path):
+      return
+
+    valid = 0
+    with open(self.path, "rb") as f:
+      for line in f:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          # Line partially written by a crash: drop it and everything after
+          break
+        self._apply(record)
+        valid += len(line)
+
+    if valid < os.path.getsize(self.path):
+      with open(self.path, "r+b") as f:
+        f.truncate(valid)
+
+  def _apply(self, record: dict):
+    """Update the in-memory state with a record, read from disk or just written"""
+    self.seq = max(self.seq, record["s"])
+    self.records += 1
+    op = record.get("op")
+
+    if op == "snapshot":
+      self.snapshot_seq = record["upto"]
+      return
+    if op == "commit":
+      for file in record["files"]:
+        self._commits[file] = record["upto"]
+      return
+
+    self._changes[record["s"]] = record
+    self._rows.setdefault(record["r"], []).append(record["s"])
+
+    if op == "undo":
+      if self._undo and self._undo[-1] == record["of"]:
+        self._redo.append(self._undo.pop())
+    elif op == "redo":
+      if self._redo and self._redo[-1] == record["of"]:
+        self._undo.append(self._redo.pop())
+    else:
+      self._undo.append(record["s"])
+      self._redo.clear()
+
+  def _write(self, record: dict):
+    self.seq += 1
+    record = dict(record, s=self.seq)
+    self._file.write(json.dumps(record, separators=(",", ":"), ensure_ascii=False).encode("utf-8") + b"\n")
+    self._file.flush()
+    self._apply(record)
+
+    self._pending += 1
+    if self._pending_since is None:
+      self._pending_since = time.monotonic()
+    if self._pending >= GROUP_SIZE or time.monotonic() - self._pending_since >= GROUP_DELAY:
+      self._sync()
+
+    return record
+
+  def _sync(self):
+    if self._pending:
+      os.fsync(self._file.fileno())
+    self._pending = 0
+    self._pending_since = None
+
+  def flush(self):
+    """Make the records written so far durable"""
+    with self._lock:
+      self._sync()
+
+  def close(self):
+    with self._lock:
+      self._sync()
+      self._file.close()
+
+  def __len__(self):
+    return len(self._changes)
+
+  def record(self, row, file, col: str, old, new) -> int:
+    """
+    Journal the edit of a cell
+    :return: sequence number of the change
+    """
+    with self._lock:
+      return self._write({"t": time.time(), "r": _plain(row), "f": _plain(file), "c": col,
+                          "o": _plain(old), "n": _plain(new)})["s"]
+
+  def undo(self):
+    """
+    Journal the revert of the last change not undone yet
+    :return: the change applying the reverted value in "n", or None if there is nothing to undo
+    """
+    with self._lock:
+      if not self._undo:
+        return None
+      change = self._changes[self._undo[-1]]
+      return self._write({"op": "undo", "of": change["s"], "t": time.time(), "r": change["r"], "f": change["f"],
+                          "c": change["c"], "o": change["n"], "n": change["o"]})
+
+  def redo(self):
+    """
+    Journal the replay of the last undone change
+    :return: the change applying the value again in "n", or None if there is nothing to redo
+    """
+    with self._lock:
+      if not self._redo:
+        return None
+      change = self._changes[self._redo[-1]]
+      return self._write({"op": "redo", "of": change["s"], "t": time.time(), "r": change["r"], "f": change["f"],
+                          "c": change["c"], "o": change["o"], "n": change["n"]})
+
+  def can_undo(self) -> bool:
+    return bool(self._undo)
+
+  def can_redo(self) -> bool:
+    return bool(self._redo)
+
+  def mark_snapshot(self, upto=None):
+    """
+    Record that the changes up to the sequence number upto are saved in the snapshot,
+    and compact the journal if it grew too long
+    :param upto: sequence number at the time the saved data was read, defaults to the last one
+    """
+    with self._lock:
+      self._write({"op": "snapshot", "upto": self.seq if upto is None else upto})
+      self._sync()
+      if self.records > COMPACT_RECORDS:
+        self._compact(RETENTION)
+
+  def mark_commit(self, files, upto=None):
+    """Record that the changes up to the sequence number upto are written back to files"""
+    files = [_plain(file) for file in files]
+    if not files:
+      return
+    with self._lock:
+      self._write({"op": "commit", "files": files, "upto": self.seq if upto is None else upto})
+      self._sync()
+
+  def history(self, row) -> list:
+    """:return: the changes of a row, oldest first, undo and redo included"""
+    return [self._changes[seq] for seq in self._rows.get(row, [])]
+
+  def values_at(self, row, when: float) -> dict:
+    """
+    Find the values of a row at a point in time, from the changes made since then
+    :param when: UNIX time
+    :return: dict of column -> value for the columns changed since then only
+    """
+    values = dict()
+    for change in reversed(self.history(row)):
+      if change["t"] <= when:
+        break
+      values[change["c"]] = change["o"]
+    return values
+
+  def pending(self) -> list:
+    """:return: the changes not in the snapshot and not written back to their file, oldest first"""
+    return [change for seq, change in sorted(self._changes.items())
+            if seq > self.snapshot_seq and seq > self._commits.get(change["f"], 0)]
+
+  def recover(self, data: pd.DataFrame):
+    """
+    Replay the pending changes on the address book loaded after a crash.
+    A change is applied only if the cell still holds its old value, so changes already
+    in the data are skipped, and cells modified since by another app are left alone.
+    :return: tuple(data, rows, conflicts) with the recovered rows, and the changes that could not be applied
+    """
+    rows = set()
+    conflicts = []
+
+    for change in self.pending():
+      row, col = change["r"], change["c"]
+      if row not in data.index or ("z-file" in data.columns and _plain(data.at[row, "z-file"]) != change["f"]):
+        conflicts.append(change)
+        continue
+
+      current = _plain(data.at[row, col]) if col in data.columns else None
+      if current == change["n"]:
+        continue
+      if current != change["o"]:
+        conflicts.append(change)
+        continue
+
+      if col not in data.columns:
+        data[col] = None
+      column = data[col]
+      if isinstance(column.dtype, pd.CategoricalDtype) and isinstance(change["n"], str) \
+              and change["n"] not in column.cat.categories:
+        data[col] = column.cat.add_categories([change["n"]])
+      data.at[row, col] = change["n"] if change["n"] is not None else None
+      rows.add(row)
+
+    if rows:
+      if "changed" not in data.columns:
+        data["changed"] = False
+      data.loc[list(rows), "changed"] = True
+
+    return data, sorted(rows), conflicts
+
+  def _compact(self, retention: float):
+    """
+    Rewrite the journal without the changes older than retention that are saved in the snapshot.
+    The marks are collapsed to the latest ones.
+    """
+    horizon = time.time() - retention
+    pending = {change["s"] for change in self.pending()}
+    kept = [change for seq, change in sorted(self._changes.items()) if change["t"] >= horizon or seq in pending]
+    if len(kept) == len(self._changes):
+      return
+
+    records = [{"op": "snapshot", "upto": self.snapshot_seq, "s": self.snapshot_seq}]
+    commits = dict()
+    for file, upto in self._commits.items():
+      commits.setdefault(upto, []).append(file)
+    records += [{"op": "commit", "files": files, "upto": upto, "s": upto} for upto, files in sorted(commits.items())]
+    records += kept
+    last = {"op": "snapshot", "upto": self.snapshot_seq, "s": self.seq}
+
+    temp_path = self.path + ".tmp"
+    with open(temp_path, "wb") as f:
+      for record in records + [last]:
+        f.write(json.dumps(record, separators=(",", ":"), ensure_ascii=False).encode("utf-8") + b"\n")
+      f.flush()
+      os.fsync(f.fileno())
+
+    self._file.close()
+    os.replace(temp_path, self.path)
+    self._read()
+    self._file = open(self.path, "ab")
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import re
+
+import pandas as pd
+
+try:
+  import phonenumbers
+except ImportError:
+  phonenumbers = None
+
+NOT_PHONE = re.compile(r"[^\d+]")
+
+
+def normalize_email(email: str) -> str:
+  """
+  Lower-case an email address, and encode its domain name in IDNA,
+  so "Jean@Müller.de" and "jean@xn--mller-kva.de" match
+  """
+  email = email.strip().lower()
+  if email.startswith("mailto:"):
+    email = email[7:]
+
+  local, at, domain = email.rpartition("@")
+  if not at or domain.isascii():
+    return email
+
+  try:
+    return local + "@" + domain.encode("idna").decode("ascii")
+  except UnicodeError:
+    return email
+
+
+def normalize_phone(number: str, region=None) -> str:
+  """
+  Format a phone number as E.164 (+33612345678).
+  National numbers need the ISO code of their country as region, or they are returned as digits only.
+  Uses the `phonenumbers` package if installed.
+  """
+  if number.startswith("tel:"):
+    number = number[4:]
+
+  if phonenumbers is not None:
+    try:
+      parsed = phonenumbers.parse(number, region)
+      return phonenumbers.format_number(parsed, phonenumbers.PhoneNumberFormat.E164)
+    except phonenumbers.NumberParseException:
+      pass
+
+  number = NOT_PHONE.sub("", number)
+  if number.startswith("00"):
+    number = "+" + number[2:]
+  return number
+
+
+def _values(value) -> list:
+  if isinstance(value, list):
+    return [elem for elem in value if isinstance(elem, str) and elem]
+  if isinstance(value, str) and value:
+    # Address books from older versions hold comma-separated values
+    return value.split(",")
+  return []
+
+
+class LookupIndex():
+  """
+  Hash indexes from normalized emails and phone numbers to the index of the rows holding them,
+  to find the owner of an email or a number without scanning the book.
+  Rows are added, updated and removed incrementally.
+  """
+
+  def __init__(self, region=None):
+    """
+    :param region: ISO code of the country of national phone numbers, like "FR"
+    """
+    self.region = region
+    self.clear()
+
+  def clear(self):
+    # key -> set of rows
+    self._emails = dict()
+    self._phones = dict()
+    # row -> keys, to remove rows
+    self._rows = dict()
+
+  def __len__(self):
+    return len(self._rows)
+
+  def build(self, data: pd.DataFrame):
+    self.clear()
+    self.update(data, data.index)
+
+  def update(self, data: pd.DataFrame, rows):
+    """
+    Index the added or modified rows again, and forget the removed ones
+    :param rows: index of the added, modified or removed rows
+    """
+    rows = pd.Index(rows)
+    self.remove(rows)
+
+    present = rows.intersection(data.index)
+    emails = data.loc[present, "email"] if "email" in data.columns else pd.Series(None, index=present)
+    phones = data.loc[present, "tel"] if "tel" in data.columns else pd.Series(None, index=present)
+
+    # Normalizing phone numbers is slow: do it once per distinct number
+    numbers = {number for value in phones for number in _values(value)}
+    numbers = {number: normalize_phone(number, self.region) for number in numbers}
+
+    for row, email, phone in zip(present, emails, phones):
+      email_keys = {normalize_email(elem) for elem in _values(email)}
+      phone_keys = {numbers[elem] for elem in _values(phone)}
+      email_keys.discard("")
+      phone_keys.discard("")
+
+      for key in email_keys:
+        self._emails.setdefault(key, set()).add(row)
+      for key in phone_keys:
+        self._phones.setdefault(key, set()).add(row)
+
+      self._rows[row] = (email_keys, phone_keys)
+
+  def remove(self, rows):
+    for row in rows:
+      email_keys, phone_keys = self._rows.pop(row, ((), ()))
+      for keys, index in ((email_keys, self._emails), (phone_keys, self._phones)):
+        for key in keys:
+          owners = index[key]
+          owners.discard(row)
+          if not owners:
+            del index[key]
+
+  def lookup_emails(self, emails) -> list:
+    """:return: for each email, the sorted list of the rows holding it"""
+    return [sorted(self._emails.get(normalize_email(email), ())) for email in emails]
+
+  def lookup_phones(self, numbers) -> list:
+    """:return: for each phone number, the sorted list of the rows holding it"""
+    return [sorted(self._phones.get(normalize_phone(number, self.region), ())) for number in numbers]
+
+  def lookup(self, keys) -> list:
+    """
+    Find the owners of emails and phone numbers, told apart by the "@"
+    :return: for each key, the sorted list of the rows holding it
+    """
+    return [self.lookup_emails([key])[0] if "@" in key else self.lookup_phones([key])[0] for key in keys]
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+
+
+class FileManifest():
+  """
+  Record of the state of the .vcf files the last time they were parsed:
+  path -> [inode, size, mtime_ns, hash].
+
+  Comparing the current `os.stat()` of a file against its record tells if the file
+  needs to be read and hashed again. The manifest is persisted as JSON next to the
+  cached address book.
+  """
+
+  def __init__(self, path=""):
+    # If path is empty, the manifest lives only in memory
+    self.path = path
+    self.dict = dict()
+
+    if self.path and os.path.isfile(self.path):
+      self.read_manifest()
+
+  def read_manifest(self):
+    try:
+      with open(self.path, "r") as f:
+        self.dict = json.loads(f.read())
+    except (OSError, ValueError):
+      # A corrupted manifest only costs a full re-hashing of the directory
+      self.dict = dict()
+
+  def write_manifest(self):
+    if not self.path:
+      return
+
+    # Write to a temporary file and swap, so a crash never leaves a half-written manifest
+    temp_path = self.path + ".tmp"
+    with open(temp_path, "w") as f:
+      json.dump(self.dict, f)
+    os.replace(temp_path, self.path)
+
+  def is_unchanged(self, path: str, stat: os.stat_result) -> bool:
+    """Check if the file metadata still match the record"""
+    record = self.dict.get(path)
+    return record is not None and \
+      record[0] == stat.st_ino and record[1] == stat.st_size and record[2] == stat.st_mtime_ns
+
+  def get_hash(self, path: str):
+    record = self.dict.get(path)
+    return record[3] if record is not None else None
+
+  def update(self, path: str, stat: os.stat_result, hash: str):
+    self.dict[path] = [stat.st_ino, stat.st_size, stat.st_mtime_ns, hash]
+
+  def remove(self, path: str):
+    self.dict.pop(path, None)
+
+  def __contains__(self, path: str):
+    return path in self.dict
+
+  def __len__(self):
+    return len(self.dict)
@@ -16,75 +16,97 @@
 # You should have received a copy of the GNU General Public License along with Open Contact Book.
 # If not, see <https://www.gnu.org/licenses/>.
 
-from urllib.parse import urlencode
-import urllib3
-import json
 import os
 import time
-import re
+import threading
 
+from data.geocache import GeoCache
+from data.geocoders import GeocodingError, PublicNominatim
 
 # Configure the cache
 home_path = os.path.expanduser('~')
 pref_path = os.path.join(home_path, ".opencontactsbook")
+# Cache of older versions, one file per query, migrated to geocache_file
 cache_path = os.path.join(pref_path, "geocache")
+geocache_file = os.path.join(pref_path, "geocache.sqlite")
 
 # Create the directory if needed
 if(not os.path.isdir(pref_path)):
   os.mkdir(pref_path)
 
-if(not os.path.isdir(cache_path)):
-  os.mkdir(cache_path)
+# Cache shared by all the Nominatim instances of the process, opened on first use
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def default_cache() -> GeoCache:
+  global _default_cache
+  with _default_lock:
+    if _default_cache is None:
+      _default_cache = GeoCache(geocache_file)
+      _default_cache.migrate(cache_path)
+      _default_cache.evict()
+    return _default_cache
+
 
 class Nominatim:
-  def __init__(self):
-    self.timer = time.time()
+  def __init__(self, cache=None, backend=None):
+    """
+    :param cache: `GeoCache` of the responses, defaults to the one of the user preferences directory
+    :param backend: `Geocoder` answering the queries missing from the cache, defaults to the public server
+    """
+    self.cache = cache if cache is not None else default_cache()
+    self.backend = backend if backend is not None else PublicNominatim()
+
+  @property
+  def concurrency(self) -> int:
+    """Number of queries the backend accepts at once"""
+    return self.backend.concurrency
 
   def fetch_cache_or_web(self, query):
     # Lookup the cache for a query. If not found, fetch it on the server
-    all_files = os.listdir(cache_path)
-    now = int(time.time())
-
-    # Walk the directory to find all files
-    # Look for case-insensitive matches
-    for file in sorted(all_files):
-      if (file.lower()).startswith(query.lower()):
-        """
-        # Get the file timestamp
-        timestamp = re.search(r"\d+$", file)
-
-        if(now - int(timestamp.group(0)) > 5184000):
-          # if the cache is older than 60 days, flush it
-          print("Cache flushed for query", query)
-          os.remove(file)
-        else:
-        """
-        # the cache is new enough, use it
-        # print("Cache used for query", query)
-        with open(os.path.join(cache_path, file), "r") as f:
-          return json.loads(f.read())
-
-    # No cache found, make it
-    http = urllib3.PoolManager(num_pools=1, headers={
-      "Accept": "application/json",
-      "Content-Type": "application/json",
-      "Accept": "text/plain",
-      "User-Agent": "Open Contact book experimental"
-    })
-    url = 'https://nominatim.openstreetmap.org/search?' + query
-
-    # Check if previous request is more than 1 s old
-    # To comply with the conditions of use of the API
-    now = time.time()
-    time_passed = now - self.timer
-    if(time_passed < 1.): time.sleep(1. - time_passed)
-
-    r = http.request('GET', url)
-    self.timer = now
-    output = json.loads(r.data.decode('utf-8'))
-
-    with open(os.path.join(cache_path, query.lower() + "_" + str(int(now))), "w") as file:
-      file.write(json.dumps(output))
+    output = self.cache.get(query)
+    if output is not None:
+      return output
+
+    return self.fetch_web(query)
+
+  def fetch_web(self, query):
+    """
+    Fetch a query on the server and cache the response, which may be an empty list if nothing was found
+    :raise GeocodingError: if the server could not answer after the retries. Nothing is cached then.
+    """
+    output = self.backend.search(query)
+    self.cache.put(query, output, time.time())
 
     print("Server used for query", query)
     return output
+
+  def refresh(self, limit=None, progress=None, killswitch=None):
+    """
+    Fetch again the expired responses used since the cache was opened, then evict the cache.
+    Requests are spaced like the others to respect the rate limit.
+    :param limit: maximum number of queries fetched, the others wait for the next refresh
+    :param progress: Qt Worker Signal to emit progress info
+    :param killswitch: Thread-safe boolean stopping the process if == True
+    :return: number of responses refreshed
+    """
+    queries = self.cache.stale_queries(limit)
+    refreshed = 0
+
+    for i, query in enumerate(queries):
+      if killswitch is not None and killswitch.is_set():
+        break
+
+      if progress is not None:
+        progress.emit((i, 0, len(queries), "Refreshing cached locations", "Fetch geolocation data"))
+
+      try:
+        self.fetch_web(query)
+        refreshed += 1
+      except GeocodingError as error:
+        # Keep the stale response, it will be tried again when used next
+        print("Refresh failed for query", query, error)
+
+    self.cache.evict()
+    return refreshed
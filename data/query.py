@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+# Query language to filter the address book:
+#
+#   doe                     any of the DEFAULT_FIELDS contains "doe"
+#   org:acme                the org column contains "acme"
+#   "jean-paul"             quoted values may contain spaces and special characters
+#   email:/@acme\.(com|fr)/ the email column matches a regular expression
+#   adr-country=france      the column, or one element of the list, is exactly "france"
+#   category:vip            "vip" is one of the categories
+#   has:photo               the photo column is not empty
+#   a b, a AND b            both match
+#   a OR b                  any matches
+#   NOT a, -a               a doesn't match
+#   ( a OR b ) AND c        grouping
+#
+# Text is compared case- and accents-insensitively, except by regular expressions which only ignore case.
+# Predicates are evaluated as vectorized masks over whole columns, which are cached so editing
+# a query only evaluates its new predicates.
+
+import re
+from collections import OrderedDict
+from functools import lru_cache
+
+import pandas as pd
+
+from data.text import normalize, normalize_series, column_text
+
+# Columns searched by values without a field
+DEFAULT_FIELDS = ("fn", "n", "nickname", "org", "email", "tel", "adr-street", "adr-locality", "adr-country", "note")
+
+TOKEN = re.compile(r'''
+  \s*(?:
+    (?P<open>\()
+  | (?P<close>\))
+  | (?P<negate>-)?(?:(?P<field>[\w\-]+)(?P<op>[:=]))?
+    (?:"(?P<quoted>(?:[^"\\]|\\.)*)"
+     | /(?P<regex>(?:[^/\\]|\\.)*)/
+     | (?P<word>[^\s()"]+))
+  )''', re.VERBOSE)
+
+KEYWORDS = {"AND", "OR", "NOT"}
+
+# Masks of predicates kept by a `QueryEngine`, the least recently used dropped first.
+# Typing a query adds one per keystroke, and each is updated on every edit.
+MASKS_SIZE = 64
+
+
+class QueryError(ValueError):
+  """The query can't be parsed"""
+  pass
+
+
+class Predicate():
+  """
+  Leaf of a query: (op, field, value), with op one of "contains", "equals", "regex", "has".
+  Field "*" means any of the `DEFAULT_FIELDS`.
+  """
+
+  def __init__(self, op: str, field: str, value: str):
+    self.op = op
+    self.field = field
+    self.value = value
+
+    if op == "regex":
+      try:
+        self.pattern = re.compile(value, re.IGNORECASE)
+      except re.error as error:
+        raise QueryError("Invalid regular expression /%s/: %s" % (value, error))
+    elif op != "has":
+      self.value = normalize(value)
+
+  @property
+  def key(self):
+    return (self.op, self.field, self.value)
+
+  def evaluate(self, engine, rows=None) -> pd.Series:
+    return engine.predicate(self, rows)
+
+  def compute(self, engine, rows) -> pd.Series:
+    """Evaluate the predicate over rows (index), without cache"""
+    if self.field == "*" and self.op == "equals":
+      mask = pd.Series(False, index=rows)
+      for field in DEFAULT_FIELDS:
+        if field in engine.data.columns:
+          mask |= Predicate(self.op, field, self.value).compute(engine, rows)
+      return mask
+
+    if self.field != "*" and self.field not in engine.data.columns:
+      return pd.Series(False, index=rows)
+
+    if self.op == "has":
+      return engine.raw_text(self.field, rows) != ""
+    if self.op == "regex":
+      return engine.raw_text(self.field, rows).str.contains(self.pattern, regex=True)
+    if self.op == "contains":
+      return engine.text(self.field, rows).str.contains(self.value, regex=False)
+
+    # equals: the whole cell, or one element of lists
+    column = engine.data[self.field].reindex(rows)
+    if column.dtype == object and column.map(lambda value: isinstance(value, list)).any():
+      elements = column.explode()
+      elements = normalize_series(elements.where(elements.notna(), "").astype(str))
+      return (elements == self.value).groupby(level=0, sort=False).any().reindex(rows, fill_value=False)
+
+    return engine.text(self.field, rows) == self.value
+
+
+class And():
+  def __init__(self, *children):
+    self.children = children
+
+  def evaluate(self, engine, rows=None) -> pd.Series:
+    mask = self.children[0].evaluate(engine, rows)
+    for child in self.children[1:]:
+      mask = mask & child.evaluate(engine, rows)
+    return mask
+
+
+class Or(And):
+  def evaluate(self, engine, rows=None) -> pd.Series:
+    mask = self.children[0].evaluate(engine, rows)
+    for child in self.children[1:]:
+      mask = mask | child.evaluate(engine, rows)
+    return mask
+
+
+class Not(And):
+  def evaluate(self, engine, rows=None) -> pd.Series:
+    return ~self.children[0].evaluate(engine, rows)
+
+
+def tokenize(query: str) -> list:
+  tokens = []
+  position = 0
+  query = query.rstrip()
+
+  while position < len(query):
+    match = TOKEN.match(query, position)
+    if match is None or match.end() == position:
+      raise QueryError("Unexpected character at position %i: %s" % (position, query[position:]))
+    tokens.append(match)
+    position = match.end()
+
+  return tokens
+
+
+@lru_cache(maxsize=256)
+def compile(query: str):
+  """
+  Parse a query into a tree of `And`, `Or`, `Not` and `Predicate`
+  :raise QueryError: on syntax errors
+  """
+  tokens = tokenize(query)
+  if not tokens:
+    return None
+
+  position = 0
+
+  def peek():
+    return tokens[position] if position < len(tokens) else None
+
+  def keyword(token):
+    if token is None or token["field"] or token["negate"]:
+      return None
+    return token["word"] if token["word"] in KEYWORDS else None
+
+  def parse_or():
+    nonlocal position
+    children = [parse_and()]
+    while keyword(peek()) == "OR":
+      position += 1
+      children.append(parse_and())
+    return children[0] if len(children) == 1 else Or(*children)
+
+  def parse_and():
+    nonlocal position
+    children = [parse_not()]
+    while peek() is not None and not peek()["close"] and keyword(peek()) != "OR":
+      if keyword(peek()) == "AND":
+        position += 1
+      children.append(parse_not())
+    return children[0] if len(children) == 1 else And(*children)
+
+  def parse_not():
+    nonlocal position
+    if keyword(peek()) == "NOT":
+      position += 1
+      return Not(parse_not())
+    return parse_atom()
+
+  def parse_atom():
+    nonlocal position
+    token = peek()
+    if token is None:
+      raise QueryError("Unexpected end of query")
+    position += 1
+
+    if token["open"]:
+      node = parse_or()
+      if peek() is None or not peek()["close"]:
+        raise QueryError("Missing closing parenthesis")
+      position += 1
+      return node
+
+    if token["close"] or keyword(token):
+      raise QueryError("Unexpected %s" % token.group().strip())
+
+    node = parse_term(token)
+    return Not(node) if token["negate"] else node
+
+  def parse_term(token):
+    field = token["field"].lower() if token["field"] else "*"
+    value = token["word"] if token["word"] is not None else token["quoted"]
+    if token["quoted"] is not None:
+      value = re.sub(r'\\(.)', r'\1', value)
+
+    if token["regex"] is not None:
+      if token["op"] == "=":
+        raise QueryError("Regular expressions need \":\": %s" % token.group().strip())
+      return Predicate("regex", field, token["regex"])
+
+    if field == "has":
+      return Predicate("has", value.lower(), "")
+    if field in ("category", "categories", "in"):
+      return Predicate("equals", "categories", value)
+    if token["op"] == "=":
+      return Predicate("equals", field, value)
+    return Predicate("contains", field, value)
+
+  node = parse_or()
+  if position < len(tokens):
+    raise QueryError("Unexpected %s" % tokens[position].group().strip())
+
+  return node
+
+
+class QueryEngine():
+  """
+  Evaluate compiled queries over an address book, caching the mask of the last `MASKS_SIZE` predicates
+  and the normalized text of the columns they read.
+
+  When rows are added, modified or removed, `update()` recomputes the cached masks
+  for those rows only.
+  """
+
+  def __init__(self, data=None):
+    self.set_data(data if data is not None else pd.DataFrame())
+
+  def set_data(self, data: pd.DataFrame):
+    self.data = data
+    self._masks = OrderedDict()
+    self._predicates = dict()
+    self._raw = dict()
+    self._texts = dict()
+
+  def _to_text(self, field: str, rows) -> list:
+    if field == "*":
+      # All the default fields on separate lines, to search them at once
+      fields = [field for field in DEFAULT_FIELDS if field in self.data.columns]
+      return ["\n".join(values)
+              for values in zip(*[column_text(self.data.loc[rows, field]) for field in fields])] \
+        if fields else [""] * len(rows)
+    return column_text(self.data.loc[rows, field]).tolist()
+
+  def raw_text(self, field: str, rows) -> pd.Series:
+    if field not in self._raw:
+      self._raw[field] = pd.Series(self._to_text(field, self.data.index), index=self.data.index, dtype=object)
+    return self._raw[field].reindex(rows)
+
+  def text(self, field: str, rows) -> pd.Series:
+    if field not in self._texts:
+      if field == "*":
+        # Join the normalized columns, which are cached for predicates on single fields
+        fields = [field for field in DEFAULT_FIELDS if field in self.data.columns]
+        texts = [self.text(field, self.data.index) for field in fields]
+        self._texts[field] = pd.Series(["\n".join(values) for values in zip(*texts)] if fields
+                                       else [""] * len(self.data.index), index=self.data.index, dtype=object)
+      else:
+        self._texts[field] = normalize_series(self.raw_text(field, self.data.index))
+    return self._texts[field].reindex(rows)
+
+  def predicate(self, predicate: Predicate, rows=None) -> pd.Series:
+    key = predicate.key
+    if key in self._masks:
+      self._masks.move_to_end(key)
+    else:
+      self._masks[key] = self._compute(predicate)
+      self._predicates[key] = predicate
+      while len(self._masks) > MASKS_SIZE:
+        del self._predicates[self._masks.popitem(last=False)[0]]
+
+    mask = self._masks[key]
+    return mask if rows is None else mask.reindex(rows, fill_value=False)
+
+  def _compute(self, predicate: Predicate) -> pd.Series:
+    index = self.data.index
+
+    if predicate.op == "contains":
+      # While typing, the new value extends a previous one:
+      # only the rows matching the previous value can match the new one
+      narrower = [key for key in self._masks
+                  if key[0] == "contains" and key[1] == predicate.field and key[2] in predicate.value]
+      if narrower:
+        previous = self._masks[max(narrower, key=lambda key: len(key[2]))]
+        candidates = index[previous.to_numpy()]
+        mask = pd.Series(False, index=index)
+        mask[candidates] = predicate.compute(self, candidates).to_numpy()
+        return mask
+
+    return predicate.compute(self, index)
+
+  def mask(self, node, rows=None) -> pd.Series:
+    """Boolean mask of the rows matching the compiled query, over rows or the whole book"""
+    if node is None:
+      return pd.Series(True, index=self.data.index if rows is None else rows)
+    return node.evaluate(self, rows)
+
+  def update(self, rows, data=None):
+    """
+    Recompute the cached text and masks for rows
+    :param rows: index of the added, modified or removed rows
+    :param data: the new address book, if rows were added or removed
+    """
+    if data is not None and data is not self.data:
+      self.data = data
+      index = data.index
+      self._raw = {field: text.reindex(index) for field, text in self._raw.items()
+                   if field in data.columns or field == "*"}
+      self._texts = {field: text.reindex(index) for field, text in self._texts.items() if field in self._raw}
+      self._masks = OrderedDict((key, mask.reindex(index, fill_value=False)) for key, mask in self._masks.items())
+
+    rows = pd.Index(rows).intersection(self.data.index)
+    if len(rows) == 0:
+      return
+
+    for field, text in self._raw.items():
+      text[rows] = self._to_text(field, rows)
+    for field, text in self._texts.items():
+      if field != "*":
+        text[rows] = normalize_series(self._raw[field][rows]).to_numpy()
+    if "*" in self._texts:
+      fields = [field for field in DEFAULT_FIELDS if field in self._texts]
+      self._texts["*"][rows] = ["\n".join(values) for values in zip(*[self._texts[field][rows] for field in fields])]
+    for key, mask in self._masks.items():
+      mask[rows] = self._predicates[key].compute(self, rows).to_numpy()
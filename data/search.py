@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import bisect
+import heapq
+import re
+
+import pandas as pd
+
+from data import vcard
+from data.text import column_text, normalize, normalize_series
+
+# Indexed columns and the weight of their matches in the ranking
+FIELD_WEIGHTS = {"fn": 4, "nickname": 3, "org": 2, "email": 2, "tel": 1}
+FIELD_WEIGHTS.update({col: 1 for col in vcard.ADDRESS_COLUMNS})
+
+# Weight of the match of a searched word against an indexed word
+EXACT = 3
+PREFIX = 2
+SUBSTRING = 1
+
+WORD = re.compile(r"\w+")
+NOT_DIGIT = re.compile(r"\D")
+
+
+def trigrams(word: str) -> set:
+  return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+class SearchIndex():
+  """
+  In-memory inverted index of the words of the names, organizations, emails, phones and addresses
+  of the contacts, normalized like `query.normalize()`, for search as you type.
+
+  Words shorter than 3 characters are looked up as prefixes in the sorted vocabulary,
+  longer ones as substrings through a trigram index of the vocabulary.
+  Phone numbers are also indexed with their digits only, so "0612" finds "06 12 34 56 78".
+
+  Rows are added, updated and removed incrementally.
+  """
+
+  def __init__(self, data=None):
+    self.clear()
+    if data is not None:
+      self.build(data)
+
+  def clear(self):
+    # word -> {row: weight}
+    self._postings = dict()
+    # row -> {word: weight}
+    self._rows = dict()
+    # trigram -> set of words
+    self._trigrams = dict()
+    # sorted vocabulary, for prefixes
+    self._vocabulary = []
+
+  def __len__(self):
+    return len(self._rows)
+
+  def __contains__(self, row):
+    return row in self._rows
+
+  def build(self, data: pd.DataFrame):
+    """Index all the rows of the address book"""
+    self.clear()
+    for row, words in self._words(data).items():
+      self._add(row, words, sort=False)
+
+    # Sort the vocabulary once, instead of inserting each new word at its place
+    self._vocabulary = sorted(self._postings)
+
+  def update(self, data: pd.DataFrame, rows):
+    """
+    Index the added or modified rows again, and forget the removed ones
+    :param rows: index of the added, modified or removed rows
+    """
+    rows = pd.Index(rows)
+    for row in rows:
+      self._remove(row)
+
+    present = rows.intersection(data.index)
+    for row, words in self._words(data.loc[present]).items():
+      self._add(row, words)
+
+  def remove(self, rows):
+    for row in rows:
+      self._remove(row)
+
+  def _words(self, data: pd.DataFrame) -> dict:
+    """Find the words of each row, with their best field weight"""
+    words = {row: dict() for row in data.index}
+
+    # Read the fields of the same weight at once, the heaviest first so words keep their best weight
+    for weight in sorted(set(FIELD_WEIGHTS.values()), reverse=True):
+      fields = [field for field, field_weight in FIELD_WEIGHTS.items()
+                if field_weight == weight and field in data.columns]
+      if not fields:
+        continue
+
+      texts = [normalize_series(column_text(data[field])) for field in fields]
+      for row, values in zip(data.index, zip(*texts)):
+        row_words = words[row]
+        for word in WORD.findall(" ".join(values)):
+          row_words.setdefault(word, weight)
+
+      if "tel" in fields:
+        for row, value in data["tel"].items():
+          for number in (value if isinstance(value, list) else [value]):
+            if isinstance(number, str):
+              digits = NOT_DIGIT.sub("", number)
+              if digits:
+                words[row].setdefault(digits, weight)
+
+    return words
+
+  def _add(self, row, words: dict, sort=True):
+    self._rows[row] = words
+
+    for word, weight in words.items():
+      postings = self._postings.get(word)
+      if postings is None:
+        postings = self._postings[word] = dict()
+        if sort:
+          bisect.insort(self._vocabulary, word)
+        for trigram in trigrams(word):
+          self._trigrams.setdefault(trigram, set()).add(word)
+      postings[row] = weight
+
+  def _remove(self, row):
+    words = self._rows.pop(row, None)
+    if words is None:
+      return
+
+    for word in words:
+      postings = self._postings[word]
+      del postings[row]
+      if postings:
+        continue
+
+      # Last occurrence of the word
+      del self._postings[word]
+      del self._vocabulary[bisect.bisect_left(self._vocabulary, word)]
+      for trigram in trigrams(word):
+        matches = self._trigrams[trigram]
+        matches.discard(word)
+        if not matches:
+          del self._trigrams[trigram]
+
+  def _matching_words(self, token: str):
+    """Yield the indexed words matching a searched word, with the weight of the match"""
+    if len(token) < 3:
+      start = bisect.bisect_left(self._vocabulary, token)
+      for word in self._vocabulary[start:]:
+        if not word.startswith(token):
+          break
+        yield word, EXACT if word == token else PREFIX
+      return
+
+    candidates = sorted((self._trigrams.get(trigram, set()) for trigram in trigrams(token)), key=len)
+    for word in set.intersection(*candidates):
+      if token in word:
+        yield word, EXACT if word == token else PREFIX if word.startswith(token) else SUBSTRING
+
+  def search(self, text: str, limit=50) -> list:
+    """
+    Find the rows containing all the words of text, as prefixes or substrings of their words
+    :return: index of the best matching rows, best first. Rows matching whole words in names rank first.
+    """
+    tokens = sorted(set(WORD.findall(normalize(text))), key=len, reverse=True)
+    if not tokens:
+      return []
+
+    scores = None
+    for token in tokens:
+      token_scores = dict()
+      for word, quality in self._matching_words(token):
+        for row, weight in self._postings[word].items():
+          score = quality * weight
+          if token_scores.get(row, 0) < score:
+            token_scores[row] = score
+
+      if scores is None:
+        scores = token_scores
+      else:
+        scores = {row: score + token_scores[row] for row, score in scores.items() if row in token_scores}
+
+      if not scores:
+        return []
+
+    return [row for row, score in heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))]
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# Bump when the layout of the address book changes in a way older snapshots can't be read as-is
+SNAPSHOT_VERSION = 1
+METADATA_KEY = b"opencontactbook"
+
+# Columns whose changes mark a row as needing a checkpoint
+FINGERPRINT_COLS = ["z-hash", "z-geoupdate", "changed"]
+
+
+def _to_list(value):
+  # Nested lists are read as arrays of arrays
+  if isinstance(value, np.ndarray):
+    return [_to_list(elem) for elem in value]
+  return value
+
+
+class Snapshot():
+  """
+  On-disk copy of the address book as an uncompressed Arrow IPC (Feather v2) file,
+  tagged with `SNAPSHOT_VERSION`.
+
+  The base file is memory-mapped on loading, and columns can be loaded selectively.
+  Between two full saves, `checkpoint()` appends only the rows changed since the previous
+  save or checkpoint to numbered delta files, which are replayed on loading
+  and merged into the base file on the next `save()`.
+  """
+
+  def __init__(self, path: str):
+    self.path = path
+
+    # Fingerprints of the rows as of the last save or checkpoint, to find what changed since
+    self._fingerprints = None
+
+  def exists(self) -> bool:
+    return os.path.isfile(self.path)
+
+  def _deltas(self) -> list:
+    return sorted(glob.glob(glob.escape(self.path) + ".delta-*"))
+
+  def _read_table(self, path: str, columns=None) -> pa.Table:
+    # The table keeps referencing the mapped file: let it close with the table
+    table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+    metadata = json.loads((table.schema.metadata or {}).get(METADATA_KEY, b"{}"))
+    if metadata.get("version") != SNAPSHOT_VERSION:
+      raise ValueError("Snapshot %s has version %s, expected %i"
+                       % (path, metadata.get("version"), SNAPSHOT_VERSION))
+
+    if columns is not None:
+      # Keep the index columns stored by pandas
+      index_cols = [col for col in table.column_names if col.startswith("__index_level_")]
+      table = table.select([col for col in table.column_names if col in columns] + index_cols)
+
+    return table
+
+  def _to_pandas(self, table: pa.Table) -> pd.DataFrame:
+    data = table.to_pandas()
+
+    # Arrow lists are read as numpy arrays, the book holds Python lists
+    for field in table.schema:
+      if field.name in data.columns and (pa.types.is_list(field.type) or pa.types.is_large_list(field.type)):
+        data[field.name] = data[field.name].map(_to_list)
+
+    return data
+
+  def _write_table(self, data: pd.DataFrame, path: str, metadata: dict):
+    table = pa.Table.from_pandas(data, preserve_index=True)
+    schema_metadata = dict(table.schema.metadata or {})
+    schema_metadata[METADATA_KEY] = json.dumps(dict(metadata, version=SNAPSHOT_VERSION)).encode()
+    table = table.replace_schema_metadata(schema_metadata)
+
+    # Write to a temporary file and swap, so a crash never leaves a half-written snapshot
+    temp_path = path + ".tmp"
+    with pa.OSFile(temp_path, "wb") as sink:
+      with pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(temp_path, path)
+
+  def columns(self) -> list:
+    """List the columns stored in the snapshot, without loading them"""
+    with pa.memory_map(self.path, "r") as source:
+      schema = pa.ipc.open_file(source).schema
+    return [col for col in schema.names if not col.startswith("__index_level_")]
+
+  def load(self, columns=None) -> pd.DataFrame:
+    """
+    Load the address book, including the pending checkpoints
+    :param columns: optional list of the only columns to load
+    :raise ValueError: if the snapshot was written with another `SNAPSHOT_VERSION`
+    """
+    data = self._to_pandas(self._read_table(self.path, columns))
+
+    for delta in self._deltas():
+      table = self._read_table(delta, columns)
+      deleted = json.loads(table.schema.metadata[METADATA_KEY]).get("deleted", [])
+      rows = self._to_pandas(table)
+
+      data = data.drop(index=[row for row in deleted if row in data.index])
+      data = pd.concat([data.drop(index=rows.index.intersection(data.index)), rows], axis=0)
+
+    if columns is None:
+      self._fingerprints = self._fingerprint(data)
+
+    return data
+
+  def save(self, data: pd.DataFrame, progress=None, killswitch=None):
+    """Write the whole address book and drop the checkpoints"""
+    self._write_table(data, self.path, dict())
+
+    for delta in self._deltas():
+      os.remove(delta)
+
+    self._fingerprints = self._fingerprint(data)
+
+  def checkpoint(self, data: pd.DataFrame, rows=(), progress=None, killswitch=None):
+    """
+    Write the rows changed since the last save or checkpoint.
+    Rows are found changed from their hash, geolocation and edit flags, plus the explicit rows.
+    :param rows: index of rows known to be changed, typically edited by the user
+    :return: number of rows written
+    """
+    if not self.exists() or self._fingerprints is None:
+      self.save(data)
+      return len(data.index)
+
+    fingerprints = self._fingerprint(data)
+    previous = self._fingerprints.reindex(fingerprints.index)
+    changed = fingerprints.index[(fingerprints != previous) | previous.isna()]
+    changed = changed.union(pd.Index(rows).intersection(data.index))
+    deleted = self._fingerprints.index.difference(fingerprints.index).tolist()
+
+    if len(changed) == 0 and not deleted:
+      return 0
+
+    deltas = self._deltas()
+    number = int(deltas[-1].rsplit("-", 1)[1]) + 1 if deltas else 0
+    self._write_table(data.loc[changed], "%s.delta-%06i" % (self.path, number), {"deleted": deleted})
+
+    self._fingerprints = fingerprints
+    return len(changed)
+
+  def _fingerprint(self, data: pd.DataFrame) -> pd.Series:
+    fingerprint = pd.Series("", index=data.index)
+    for col in FINGERPRINT_COLS:
+      if col in data.columns:
+        fingerprint = fingerprint + "|" + data[col].astype(str)
+    return fingerprint
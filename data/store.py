@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import re
+import sqlite3
+import threading
+
+import pandas as pd
+
+from data import vcard
+from data.text import to_text
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS contacts (
+  id INTEGER PRIMARY KEY,
+  file TEXT,
+  hash TEXT
+);
+CREATE INDEX IF NOT EXISTS contacts_file ON contacts(file);
+
+CREATE TABLE IF NOT EXISTS properties (
+  contact INTEGER NOT NULL REFERENCES contacts(id) ON DELETE CASCADE,
+  name TEXT NOT NULL,
+  value TEXT,
+  PRIMARY KEY (contact, name)
+) WITHOUT ROWID;
+
+CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(
+  name, org, email, tel, address, note, categories,
+  tokenize = "unicode61 remove_diacritics 2"
+);
+"""
+
+# Maximum number of SQL variables per statement on older SQLite
+CHUNK = 500
+
+
+class SQLiteStore():
+  """
+  SQLite storage of the address book, with a FTS5 full-text index over
+  names, organizations, emails, phones, addresses, notes and categories.
+
+  Contacts are stored in long format: one (contact, property, JSON value) record
+  per non-empty cell, so sparse custom properties cost nothing.
+  The contact id is the index of the row in the address book DataFrame.
+  The database uses WAL journaling, so readers don't block the writer.
+  """
+
+  def __init__(self, path=":memory:"):
+    self.path = path
+    self._lock = threading.Lock()
+    self._connection = sqlite3.connect(path, check_same_thread=False)
+    self._connection.execute("PRAGMA journal_mode=WAL")
+    self._connection.execute("PRAGMA synchronous=NORMAL")
+    self._connection.execute("PRAGMA foreign_keys=ON")
+    self._connection.executescript(SCHEMA)
+
+  def close(self):
+    with self._lock:
+      self._connection.close()
+
+  def __len__(self):
+    with self._lock:
+      return self._connection.execute("SELECT COUNT(*) FROM contacts").fetchone()[0]
+
+  def write(self, data: pd.DataFrame, rows=None, progress=None, killswitch=None):
+    """
+    Insert or replace contacts from the address book, and remove the ones missing from it
+    :param rows: index of the added, modified or removed rows. If None, the whole store is replaced by data.
+    """
+    with self._lock, self._connection:
+      if rows is None:
+        self._connection.execute("DELETE FROM contacts")
+        self._connection.execute("DELETE FROM search")
+        rows = data.index
+      else:
+        rows = pd.Index(rows)
+        self._delete(rows.tolist())
+        rows = rows.intersection(data.index)
+
+      columns = data.columns.tolist()
+      subset = data.loc[rows]
+
+      contacts = []
+      properties = []
+      search = []
+
+      for contact, values in zip(subset.index.tolist(), subset.itertuples(index=False, name=None)):
+        row = dict(zip(columns, values))
+        contacts.append((contact, _scalar(row.get("z-file")), _scalar(row.get("z-hash"))))
+        properties += [(contact, name, json.dumps(_scalar(value)))
+                       for name, value in row.items() if not _is_missing(value)]
+        search.append((contact,) + _search_fields(row))
+
+      self._connection.executemany("INSERT INTO contacts (id, file, hash) VALUES (?, ?, ?)", contacts)
+      self._connection.executemany("INSERT INTO properties (contact, name, value) VALUES (?, ?, ?)", properties)
+      self._connection.executemany(
+        "INSERT INTO search (rowid, name, org, email, tel, address, note, categories) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        search)
+
+  def set_value(self, row, col, value):
+    """Update a single property of a contact and its full-text index"""
+    with self._lock, self._connection:
+      if _is_missing(value):
+        self._connection.execute("DELETE FROM properties WHERE contact = ? AND name = ?", (row, col))
+      else:
+        self._connection.execute("INSERT OR REPLACE INTO properties (contact, name, value) VALUES (?, ?, ?)",
+                                 (row, col, json.dumps(_scalar(value))))
+
+      record = {name: json.loads(value) for name, value in self._connection.execute(
+        "SELECT name, value FROM properties WHERE contact = ?", (row, ))}
+      self._connection.execute("DELETE FROM search WHERE rowid = ?", (row, ))
+      self._connection.execute(
+        "INSERT INTO search (rowid, name, org, email, tel, address, note, categories) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (row,) + _search_fields(record))
+
+  def delete(self, rows):
+    """Remove contacts by index"""
+    with self._lock, self._connection:
+      self._delete(list(rows))
+
+  def _delete(self, rows: list):
+    for i in range(0, len(rows), CHUNK):
+      chunk = rows[i:i + CHUNK]
+      marks = ",".join("?" * len(chunk))
+      self._connection.execute("DELETE FROM contacts WHERE id IN (%s)" % marks, chunk)
+      self._connection.execute("DELETE FROM search WHERE rowid IN (%s)" % marks, chunk)
+
+  def rows_of_files(self, files) -> list:
+    """Find the index of the contacts parsed from files"""
+    files = list(files)
+    rows = []
+    with self._lock:
+      for i in range(0, len(files), CHUNK):
+        chunk = files[i:i + CHUNK]
+        rows += [row for (row, ) in self._connection.execute(
+          "SELECT id FROM contacts WHERE file IN (%s)" % ",".join("?" * len(chunk)), chunk)]
+    return rows
+
+  def sync(self, data: pd.DataFrame, changes: dict):
+    """
+    Apply a change set of `contact.sync_vcf_in_directory` to the store
+    :param data: address book after the sync
+    :param changes: dict of "added", "modified" and "deleted" lists of file paths
+    """
+    self.delete(self.rows_of_files(changes.get("deleted", [])))
+
+    touched = set(changes.get("added", [])) | set(changes.get("modified", []))
+    if touched:
+      # Modified files keep their row index, their old record gets replaced
+      self.write(data, data.index[data["z-file"].isin(touched)])
+
+  def search(self, text: str, limit=50) -> list:
+    """
+    Full-text search, each word of text being matched as a prefix, accents and case ignored
+    :return: index of the matching contacts, best matches first
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+      return []
+
+    query = " ".join('"%s"*' % word for word in words)
+    with self._lock:
+      return [row for (row, ) in self._connection.execute(
+        "SELECT rowid FROM search WHERE search MATCH ? ORDER BY rank LIMIT ?", (query, limit))]
+
+  def load(self, rows=None) -> pd.DataFrame:
+    """
+    Read contacts back as an address book DataFrame
+    :param rows: index of the contacts to read. If None, read all contacts.
+    """
+    records = dict()
+
+    with self._lock:
+      if rows is None:
+        cursor = self._connection.execute("SELECT contact, name, value FROM properties")
+        self._collect(cursor, records)
+      else:
+        rows = list(rows)
+        for i in range(0, len(rows), CHUNK):
+          chunk = rows[i:i + CHUNK]
+          cursor = self._connection.execute(
+            "SELECT contact, name, value FROM properties WHERE contact IN (%s)" % ",".join("?" * len(chunk)),
+            chunk)
+          self._collect(cursor, records)
+
+    index = [row for row in rows if row in records] if rows is not None else sorted(records)
+    return pd.DataFrame([records[row] for row in index], index=pd.Index(index, dtype="int64"))
+
+  def _collect(self, cursor, records: dict):
+    for contact, name, value in cursor:
+      records.setdefault(contact, dict())[name] = json.loads(value)
+
+
+def _search_fields(row: dict) -> tuple:
+  address = " ".join(to_text(row.get(col)) for col in vcard.ADDRESS_COLUMNS)
+  return (" ".join([to_text(row.get("fn")), to_text(row.get("n")), to_text(row.get("nickname"))]),
+          to_text(row.get("org")),
+          to_text(row.get("email")),
+          to_text(row.get("tel")),
+          address,
+          to_text(row.get("note")),
+          to_text(row.get("categories")))
+
+
+def _is_missing(value) -> bool:
+  if isinstance(value, list):
+    return False
+  try:
+    return bool(pd.isna(value))
+  except (TypeError, ValueError):
+    return False
+
+
+def _scalar(value):
+  # numpy scalars to Python values, for sqlite and json
+  if hasattr(value, "item") and not isinstance(value, list):
+    return value.item()
+  return value
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+# Text forms of the cells of the address book, shared by the address book, the query engine,
+# the search indexes and the duplicates detection.
+
+import pandas as pd
+import unidecode
+
+from data import vcard
+
+# Columns holding lists of str, whatever their current cell: multi-valued and list properties,
+# the components of the addresses and the TYPE parameters in "<name>-type"
+LIST_COLUMNS = {name.lower() for name in vcard.MULTIVALUED | vcard.LISTS} | set(vcard.ADDRESS_COLUMNS)
+
+
+def is_list_column(col: str) -> bool:
+  return col in LIST_COLUMNS or col.endswith("-type")
+
+
+def to_text(value) -> str:
+  """Display a typed cell of the address book: lists are separated by commas, missing values are empty"""
+  if isinstance(value, list):
+    return ", ".join(str(elem) for elem in value)
+  if value is None or (isinstance(value, float) and value != value):
+    return ""
+  return str(value)
+
+
+def from_text(text: str, col: str):
+  """Parse a text edited by the user back to the type of the column, missing cells included"""
+  if is_list_column(col):
+    return [elem.strip() for elem in text.split(",") if elem.strip()]
+  return text
+
+
+def normalize(text: str) -> str:
+  return unidecode.unidecode(text).lower()
+
+
+def column_text(column: pd.Series) -> pd.Series:
+  """Vectorized `to_text()` for columns holding only text and missing values"""
+  if isinstance(column.dtype, pd.CategoricalDtype):
+    # Convert each category once
+    categories = [to_text(value) for value in column.cat.categories]
+    codes = column.cat.codes.to_numpy()
+    return pd.Series([categories[code] if code >= 0 else "" for code in codes], index=column.index, dtype=object)
+  if pd.api.types.infer_dtype(column, skipna=True) in ("string", "empty"):
+    return column.astype(object).where(column.notna(), "")
+  return pd.Series([to_text(value) for value in column], index=column.index, dtype=object)
+
+
+def normalize_series(text: pd.Series) -> pd.Series:
+  """Vectorized `normalize()`, calling unidecode only once per distinct non-ASCII value"""
+  text = text.str.lower()
+  accented = ~text.str.isascii().astype(bool)
+  if accented.any():
+    values = text[accented]
+    text[accented] = values.map({value: normalize(value) for value in values.unique()})
+  return text
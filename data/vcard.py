@@ -0,0 +1,615 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+# Lightweight vCard 3.0/4.0 tokenizer.
+# vobject builds a full tree of components and behaviours for each card, which we then
+# flatten anyway. This reads the content lines straight into plain Python values
+# and leaves anything unusual to vobject.
+
+import re
+import base64
+import datetime
+import unidecode
+
+
+# Structured properties: value split on unescaped ";"
+STRUCTURED = {"N", "ADR", "ORG", "GENDER", "CLIENTPIDMAP"}
+
+# List properties: value split on unescaped ","
+LISTS = {"CATEGORIES", "NICKNAME"}
+
+# Properties that may hold inline binary data
+BINARY = {"PHOTO", "LOGO", "SOUND", "KEY"}
+
+# Order of the components of structured names and addresses, as in RFC 6350
+NAME_ORDER = ("family", "given", "additional", "prefix", "suffix")
+ADDRESS_ORDER = ("box", "extended", "street", "city", "region", "code", "country")
+
+# Properties that commonly occur several times per card.
+# They are stored as lists, along with the list of their TYPE parameters in "<name>-type"
+MULTIVALUED = {"EMAIL", "TEL", "URL", "IMPP"}
+
+# Columns holding the components of the ADR properties, in ADDRESS_ORDER.
+# Each is a list with one element per address of the contact, "adr-type" holds their TYPE.
+ADDRESS_COLUMNS = ("adr-box", "adr-extended", "adr-street", "adr-locality", "adr-region", "adr-postcode", "adr-country")
+
+# group.NAME;PARAMS:value
+LINE = re.compile(r'^(?:([\w\-]+)\.)?([\w\-]+)((?:;(?:[^:;"]|"[^"]*")*)*):(.*)$', re.DOTALL)
+PARAM = re.compile(r';([^=;]+)(?:=((?:[^;"]|"[^"]*")*))?')
+PARAM_VALUE = re.compile(r'"([^"]*)"|([^,]+)')
+UNFOLD = re.compile(r'\r\n[ \t]|\n[ \t]|\r[ \t]')
+ESCAPE = re.compile(r'\\(.)', re.DOTALL)
+ESCAPED_CHARS = {"n": "\n", "N": "\n"}
+BINARY_LINE = re.compile(r'^(?:[\w\-]+\.)?(PHOTO|LOGO|SOUND|KEY)((?:;(?:[^:;"\r\n]|"[^"]*")*)*):',
+                         re.IGNORECASE | re.MULTILINE)
+LINE_END = re.compile(r'\r\n(?![ \t])|\n(?![ \t])|\r(?![\n \t])')
+TO_ESCAPE = re.compile(r'([\\;,])')
+PARAM_QUOTE = re.compile(r'[:;,]')
+
+# Maximal length of content lines, in octets, before folding
+LINE_LENGTH = 75
+
+# Columns that are not vCard properties, or are written from other columns
+NOT_PROPERTIES = {"changed", "adr-type", "rev", "begin", "end"} | {name.lower() + "-type" for name in MULTIVALUED}
+
+
+class Unsupported(Exception):
+    """The card uses features of the format the fast tokenizer doesn't handle"""
+    pass
+
+
+class Property():
+    """
+    A vCard content line reduced to plain Python values:
+    - name: upper-case property name,
+    - params: dict of upper-case parameter names -> list of values,
+    - value: str, or list of str for structured and list properties,
+      or base64 str for inline binary data,
+    - group: optional group name (item1.EMAIL -> "item1").
+
+    The representation mimics vobject's ContentLine so both backends produce the same
+    strings in the address book.
+    """
+    __slots__ = ("name", "params", "value", "group")
+
+    def __init__(self, name: str, params=None, value="", group=None):
+        self.name = name
+        self.params = params if params is not None else dict()
+        self.value = value
+        self.group = group
+
+    def is_binary(self) -> bool:
+        return self.name in BINARY and \
+            any(encoding.upper() in ("B", "BASE64") for encoding in self.params.get("ENCODING", []))
+
+    def value_repr(self) -> str:
+        if self.is_binary():
+            return " (BINARY %s DATA) " % self.name
+        if self.name == "N":
+            return format_name(self.value)
+        if self.name == "ADR":
+            return format_address(self.value)
+        return str(self.value)
+
+    def __repr__(self):
+        return "<{0}{1}{2}>".format(self.name, self.params, self.value_repr())
+
+    def __eq__(self, other):
+        return isinstance(other, Property) and \
+            (self.name, self.params, self.value, self.group) == (other.name, other.params, other.value, other.group)
+
+
+def format_name(value: list) -> str:
+    """Display a structured N value in English order, like vobject.vcard.Name"""
+    fields = dict(zip(NAME_ORDER, value))
+    return " ".join(fields.get(field, "") for field in ("prefix", "given", "additional", "family", "suffix"))
+
+
+def format_address(value: list) -> str:
+    """Display a structured ADR value on several lines, like vobject.vcard.Address"""
+    fields = dict(zip(ADDRESS_ORDER, value))
+    lines = "\n".join(fields[field] for field in ("box", "extended", "street") if fields.get(field))
+    lines += "\n{0!s}, {1!s} {2!s}".format(fields.get("city", ""), fields.get("region", ""), fields.get("code", ""))
+    if fields.get("country"):
+        lines += "\n" + fields["country"]
+    return lines
+
+
+def unescape(text: str) -> str:
+    """Remove the backslash escaping of text values: \\n, \\, \\; \\\\"""
+    if "\\" not in text:
+        return text
+    return ESCAPE.sub(lambda m: ESCAPED_CHARS.get(m.group(1), m.group(1)), text)
+
+
+def split_escaped(text: str, separator: str) -> list:
+    """Split text on the separators that are not backslash-escaped, and unescape the parts"""
+    if "\\" not in text:
+        return text.split(separator)
+
+    parts = []
+    current = []
+    escaped = False
+    for char in text:
+        if escaped:
+            current.append("\\" + char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == separator:
+            parts.append(unescape("".join(current)))
+            current = []
+        else:
+            current.append(char)
+    parts.append(unescape("".join(current)))
+    return parts
+
+
+def parse_params(text: str) -> dict:
+    params = dict()
+    for match in PARAM.finditer(text):
+        name = match.group(1).strip().upper()
+        if match.group(2) is None:
+            # vCard 2.1 singleton parameter (TEL;CELL:…)
+            raise Unsupported("Parameter without value: %s" % name)
+
+        values = [quoted or plain
+                  for quoted, plain in PARAM_VALUE.findall(match.group(2))]
+        params.setdefault(name, []).extend(values)
+
+    return params
+
+
+def parse_value(name: str, params: dict, value: str):
+    if "CHARSET" in params:
+        raise Unsupported("Charset parameter")
+
+    encoding = [e.upper() for e in params.get("ENCODING", [])]
+    if encoding:
+        if "QUOTED-PRINTABLE" in encoding:
+            raise Unsupported("Quoted-printable encoding")
+        if name in BINARY and ("B" in encoding or "BASE64" in encoding):
+            # Keep the base64 text as-is, without the folding whitespace
+            return re.sub(r"\s+", "", value)
+        raise Unsupported("Encoding %s" % encoding)
+
+    if name in STRUCTURED:
+        return split_escaped(value, ";")
+    if name in LISTS:
+        return split_escaped(value, ",")
+    return unescape(value)
+
+
+def binary_spans(content: str) -> dict:
+    """
+    Find the inline base64 values of the `BINARY` properties in the text of a card, without parsing it
+    :return: dict of lower-case property name -> list of (start, end) positions of the folded values in content
+    """
+    spans = dict()
+    for match in BINARY_LINE.finditer(content):
+        encoding = [e.upper() for e in parse_params(match.group(2)).get("ENCODING", [])]
+        if "B" not in encoding and "BASE64" not in encoding:
+            continue
+
+        end = LINE_END.search(content, match.end())
+        spans.setdefault(match.group(1).lower(), []).append((match.end(), end.start() if end else len(content)))
+
+    return spans
+
+
+def parse_vcard(content: str) -> dict:
+    """
+    Tokenize a single vCard 3.0 or 4.0 into a dict of lower-case property names -> list of `Property`,
+    like vobject's `Component.contents`.
+    :raise Unsupported: if the card needs the full vobject parser.
+    """
+    lines = UNFOLD.sub("", content).splitlines()
+    contents = dict()
+    depth = 0
+    cards = 0
+
+    for line in lines:
+        if not line.strip():
+            continue
+
+        match = LINE.match(line)
+        if match is None:
+            raise Unsupported("Malformed line: %s" % line)
+
+        group, name, params, value = match.groups()
+        # Some apps write accentuated characters in tags
+        name = unidecode.unidecode(name).upper()
+
+        if name == "BEGIN":
+            if value.strip().upper() != "VCARD" or depth > 0 or cards > 0:
+                # Nested components or several cards in one file
+                raise Unsupported("Unexpected BEGIN:%s" % value)
+            depth += 1
+            cards += 1
+            continue
+
+        if name == "END":
+            depth -= 1
+            continue
+
+        if depth != 1:
+            raise Unsupported("Content line outside of a card: %s" % line)
+
+        if name == "VERSION" and value.strip() not in ("3.0", "4.0"):
+            raise Unsupported("vCard version %s" % value)
+
+        params = parse_params(params)
+        contents.setdefault(name.lower(), []).append(
+            Property(name, params, parse_value(name, params, value), group))
+
+    if cards != 1 or depth != 0:
+        raise Unsupported("Incomplete card")
+
+    return contents
+
+
+def from_vobject(contents: dict) -> dict:
+    """
+    Convert vobject's `Component.contents` into the same dict of `Property` produced by `parse_vcard`,
+    so both backends can be compared and handled the same way.
+    """
+    properties = dict()
+
+    for key, lines in contents.items():
+        for line in lines:
+            name = line.name.upper()
+            value = line.value
+
+            if hasattr(value, "family") and name == "N":
+                value = [_join(getattr(value, field)) for field in NAME_ORDER]
+            elif hasattr(value, "street") and name == "ADR":
+                value = [_join(getattr(value, field)) for field in ADDRESS_ORDER]
+            elif isinstance(value, bytes):
+                value = base64.b64encode(value).decode("ascii")
+            elif isinstance(value, list):
+                value = [str(elem) for elem in value]
+            else:
+                value = str(value)
+
+            params = {param.upper(): values for param, values in line.params.items()}
+            properties.setdefault(key, []).append(Property(name, params, value, line.group))
+
+    return properties
+
+
+def flatten(contents: dict) -> dict:
+    """
+    Turn a dict of `Property`, as returned by `parse_vcard` or `from_vobject`, into a row of typed values
+    for the address book:
+    - ADR is split into the `ADDRESS_COLUMNS` lists, plus "adr-type",
+    - `MULTIVALUED` properties are lists of str, plus a list of their TYPE in "<name>-type",
+    - CATEGORIES and NICKNAME are lists of str,
+    - N is the display name, ORG the organization and units separated by commas,
+    - inline binary data stays base64 text,
+    - anything else is str, several occurrences are separated by new lines.
+    Other parameters are dropped.
+    """
+    row = dict()
+
+    for key, properties in contents.items():
+        name = properties[0].name
+
+        if name == "ADR":
+            for prop in properties:
+                value = _pad(prop.value, len(ADDRESS_ORDER))
+                for column, component in zip(ADDRESS_COLUMNS, value):
+                    row.setdefault(column, []).append(component)
+                row.setdefault("adr-type", []).append(_type(prop))
+
+        elif name in MULTIVALUED:
+            row[key] = [_join(prop.value) for prop in properties]
+            row[key + "-type"] = [_type(prop) for prop in properties]
+
+        elif name in LISTS:
+            row[key] = [elem for prop in properties for elem in _list(prop.value) if elem]
+
+        elif name == "N":
+            row[key] = "\n".join(" ".join(format_name(_pad(prop.value, len(NAME_ORDER))).split())
+                                 for prop in properties)
+
+        elif name == "ORG":
+            row[key] = "\n".join(", ".join(elem for elem in _list(prop.value) if elem)
+                                 for prop in properties)
+
+        elif name in STRUCTURED:
+            row[key] = "\n".join(";".join(_list(prop.value)) for prop in properties)
+
+        else:
+            row[key] = "\n".join(_join(prop.value) for prop in properties)
+
+    return row
+
+
+def _pad(value, length: int) -> list:
+    value = _list(value)
+    return value + [""] * (length - len(value))
+
+
+def _list(value) -> list:
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def _type(prop: Property) -> str:
+    return ",".join(prop.params.get("TYPE", []))
+
+
+def _join(value) -> str:
+    if isinstance(value, (list, tuple)):
+        return ",".join(value)
+    return value
+
+
+def escape(text: str) -> str:
+    """Backslash-escape a text value, the reverse of `unescape`"""
+    return TO_ESCAPE.sub(r"\\\1", text).replace("\r\n", "\\n").replace("\n", "\\n")
+
+
+def fold(line: str, newline="\r\n") -> str:
+    """Fold a content line in chunks of at most `LINE_LENGTH` octets, without splitting UTF-8 characters"""
+    if len(line) <= LINE_LENGTH // 4 or len(line.encode("utf-8")) <= LINE_LENGTH:
+        return line
+
+    chunks = []
+    chunk = ""
+    size = 0
+    limit = LINE_LENGTH
+    for char in line:
+        length = len(char.encode("utf-8"))
+        if size + length > limit:
+            chunks.append(chunk)
+            chunk = ""
+            size = 0
+            # Continuation lines start with a space
+            limit = LINE_LENGTH - 1
+        chunk += char
+        size += length
+    chunks.append(chunk)
+
+    return (newline + " ").join(chunks)
+
+
+def format_property(name: str, params: dict, value: str, group=None) -> str:
+    """Write a content line, value being already escaped"""
+    line = (group + "." if group else "") + name.upper()
+    for param, values in params.items():
+        values = ['"%s"' % elem if PARAM_QUOTE.search(elem) else elem for elem in values if elem]
+        if values:
+            line += ";%s=%s" % (param.upper(), ",".join(values))
+    return line + ":" + value
+
+
+def _is_empty(value) -> bool:
+    if isinstance(value, (list, tuple)):
+        return not any(elem for elem in value)
+    return value is None or value == "" or (isinstance(value, float) and value != value)
+
+
+def _group_values(row: dict, group: str):
+    """Values of the columns of a group of the row, comparable between rows, or None if empty"""
+    if group == "adr":
+        values = tuple(None if _is_empty(row.get(col)) else tuple(row[col])
+                       for col in ADDRESS_COLUMNS + ("adr-type", ))
+        return None if all(value is None for value in values[:-1]) else values
+    if group.upper() in MULTIVALUED:
+        value = row.get(group)
+        return None if _is_empty(value) else (tuple(value), tuple(row.get(group + "-type") or ()))
+
+    value = row.get(group)
+    if _is_empty(value):
+        return None
+    if group.upper() in ("N", "ORG"):
+        # Names edited as "family;given;additional;prefix;suffix" are unchanged if they display the same
+        return tuple(_display(group.upper(), _split_components(group.upper(), text.strip()))
+                     for text in str(value).split("\n"))
+    return tuple(value) if isinstance(value, list) else str(value)
+
+
+def _groups(row: dict) -> set:
+    groups = set()
+    for key in row:
+        if key.startswith("z-") or key in NOT_PROPERTIES:
+            continue
+        groups.add("adr" if key in ADDRESS_COLUMNS else key)
+    return groups
+
+
+def _kept(original: list, i: int, types=None) -> tuple:
+    """
+    Parameters and group of the i-th original property of a group, to write it again
+    :param types: TYPE of each property, from the "<name>-type" column, replacing the original ones if given
+    :return: tuple(params, group)
+    """
+    if i >= len(original):
+        params, line_group = dict(), None
+    else:
+        params = {key: values for key, values in original[i].params.items() if key not in ("CHARSET", "TYPE")}
+        line_group = original[i].group
+        if types is None and "TYPE" in original[i].params:
+            params["TYPE"] = original[i].params["TYPE"]
+
+    if types is not None and i < len(types) and types[i]:
+        params["TYPE"] = types[i].split(",")
+
+    return params, line_group
+
+
+def _display(name: str, components: list) -> str:
+    """Text of the N or ORG column for the components of a property, as written by `flatten`"""
+    if name == "N":
+        return " ".join(format_name(_pad(components, len(NAME_ORDER))).split())
+    return ", ".join(elem for elem in _list(components) if elem)
+
+
+def _components(name: str, text: str, original=None) -> list:
+    """
+    Components of the N or ORG property edited as `text`, the reverse of `_display`:
+    - the original components, if their display didn't change: prefixes, suffixes or empty units
+      can't be told apart from the display,
+    - for N, the components separated by ";", as in the vCard "family;given;additional;prefix;suffix",
+    - for ORG, the organization and units separated by commas, like `flatten` joined them.
+    A changed name needs its components: they are not guessed from the display.
+    :return: list of str, empty if the text is empty
+    """
+    text = text.strip()
+    if not text:
+        return []
+    if original is not None and _display(name, original.value) == _display(name, _split_components(name, text)):
+        return _list(original.value)
+
+    if name == "N" and ";" not in text:
+        raise ValueError("the structured name '%s' changed: write it as family;given;additional;prefix;suffix"
+                         % text)
+    return _split_components(name, text)
+
+
+def _split_components(name: str, text: str) -> list:
+    if name == "ORG":
+        return [elem.strip() for elem in text.split(", ")]
+    if ";" in text:
+        return [elem.strip() for elem in text.split(";")]
+    # Display text of the name
+    return ["", text, "", "", ""]
+
+
+def to_properties(group: str, row: dict, original=None) -> list:
+    """
+    Write the content lines of a group of columns of a row, the reverse of `flatten`.
+    :param original: list of the `Property` of the group in the card being patched,
+    whose groups and parameters are kept. Multi-valued properties keep the ones at the same rank,
+    with the TYPE of their "<name>-type" column.
+    """
+    name = group.upper()
+    original = original or []
+    params, line_group = _kept(original, 0)
+
+    if name == "ADR":
+        addresses = zip(*[_pad(row.get(col) if isinstance(row.get(col), list) else [], 0) for col in ADDRESS_COLUMNS])
+        types = row.get("adr-type") if isinstance(row.get("adr-type"), list) else []
+        lines = []
+        for i, address in enumerate(addresses):
+            params, line_group = _kept(original, i, types)
+            lines.append(format_property(name, params, ";".join(escape(component) for component in address),
+                                         line_group))
+        return lines
+
+    value = row.get(group)
+
+    # Cleared by the user: drop the property
+    if _is_empty(value):
+        return []
+
+    if name in MULTIVALUED:
+        values = value if isinstance(value, list) else [value]
+        types = row.get(group + "-type") if isinstance(row.get(group + "-type"), list) else []
+        lines = []
+        for i, elem in enumerate(values):
+            if elem:
+                params, line_group = _kept(original, i, types)
+                lines.append(format_property(name, params, escape(str(elem)), line_group))
+        return lines
+
+    if name in LISTS:
+        values = value if isinstance(value, list) else [elem.strip() for elem in str(value).split(",")]
+        values = [elem for elem in values if elem]
+        if not values:
+            return []
+        return [format_property(name, params, ",".join(escape(elem) for elem in values), line_group)]
+
+    if name in ("N", "ORG"):
+        # Several occurrences are separated by new lines
+        lines = []
+        for i, text in enumerate(str(value).split("\n")):
+            components = _components(name, text, original[i] if i < len(original) else None)
+            if components:
+                params, line_group = _kept(original, i)
+                lines.append(format_property(name, params, ";".join(escape(elem) for elem in components),
+                                             line_group))
+        return lines
+
+    if name in STRUCTURED:
+        return [format_property(name, params, ";".join(escape(part) for part in str(value).split(";")), line_group)]
+
+    if isinstance(value, list):
+        value = ",".join(str(elem) for elem in value)
+
+    if original and original[0].is_binary():
+        return [format_property(name, params, str(value), line_group)]
+
+    return [format_property(name, params, escape(str(value)), line_group)]
+
+
+def patch_vcard(content: str, row: dict, contents: dict) -> str:
+    """
+    Update the text of a single vCard with the values of a row of the address book.
+    Only the properties whose columns differ from the card are written again,
+    the other lines are kept as-is, and REV is set to the current time.
+    :param content: text of the card
+    :param row: dict of column -> value
+    :param contents: the card parsed by `parse_vcard` or `from_vobject`
+    :return: the new text, or the same text if nothing changed
+    """
+    original = flatten(contents)
+    changed = {group for group in _groups(original) | _groups(row)
+               if _group_values(original, group) != _group_values(row, group)}
+    if not changed:
+        return content
+
+    newline = "\r\n" if "\r\n" in content else "\n"
+    rev = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+    def write(group):
+        return [fold(line, newline) for line in to_properties(group, row, contents.get(group))]
+
+    # Logical lines, as lists of physical lines
+    lines = []
+    for line in content.splitlines():
+        if line[:1] in (" ", "\t") and lines:
+            lines[-1].append(line)
+        else:
+            lines.append([line])
+
+    output = []
+    written = set()
+    for physical in lines:
+        match = LINE.match(UNFOLD.sub("", newline.join(physical)))
+        key = unidecode.unidecode(match.group(2)).lower() if match else ""
+
+        if key == "end":
+            # Properties that were not in the card yet
+            for group in sorted(changed - written):
+                output += write(group)
+            written |= changed
+            output.append(format_property("REV", dict(), rev))
+        elif key == "rev":
+            continue
+        elif key in changed:
+            if key not in written:
+                output += write(key)
+                written.add(key)
+            continue
+
+        output += physical
+
+    return newline.join(output) + (newline if content.endswith(("\n", "\r")) else "")
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import threading
+
+try:
+  from watchdog.observers import Observer
+  from watchdog.events import FileSystemEventHandler
+except ImportError:
+  Observer = None
+  FileSystemEventHandler = object
+
+
+class _EventHandler(FileSystemEventHandler):
+  def __init__(self, watcher):
+    super().__init__()
+    self.watcher = watcher
+
+  def on_any_event(self, event):
+    if event.is_directory:
+      return
+
+    self.watcher.touch(event.src_path)
+
+    # Renames report both ends: the old file is deleted, the new one is added
+    if getattr(event, "dest_path", None):
+      self.watcher.touch(event.dest_path)
+
+
+class DirectoryWatcher():
+  """
+  Watch a directory of .vcf files and report the paths of the files added, modified or deleted.
+
+  Events are received from the OS (inotify on Linux) through the optional `watchdog` package,
+  or by periodically comparing the `os.stat()` of the files if it is not installed.
+  Bursts of events, like a CardDAV sync writing hundreds of files, are debounced:
+  the callback is called once with all the touched paths after `debounce` seconds without new event.
+
+  The callback is called from a background thread.
+  """
+
+  def __init__(self, directory: str, callback, debounce=2., interval=10., polling=False):
+    """
+    :param directory: directory to watch
+    :param callback: function taking a set of touched paths
+    :param debounce: seconds of quiet to wait before reporting the touched paths
+    :param interval: seconds between two scans of the directory, when polling
+    :param polling: force polling even if OS events are available
+    """
+    self.directory = directory
+    self.callback = callback
+    self.debounce = debounce
+    self.interval = interval
+    self.polling = polling or Observer is None
+
+    self._lock = threading.Lock()
+    self._touched = set()
+    self._timer = None
+    self._stop = threading.Event()
+    self._observer = None
+    self._thread = None
+
+  def start(self):
+    self._stop.clear()
+
+    if self.polling:
+      self._thread = threading.Thread(target=self._poll, daemon=True)
+      self._thread.start()
+    else:
+      self._observer = Observer()
+      self._observer.schedule(_EventHandler(self), self.directory, recursive=False)
+      self._observer.daemon = True
+      self._observer.start()
+
+  def stop(self):
+    self._stop.set()
+
+    if self._observer is not None:
+      self._observer.stop()
+      self._observer.join()
+      self._observer = None
+
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+    with self._lock:
+      if self._timer is not None:
+        self._timer.cancel()
+        self._timer = None
+      self._touched.clear()
+
+  def touch(self, path: str):
+    """Record a touched path and restart the debouncing delay"""
+    if not path.endswith(".vcf"):
+      return
+
+    with self._lock:
+      self._touched.add(os.path.join(self.directory, os.path.basename(path)))
+
+      if self._timer is not None:
+        self._timer.cancel()
+
+      self._timer = threading.Timer(self.debounce, self._flush)
+      self._timer.daemon = True
+      self._timer.start()
+
+  def _flush(self):
+    with self._lock:
+      touched = self._touched
+      self._touched = set()
+      self._timer = None
+
+    if touched and not self._stop.is_set():
+      self.callback(touched)
+
+  def _scan(self) -> dict:
+    files = dict()
+    with os.scandir(self.directory) as entries:
+      for entry in entries:
+        if entry.name.endswith(".vcf"):
+          try:
+            stat = entry.stat()
+          except FileNotFoundError:
+            continue
+          files[entry.path] = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    return files
+
+  def _poll(self):
+    previous = self._scan()
+
+    while not self._stop.wait(self.interval):
+      current = self._scan()
+
+      for path, stat in current.items():
+        if previous.get(path) != stat:
+          self.touch(path)
+
+      for path in previous:
+        if path not in current:
+          self.touch(path)
+
+      previous = current
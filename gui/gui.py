@@ -43,9 +43,19 @@ from gui.table import *
 from data import preferences
 from data import contact
 from data import addressbook as ab
+from data.manifest import FileManifest
+from data.watcher import DirectoryWatcher
+from data.snapshot import Snapshot
+from data.journal import Journal
+from data import geoservice
+from data import geocoders
+from data.store import SQLiteStore
+from data.query import QueryError
 
 class GuiEvents(QObject):
   DataChanged = Signal()
+  FilesChanged = Signal(object)
+  GeoLocated = Signal(object)
 
 class AppWindow(QMainWindow):
   def set_address_book(self, data):
@@ -54,12 +64,57 @@ class AppWindow(QMainWindow):
     # Raise the signal DataChanged so we can update the Table view
     self.signals.DataChanged.emit()
 
+  def recover_address_book(self, data):
+    # Replay the edits journaled after the last snapshot, lost if the app crashed
+    data, rows, conflicts = self.journal.recover(data)
+    if rows:
+      print("recovered unsaved edits of %i contacts" % len(rows))
+    for change in conflicts:
+      print("could not recover the edit of %s in %s: the contact changed since" % (change["c"], change["f"]))
+    if self.store_pending is not None:
+      self.store_pending |= set(rows)
+
+    self.set_address_book(data)
+
+  def patch_address_book(self, data, base, paths):
+    # Only the rows of the touched files changed: merge them in the book, keeping the cells edited
+    # while the files were synced, and patch the view instead of filtering the book again
+    rows = base.index[base["z-file"].isin(paths)].union(data.index[data["z-file"].isin(paths)])
+    edited = self.addressbook.merge_rows(data, rows, base)
+    self.signals.DataChanged.emit()
+
+    # The sync wrote these rows to the store as they are in their file
+    if len(edited) > 0:
+      self.spawn_store_thread(edited)
+
+    # The indexes and the store are updated with these rows only: just locate them
+    self.geocoder.submit(self.addressbook.addressDB, rows, geoservice.BACKGROUND)
+
+  def filter_changed(self, text):
+    try:
+      self.addressbook.query = text
+    except QueryError as error:
+      # Keep the previous view while the query is being typed
+      self.filter.setToolTip(str(error))
+      return
+
+    self.filter.setToolTip("")
+    self.make_tree_view()
+
+  def search_changed(self, text):
+    self.addressbook.search_text = text
+    self.make_tree_view()
+
   def spawn_vcf_files_thread(self):
-    # Get the VCF files
+    # Get the VCF files. The rows get new indexes: the store is written again from scratch.
+    self.store_pending = None
     self.startProgress()
     self.event_stop.clear()
-    worker = Worker(self.mutex, self.wait, self.event_stop, contact.list_vcf_in_directory, self.preferences.dict["directory"])
-    worker.signals.result.connect(self.set_address_book)
+    worker = Worker(self.mutex, self.wait, self.event_stop, contact.list_vcf_in_directory, self.preferences.dict["directory"],
+                    workers=self.preferences.dict.get("workers", os.cpu_count()),
+                    manifest=self.manifest,
+                    backend=self.preferences.dict.get("parser", contact.DEFAULT_BACKEND))
+    worker.signals.result.connect(self.recover_address_book)
     worker.signals.progress.connect(self.updateProgress)
     worker.signals.finished.connect(self.spawn_clean_contacts_db_thread)
     self.threadpool.start(worker)
@@ -71,27 +126,116 @@ class AppWindow(QMainWindow):
     worker = Worker(self.mutex, self.wait, self.event_stop,
                     contact.update_vcf_in_directory,
                     self.preferences.dict["directory"],
-                    self.addressbook.addressDB)
+                    self.addressbook.addressDB,
+                    manifest=self.manifest,
+                    backend=self.preferences.dict.get("parser", contact.DEFAULT_BACKEND),
+                    store=self.store)
     worker.signals.result.connect(self.set_address_book)
     worker.signals.progress.connect(self.updateProgress)
     worker.signals.finished.connect(self.spawn_clean_contacts_db_thread)
     self.threadpool.start(worker)
 
+  def spawn_vcf_files_update_thread(self, paths):
+    # Update only the files reported by the directory watcher, in the background.
+    # The sync works on a copy of the book, so the user can keep editing it meanwhile.
+    base = self.addressbook.addressDB.copy()
+    worker = Worker(self.mutex, self.wait, self.event_stop,
+                    contact.update_vcf_in_directory,
+                    self.preferences.dict["directory"],
+                    base,
+                    manifest=self.manifest,
+                    backend=self.preferences.dict.get("parser", contact.DEFAULT_BACKEND),
+                    paths=paths,
+                    store=self.store)
+    worker.signals.result.connect(lambda data: self.patch_address_book(data, base, paths))
+    self.threadpool.start(worker)
+
+  def files_changed(self, paths):
+    # Called in the GUI thread for files touched on disk by a background sync
+    self.pending_paths |= set(paths)
+
+    # The data is passed to workers when they are created:
+    # wait for running workers to finish before reading it
+    if self.threadpool.activeThreadCount() > 0:
+      QTimer.singleShot(1000, lambda: self.files_changed(set()))
+      return
+
+    if self.pending_paths:
+      paths = self.pending_paths
+      self.pending_paths = set()
+      self.spawn_vcf_files_update_thread(paths)
+
+  def start_watcher(self):
+    if self.watcher is not None:
+      self.watcher.stop()
+
+    # The watcher calls back from its own thread: go through a signal to get back in the GUI thread
+    self.watcher = DirectoryWatcher(self.preferences.dict["directory"], self.signals.FilesChanged.emit,
+                                    polling=self.preferences.dict.get("watcher polling", False))
+    self.watcher.start()
+
   def spawn_clean_contacts_db_thread(self):
     self.startProgress()
     self.event_stop.clear()
     worker = Worker(self.mutex, self.wait, self.event_stop, contact.cleanup_contact, self.addressbook.addressDB)
     worker.signals.result.connect(self.set_address_book)
     worker.signals.progress.connect(self.updateProgress)
-    worker.signals.finished.connect(self.spawn_geolocation_thread)
+    worker.signals.finished.connect(self.contacts_cleaned)
     self.threadpool.start(worker)
 
-  def spawn_geolocation_thread(self):
-    self.startProgress()
-    self.event_stop.clear()
-    worker = Worker(self.mutex, self.wait, self.event_stop, contact.get_geoID, self.addressbook.addressDB)
-    worker.signals.result.connect(self.set_address_book)
-    worker.signals.progress.connect(self.updateProgress)
+  def contacts_cleaned(self):
+    # The book was replaced: its indexes are built again from scratch
+    self.spawn_store_thread()
+    self.spawn_search_index_thread()
+    self.geolocate_contacts()
+
+  def geolocate_contacts(self):
+    # Queue the contacts to locate to the geocoding service. It runs in its own thread
+    # without holding the mutex, so the other workers don't wait for the rate-limited lookups.
+    self.geocoder.submit(self.addressbook.addressDB, self.addressbook.addressDB.index, geoservice.BACKGROUND)
+    self.prioritize_visible()
+
+  def prioritize_visible(self):
+    # Locate the contacts shown in the table first
+    if self.geocoder is None:
+      return
+
+    first = self.table.rowAt(0)
+    if first < 0:
+      return
+    last = self.table.rowAt(self.table.viewport().height())
+    if last < 0:
+      last = self.model.rowCount(None) - 1
+
+    rows = self.addressbook.addressView.index[first:last + 1]
+    self.geocoder.submit(self.addressbook.addressDB, rows, geoservice.VISIBLE)
+
+  def geolocated(self, results):
+    # Called in the GUI thread with a batch of locations found by the geocoding service
+    if self.addressbook.set_locations(results):
+      self.model.layoutChanged.emit()
+
+  def spawn_search_index_thread(self):
+    # Index the book in the background so the first search or lookup doesn't wait for it
+    for name in ("search", "lookup"):
+      worker = Worker(self.mutex, self.wait, self.event_stop, self.addressbook.build_index, name)
+      self.threadpool.start(worker)
+
+  def spawn_store_thread(self, rows=()):
+    # The syncs of files update the store with their changes, and edits and locations are written
+    # as they happen: write the other changed rows, or the whole book if it was built from the files
+    if self.store is None:
+      return
+
+    pending = self.store_pending
+    self.store_pending = set()
+    if pending is not None:
+      pending = sorted(pending | set(rows))
+      if not pending:
+        return
+
+    worker = Worker(self.mutex, self.wait, self.event_stop, self.store.write, self.addressbook.addressDB,
+                    rows=pending)
     self.threadpool.start(worker)
 
   def build_address_book(self):
@@ -99,21 +243,135 @@ class AppWindow(QMainWindow):
     file_name = os.path.basename(os.path.normpath(self.preferences.dict["directory"]))
     data_path = os.path.join(self.preferences.pref_path, file_name)
 
-    if os.path.isfile(data_path):
+    # Look for the state of the files at the time of the previous run
+    self.manifest = FileManifest(data_path + ".manifest")
+    self.snapshot = Snapshot(data_path + ".arrow")
+
+    # Journal of the edits, for undo and to recover the ones not saved yet after a crash
+    self.journal = Journal(data_path + ".journal")
+    self.addressbook.journal = self.journal
+
+    # Locate the contacts in the background. The locations are handed back through a signal
+    # to get back in the GUI thread, and saved with the next checkpoint of the snapshot.
+    self.geocoder = geoservice.GeocodingService(self.signals.GeoLocated.emit,
+                                                backend=geocoders.make_geocoder(self.preferences.dict.get("geocoder")),
+                                                refresh=int(self.preferences.dict.get("geocache refresh", 600)))
+    self.geocoder.start()
+    self.addressbook.geocoder = self.geocoder
+
+    # Optional SQLite storage with a full-text index for searching
+    if self.preferences.dict.get("storage") == "sqlite":
+      self.store = SQLiteStore(data_path + ".sqlite")
+      self.addressbook.store = self.store
+      self.store_pending = set() if len(self.store) > 0 else None
+
+    data = None
+    if self.snapshot.exists():
       # Load the cached DB
-      data = pd.read_pickle(data_path).astype(str)
-      self.set_address_book(data)
+      try:
+        data = self.snapshot.load()
+      except ValueError:
+        # Snapshot from another version: rebuild it from files
+        self.manifest.dict = dict()
+    elif os.path.isfile(data_path):
+      # Load the cached DB saved by older versions
+      data = pd.read_pickle(data_path)
+
+      # Cached DB from older versions hold stringified vCard tags, not typed columns:
+      # rebuild it from files
+      if contact.is_legacy_frame(data):
+        data = None
+        self.manifest.dict = dict()
+
+    if data is not None:
+      self.recover_address_book(data)
 
       # Update files
       self.spawn_vcf_update_thread()
     else:
       self.spawn_vcf_files_thread()
 
+    # Keep the book current with changes made on disk by other apps
+    self.start_watcher()
+
+    # Save the changes on disk regularly, so a crash doesn't lose them
+    self.checkpoint_timer.start(int(self.preferences.dict.get("checkpoint interval", 300)) * 1000)
+
+  def spawn_checkpoint_thread(self):
+    rows = self.addressbook.dirty
+    self.addressbook.dirty = set()
+    upto = self.journal.seq
+    worker = Worker(self.mutex, self.wait, self.event_stop,
+                    self.snapshot.checkpoint,
+                    self.addressbook.addressDB,
+                    rows=rows)
+    # The journaled edits are now in the snapshot
+    worker.signals.result.connect(lambda result: self.journal.mark_snapshot(upto))
+    self.threadpool.start(worker)
+
+  def undo(self):
+    if self.addressbook.undo() is not None:
+      self.make_tree_view()
+
+  def redo(self):
+    if self.addressbook.redo() is not None:
+      self.make_tree_view()
+
+  def spawn_commit_thread(self):
+    # Write the edited contacts back to their .vcf files
+    self.startProgress()
+    self.event_stop.clear()
+    # The files are written from a copy of the book: the edits made meanwhile are merged back after
+    base = self.addressbook.addressDB.copy()
+    worker = Worker(self.mutex, self.wait, self.event_stop,
+                    contact.commit_vcf_changes,
+                    base,
+                    manifest=self.manifest,
+                    workers=self.preferences.dict.get("workers", os.cpu_count()),
+                    backend=self.preferences.dict.get("parser", contact.DEFAULT_BACKEND))
+    # The edits journaled until now are the ones being written
+    upto = self.journal.seq
+    worker.signals.result.connect(lambda result: self.changes_committed(result, base, upto))
+    worker.signals.progress.connect(self.updateProgress)
+    self.threadpool.start(worker)
+
+  def changes_committed(self, result, base, upto):
+    data, failures = result
+    rows = self.addressbook.merge_committed(data, base)
+    self.journal.mark_commit(base.loc[rows, "z-file"].tolist(), upto)
+    self.signals.DataChanged.emit()
+    self.spawn_store_thread(rows)
+
+    if failures:
+      QMessageBox.warning(self, self.tr("Some contacts could not be saved"),
+                          "\n".join("%s: %s" % (path, error) for path, error in sorted(failures.items())))
+
+  def spawn_vcf_import_thread(self, path):
+    # Append all the cards of a single .vcf file to the current book
+    self.startProgress()
+    self.event_stop.clear()
+    worker = Worker(self.mutex, self.wait, self.event_stop,
+                    contact.import_vcf_file,
+                    path,
+                    self.addressbook.addressDB,
+                    backend=self.preferences.dict.get("parser", contact.DEFAULT_BACKEND))
+    worker.signals.result.connect(self.vcf_imported)
+    worker.signals.progress.connect(self.updateProgress)
+    worker.signals.finished.connect(self.spawn_clean_contacts_db_thread)
+    self.threadpool.start(worker)
+
+  def vcf_imported(self, data):
+    # The imported cards are new rows, written to the store after the cleanup
+    if self.store_pending is not None:
+      self.store_pending |= set(data.index.difference(self.addressbook.addressDB.index))
+    self.set_address_book(data)
+
   def make_tree_view(self):
     # Create the data model with the view
     self.model = TableModel(self.addressbook)
     self.table.setModel(self.model)
     self.update()
+    self.prioritize_visible()
 
   def open_local_directory(self):
     self.preferences.dict["directory"] = QFileDialog.getExistingDirectory(self, self.tr("Open Directory"),
@@ -121,19 +379,35 @@ class AppWindow(QMainWindow):
                                     QFileDialog.ShowDirsOnly | QFileDialog.DontResolveSymlinks)
     self.preferences.dict["method"] = "local directory"
 
+  def import_local_file(self):
+    path, filter = QFileDialog.getOpenFileName(self, self.tr("Import contacts"),
+                                               "/home", self.tr("vCard files (*.vcf)"))
+    if path:
+      self.spawn_vcf_import_thread(path)
+
   def set_file_menu(self):
     #self.fileMenu.addAction(self.tr("Open a book from a single file (.vcf)"), self.open_local_directory)
     self.fileMenu.addAction(self.tr("Open a book from a local directory"), self.open_local_directory)
+    self.fileMenu.addAction(self.tr("Import contacts from a file (.vcf)"), self.import_local_file)
+    save = self.fileMenu.addAction(self.tr("Save changes to the files"), self.spawn_commit_thread)
+    save.setShortcut(QKeySequence.Save)
     #self.fileMenu.addAction(self.tr("Open a book from a remote directory (CardDAV)"))
 
+  def set_edit_menu(self):
+    undo = self.editMenu.addAction(self.tr("Undo"), self.undo)
+    undo.setShortcut(QKeySequence.Undo)
+    redo = self.editMenu.addAction(self.tr("Redo"), self.redo)
+    redo.setShortcut(QKeySequence.Redo)
+
   def set_menu(self):
     self.menuBar = QMenuBar()
     self.setMenuBar(self.menuBar)
     self.fileMenu = self.menuBar.addMenu(self.tr("&File"))
-    #self.editMenu = self.menuBar.addMenu(self.tr("&Edit"))
+    self.editMenu = self.menuBar.addMenu(self.tr("&Edit"))
     #self.helpMenu = self.menuBar.addMenu(self.tr("&Help"))
 
     self.set_file_menu()
+    self.set_edit_menu()
 
   def startProgress(self):
     self.progress = QProgressDialog(self)
@@ -236,11 +510,39 @@ class AppWindow(QMainWindow):
     self.centralLayout.addWidget(self.tabs)
 
     # Create the Table widget
-    self.addressbook = ab.addressBook()
+    self.addressbook = ab.addressBook(region=self.preferences.dict.get("phone region"))
+    self.manifest = FileManifest()
+    self.watcher = None
+    self.pending_paths = set()
+    self.snapshot = None
+    self.journal = None
+    self.store = None
+    # Rows to write to the store, not written by the syncs of files, or None for the whole book
+    self.store_pending = set()
+    self.geocoder = None
+    self.checkpoint_timer = QTimer(self)
+    self.checkpoint_timer.timeout.connect(self.spawn_checkpoint_thread)
+    # Journaled edits are fsynced by groups: make the last ones durable soon too
+    self.journal_timer = QTimer(self)
+    self.journal_timer.timeout.connect(lambda: self.journal.flush() if self.journal is not None else None)
+    self.journal_timer.start(1000)
     self.table = QTableView()
     self.model = TableModel(self.addressbook)
     self.table.setModel(self.model)
+    self.table.verticalScrollBar().valueChanged.connect(lambda value: self.prioritize_visible())
+    self.filter = QLineEdit()
+    self.filter.setPlaceholderText(self.tr("Filter: name, org:acme, category:vip, email:/\\.fr$/, a OR b, NOT c…"))
+    self.filter.setClearButtonEnabled(True)
+    self.filter.textChanged.connect(self.filter_changed)
+    self.search = QLineEdit()
+    self.search.setPlaceholderText(self.tr("Search names, organizations, emails, phones, addresses…"))
+    self.search.setClearButtonEnabled(True)
+    self.search.textChanged.connect(self.search_changed)
+    bar = QHBoxLayout()
+    bar.addWidget(self.search)
+    bar.addWidget(self.filter)
     layout = QVBoxLayout()
+    layout.addLayout(bar)
     layout.addWidget(self.table)
     self.tabList.setLayout(layout)
 
@@ -265,6 +567,8 @@ class AppWindow(QMainWindow):
     self.signals = GuiEvents()
     self.signals.DataChanged.connect(self.make_tree_view)
     self.signals.DataChanged.connect(self.add_map_markers)
+    self.signals.FilesChanged.connect(self.files_changed)
+    self.signals.GeoLocated.connect(self.geolocated)
 
     # Finally, try to load some data
     if "directory" not in self.preferences.dict:
@@ -277,13 +581,35 @@ class AppWindow(QMainWindow):
 
 
   def closeEvent(self, event):
+    if self.watcher is not None:
+      self.watcher.stop()
+
+    # Keep the locations found since the last batch
+    if self.geocoder is not None:
+      self.addressbook.set_locations(self.geocoder.stop())
+
     # Save preferences
     self.preferences.write_preferences()
 
     # Save the dataframe for later use
+    self.checkpoint_timer.stop()
+    if self.snapshot is None:
+      return
+
+    self.snapshot.save(self.addressbook.addressDB)
+    self.manifest.write_manifest()
+
+    self.journal.mark_snapshot()
+    self.journal.close()
+
+    if self.store is not None:
+      self.store.close()
+
+    # Remove the cache of older versions, now replaced by the snapshot
     file_name = os.path.basename(os.path.normpath(self.preferences.dict["directory"]))
     data_path = os.path.join(self.preferences.pref_path, file_name)
-    self.addressbook.addressDB.to_pickle(data_path)
+    if os.path.isfile(data_path):
+      os.remove(data_path)
 
 
 def GUI_Start(base_dir=""):
@@ -20,7 +20,19 @@ from PySide6.QtWidgets import *
 from PySide6.QtGui import *
 from PySide6.QtCore import *
 
-from data.addressbook import addressBook
+from data.addressbook import addressBook, to_text
+from data import binary
+from data.cache import LRUCache
+
+# Photos and logos are read from their file only when displayed, and their thumbnails cached
+THUMBNAIL_SIZE = 32
+thumbnails = LRUCache(512)
+
+
+def make_thumbnail(reference: str) -> QPixmap:
+  # Several images are separated by new lines: show the first one
+  image = QImage.fromData(binary.read_binary(reference.split("\n")[0]))
+  return QPixmap.fromImage(image.scaled(THUMBNAIL_SIZE, THUMBNAIL_SIZE, Qt.KeepAspectRatio, Qt.SmoothTransformation))
 
 
 # Qt Treeview model for a Pandas DataFrame
@@ -33,7 +45,16 @@ class TableModel(QAbstractTableModel):
   def data(self, index, role):
     if role == Qt.DisplayRole or role == Qt.EditRole:
       value = self._data.addressView.iloc[index.row(), index.column()]
-      return str(value)
+      return "" if binary.is_reference(value) else to_text(value)
+
+    if role == Qt.DecorationRole:
+      value = self._data.addressView.iloc[index.row(), index.column()]
+      if binary.is_reference(value):
+        try:
+          return thumbnails.get(value, make_thumbnail)
+        except (OSError, ValueError):
+          # The file changed or disappeared since it was parsed
+          return None
 
   def rowCount(self, index):
     return self._data.addressView.shape[0]
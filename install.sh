@@ -4,8 +4,12 @@ python -m pip install vobject
 python -m pip install pyside6
 python -m pip install QtAwesome
 python -m pip install pandas
+python -m pip install pyarrow
 python -m pip install Unidecode
 python -m pip install folium
 python -m pip install country_list
 python -m pip install urllib3
+python -m pip install xxhash
+python -m pip install watchdog
+python -m pip install phonenumbers
 pythom -m pip install hashlib
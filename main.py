@@ -4,4 +4,6 @@ __version__ = "0.1.0-alpha"
 
 from gui import gui
 
-gui.GUI_Start()
+# Guard the entry point: the vCard parsing worker processes re-import this module
+if __name__ == "__main__":
+  gui.GUI_Start()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+
+from data import addressbook as ab
+from data import contact
+from data.snapshot import Snapshot
+
+
+def sample_book() -> pd.DataFrame:
+  return pd.DataFrame({
+    "fn": ["Ada Lovelace", "Alan Turing"],
+    "email": [["ada@example.org"], ["alan@example.org"]],
+    "z-file": ["ada.vcf", "alan.vcf"],
+  })
+
+
+class IncrementalIndexesTest(unittest.TestCase):
+
+  def test_synced_rows_update_the_indexes(self):
+    # As after a sync of the files reported by the watcher: Ada deleted, Alan modified, Grace added
+    book = ab.addressBook()
+    book.addressDB = sample_book()
+    self.assertEqual(book.search("ada").index.tolist(), [0])
+    self.assertEqual(book.lookup(["alan@example.org"]), [[1]])
+    indexes = dict(book._indexes)
+
+    data = sample_book()
+    data.loc[1, "email"] = ["turing@example.org"]
+    data.loc[2] = ["Grace Hopper", ["grace@example.org"], "grace.vcf"]
+    data = data.drop(index=0)
+    book.update_addressDB(data, pd.Index([0, 1, 2]))
+
+    # Updated in place, not built again
+    self.assertIs(book._indexes["search"], indexes["search"])
+    self.assertIs(book._indexes["lookup"], indexes["lookup"])
+
+    self.assertEqual(book.search("ada").index.tolist(), [])
+    self.assertEqual(book.search("grace").index.tolist(), [2])
+    self.assertEqual(book.lookup(["alan@example.org", "turing@example.org", "grace@example.org"]), [[], [1], [2]])
+
+
+class SetValueTest(unittest.TestCase):
+
+  def test_empty_list_cell_round_trips_through_the_snapshot(self):
+    data = sample_book()
+    data.loc[2] = ["Grace Hopper", None, "grace.vcf"]
+    data["categories"] = [["Clients"], None, None]
+    data["adr-locality"] = [["London"], None, None]
+    book = ab.addressBook()
+    book.addressDB = data
+
+    # Typed into missing cells of list columns
+    book.set_value(2, "email", "grace@example.org")
+    book.set_value(2, "categories", "Clients, Navy")
+    book.set_value(2, "adr-locality", "Arlington")
+    book.set_value(2, "fn", "Grace B. Hopper")
+
+    self.assertEqual(book.addressDB.at[2, "email"], ["grace@example.org"])
+    self.assertEqual(book.addressDB.at[2, "categories"], ["Clients", "Navy"])
+    self.assertEqual(book.addressDB.at[2, "adr-locality"], ["Arlington"])
+    self.assertEqual(book.addressDB.at[2, "fn"], "Grace B. Hopper")
+
+    with tempfile.TemporaryDirectory() as directory:
+      snapshot = Snapshot(os.path.join(directory, "book.arrow"))
+      snapshot.save(book.addressDB)
+      loaded = snapshot.load()
+
+    self.assertEqual(loaded.at[2, "email"], ["grace@example.org"])
+    self.assertEqual(loaded.at[2, "categories"], ["Clients", "Navy"])
+    self.assertEqual(loaded.at[2, "adr-locality"], ["Arlington"])
+    self.assertTrue(loaded.at[2, "changed"])
+
+  def test_property_no_contact_had(self):
+    book = ab.addressBook()
+    book.addressDB = sample_book()
+    book.set_value(1, "impp", "xmpp:alan@example.org")
+    self.assertEqual(book.addressDB.at[1, "impp"], ["xmpp:alan@example.org"])
+    self.assertTrue(pd.isna(book.addressDB.at[0, "impp"]))
+
+
+def card(name: str, note: str) -> str:
+  return "BEGIN:VCARD\r\nVERSION:4.0\r\nFN:%s\r\nNOTE:%s\r\nEND:VCARD\r\n" % (name, note)
+
+
+class BookOfFilesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    for name in ("ada", "alan", "grace"):
+      with open(self.path(name), "w", newline="") as f:
+        f.write(card(name.title(), "first"))
+    self.book = ab.addressBook()
+    self.book.addressDB = contact.list_vcf_in_directory(self.directory.name)
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def path(self, name: str) -> str:
+    return os.path.join(self.directory.name, name + ".vcf")
+
+  def read(self, name: str) -> str:
+    with open(self.path(name), "r", newline="") as f:
+      return f.read()
+
+  def row(self, name: str):
+    data = self.book.addressDB
+    return data.index[data["z-file"] == self.path(name)][0]
+
+
+class MergeCommittedTest(BookOfFilesTest):
+
+  def test_edit_during_commit(self):
+    ada, alan, grace = self.row("ada"), self.row("alan"), self.row("grace")
+    self.book.set_value(ada, "note", "written")
+    self.book.set_value(grace, "note", "written")
+
+    # The files are written from a copy, while the user keeps editing the book
+    base = self.book.addressDB.copy()
+    data, failures = contact.commit_vcf_changes(base)
+    self.assertEqual(failures, dict())
+    self.book.set_value(ada, "note", "edited during the commit")
+    self.book.set_value(alan, "note", "edited during the commit")
+
+    rows = self.book.merge_committed(data, base)
+    book = self.book.addressDB
+
+    self.assertEqual(sorted(rows), sorted([ada, grace]))
+    self.assertIn("NOTE:written\r\n", self.read("ada"))
+    self.assertIn("NOTE:written\r\n", self.read("grace"))
+    self.assertIn("NOTE:first\r\n", self.read("alan"))
+
+    # Edited again after it was written: still to save, from the new file
+    self.assertEqual(book.at[ada, "note"], "edited during the commit")
+    self.assertTrue(book.at[ada, "changed"])
+    self.assertEqual(book.at[ada, "z-hash"], data.at[ada, "z-hash"])
+    self.assertNotEqual(book.at[ada, "z-hash"], base.at[ada, "z-hash"])
+
+    # Not part of the commit: edit kept
+    self.assertEqual(book.at[alan, "note"], "edited during the commit")
+    self.assertTrue(book.at[alan, "changed"])
+
+    # Saved
+    self.assertEqual(book.at[grace, "note"], "written")
+    self.assertFalse(book.at[grace, "changed"])
+    self.assertEqual(self.book.addressView.at[ada, "note"], "edited during the commit")
+
+    # The next commit writes the last edits over the written file
+    data, failures = contact.commit_vcf_changes(book.copy())
+    self.assertEqual(failures, dict())
+    self.assertIn("NOTE:edited during the commit\r\n", self.read("ada"))
+    self.assertIn("NOTE:edited during the commit\r\n", self.read("alan"))
+
+
+class MergeSyncTest(BookOfFilesTest):
+
+  def test_edit_during_sync(self):
+    ada, alan, grace = self.row("ada"), self.row("alan"), self.row("grace")
+    with open(self.path("ada"), "w", newline="") as f:
+      f.write(card("Ada Lovelace", "edited on disk"))
+    os.remove(self.path("grace"))
+    paths = {self.path("ada"), self.path("grace")}
+
+    # The files reported by the watcher are synced from a copy, while the user keeps editing the book
+    base = self.book.addressDB.copy()
+    with contextlib.redirect_stdout(io.StringIO()):
+      data = contact.update_vcf_in_directory(self.directory.name, base, paths=paths)
+    self.book.set_value(ada, "email", "ada@example.org")
+    self.book.set_value(alan, "note", "edited during the sync")
+
+    rows = base.index[base["z-file"].isin(paths)].union(data.index[data["z-file"].isin(paths)])
+    edited = self.book.merge_rows(data, rows, base)
+    book = self.book.addressDB
+
+    self.assertEqual(edited.tolist(), [ada])
+    self.assertEqual(book.index.tolist(), [ada, alan] if ada < alan else [alan, ada])
+
+    # Both the edit and the change on disk
+    self.assertEqual(book.at[ada, "fn"], "Ada Lovelace")
+    self.assertEqual(book.at[ada, "note"], "edited on disk")
+    self.assertEqual(book.at[ada, "email"], ["ada@example.org"])
+    self.assertTrue(book.at[ada, "changed"])
+    self.assertEqual(book.at[alan, "note"], "edited during the sync")
+    self.assertEqual(self.book.search("lovelace").index.tolist(), [ada])
+
+
+if __name__ == "__main__":
+  unittest.main()
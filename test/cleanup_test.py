@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import unittest
+
+import pandas as pd
+
+from data import contact
+
+# Book of the fixture cards as built by older versions: the str() of the vobject contents, "nan" when missing
+# (legacy/book.json), and the output of the cleanup of these versions, before it was column-scoped
+# (legacy/cleaned.json)
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "legacy")
+
+
+def load(name: str) -> pd.DataFrame:
+  with open(os.path.join(FIXTURES, name), "r", encoding="utf-8") as f:
+    frame = json.load(f)
+  return pd.DataFrame(frame["data"], columns=frame["columns"], dtype=object)
+
+
+def cell(value):
+  """Cells comparable between versions: empty cells were "" and are now missing, flags were "True" """
+  if value is None or value == "" or (isinstance(value, float) and value != value):
+    return None
+  if hasattr(value, "item"):
+    value = value.item()
+  return str(value)
+
+
+class CleanupGoldenTest(unittest.TestCase):
+
+  def setUp(self):
+    self.book = load("book.json")
+    self.expected = load("cleaned.json")
+
+  def assertCleaned(self, cleaned: pd.DataFrame):
+    self.assertEqual(cleaned.columns.tolist(), self.expected.columns.tolist())
+    for col in self.expected.columns:
+      with self.subTest(col=col):
+        self.assertEqual([cell(value) for value in cleaned[col]], [cell(value) for value in self.expected[col]])
+
+  def test_legacy_frame(self):
+    self.assertTrue(contact.is_legacy_frame(self.book))
+    self.assertCleaned(contact.cleanup_contact(self.book.copy()))
+
+  def test_parallel(self):
+    self.assertCleaned(contact.cleanup_contact(self.book.copy(), workers=2))
+
+  def test_clean_vobject_repr(self):
+    # Column by column, on the text of the non-empty cells
+    for col in self.book.columns:
+      column = self.book[col].mask(self.book[col] == "nan")
+      if not contact.is_vobject_repr(column):
+        continue
+      with self.subTest(col=col):
+        cleaned = contact.clean_vobject_repr(column)
+        self.assertEqual([cell(value) for value in cleaned], [cell(value) for value in self.expected[col]])
+
+  def test_typed_columns_untouched(self):
+    # Only the columns holding vobject reprs are cleaned: files, hashes and flags are kept as-is
+    cleaned = contact.cleanup_contact(self.book.copy())
+    for col in ("z-file", "z-hash"):
+      self.assertEqual(cleaned[col].tolist(), self.book[col].tolist())
+    self.assertEqual(cleaned["z-geoupdate"].dtype, bool)
+    self.assertFalse(contact.is_vobject_repr(self.book["z-file"]))
+
+  def test_typed_frame(self):
+    # Books of the current versions hold typed values, which the cleanup doesn't change
+    data = pd.DataFrame({"fn": ["Ada Lovelace", "Alan Turing"], "email": [["ada@example.org"], None],
+                         "note": ["[<not a tag>]", None], "z-file": ["ada.vcf", "alan.vcf"]})
+    self.assertFalse(contact.is_legacy_frame(data))
+    cleaned = contact.cleanup_contact(data.copy())
+    self.assertEqual(cleaned.loc[0, "note"], "[<not a tag>]")
+    self.assertEqual(cleaned.loc[0, "email"], ["ada@example.org"])
+
+
+if __name__ == "__main__":
+  unittest.main()
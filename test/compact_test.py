@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import unittest
+
+import pandas as pd
+
+from data import contact
+
+
+def sample_book() -> pd.DataFrame:
+  return pd.DataFrame({
+    "fn": ["Ada", "Alan", "Grace", "Linus"],
+    "version": ["4.0", "4.0", "4.0", "4.0"],
+    "org": [None, "ACME", "ACME", None],
+    "x-custom": ["a", None, None, None],
+    "z-geoID": [None, "1", "1", None],
+    "z-file": ["a.vcf", "b.vcf", "c.vcf", "d.vcf"],
+    "categories": [["Clients"], [], None, ["Clients"]],
+    "changed": [None, True, None, False],
+  })
+
+
+class CompactColumnsTest(unittest.TestCase):
+
+  def test_dtypes(self):
+    data = contact.compact_columns(sample_book())
+    self.assertIsInstance(data["version"].dtype, pd.CategoricalDtype)
+    self.assertEqual(data["changed"].dtype, bool)
+    self.assertEqual(data["changed"].tolist(), [False, True, False, False])
+    for col in ["org", "x-custom", "z-geoID", "categories"]:
+      self.assertNotIsInstance(data[col].dtype, pd.CategoricalDtype, col)
+
+  def test_writes_after_second_pass(self):
+    # The cleanup runs again on books loaded from snapshots
+    data = contact.compact_columns(contact.compact_columns(sample_book()))
+    data.loc[[0], "z-geoID"] = "2"
+    data.loc[[1], "org"] = "Initech"
+    data.at[2, "x-custom"] = "b"
+    self.assertEqual(data.loc[0, "z-geoID"], "2")
+    self.assertEqual(data.loc[1, "org"], "Initech")
+    self.assertEqual(data.loc[2, "x-custom"], "b")
+
+  def test_older_categories_are_text(self):
+    data = sample_book()
+    data["z-geoID"] = data["z-geoID"].astype("category")
+    data = contact.compact_columns(data)
+    self.assertNotIsInstance(data["z-geoID"].dtype, pd.CategoricalDtype)
+    data.loc[[3], "z-geoID"] = "3"
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from data import dedup
+
+EMPTY = np.iinfo(np.uint64).max
+
+
+def sample_book() -> pd.DataFrame:
+  return pd.DataFrame({
+    "fn": ["Ada Lovelace", "A. Lovelace", "Alan Turing", "Alan Turing", "Grace Hopper", "Grace Hoper",
+           "Margaret Hamilton", "", None],
+    "email": [["ada@example.org"], ["Ada@Example.org "], ["alan@example.org"], None, None, None,
+              ["margaret@example.com"], None, None],
+    "tel": [None, None, ["+44 20 7946 0958"], ["0044 20 7946 0958"], None, None, None, None, None],
+    "org": [None, None, None, None, "United States Navy", "United States Navy", "NASA", None, None],
+    "adr-locality": [None, None, None, None, ["Arlington"], ["Arlington"], None, None, None],
+  }, index=pd.Index([10, 11, 20, 21, 30, 31, 40, 50, 51]))
+
+
+class MinHashTest(unittest.TestCase):
+
+  def test_signatures_dont_depend_on_other_rows(self):
+    texts = ["ada lovelace", "", "al", "grace hopper", "x", ""]
+    signatures = dedup.minhash(pd.Series(texts))
+    for i, text in enumerate(texts):
+      with self.subTest(text=text):
+        self.assertTrue((signatures[i] == dedup.minhash(pd.Series([text]))[0]).all())
+
+  def test_last_gram_before_empty_rows(self):
+    # The 3-grams of the last text are all hashed, empty rows after it included
+    signatures = dedup.minhash(pd.Series(["abcde", "abcd", "bcde", ""]))
+    self.assertTrue((signatures[0] == np.minimum(signatures[1], signatures[2])).all())
+
+  def test_short_texts(self):
+    signatures = dedup.minhash(pd.Series(["", "ab", None]).fillna(""))
+    self.assertTrue((signatures == EMPTY).all())
+
+  def test_similarity(self):
+    signatures = dedup.minhash(pd.Series(["grace hopper united states navy", "grace hoper united states navy",
+                                          "margaret hamilton nasa"]))
+    self.assertGreater((signatures[0] == signatures[1]).mean(), 0.6)
+    self.assertLess((signatures[0] == signatures[2]).mean(), 0.2)
+
+
+class DuplicatesTest(unittest.TestCase):
+
+  def setUp(self):
+    self.pairs = dedup.find_duplicate_pairs(sample_book())
+
+  def pair(self, a, b) -> pd.Series:
+    found = self.pairs[(self.pairs["row_a"] == a) & (self.pairs["row_b"] == b)]
+    self.assertEqual(len(found.index), 1, "%i and %i are not candidates" % (a, b))
+    return found.iloc[0]
+
+  def test_same_email(self):
+    pair = self.pair(10, 11)
+    self.assertTrue(pair["email"])
+    self.assertGreaterEqual(pair["confidence"], dedup.EMAIL_CONFIDENCE)
+
+  def test_same_phone_and_name(self):
+    pair = self.pair(20, 21)
+    self.assertTrue(pair["phone"] and pair["name"])
+    self.assertFalse(pair["email"])
+    self.assertEqual(pair["similarity"], 1.)
+
+  def test_near_duplicates(self):
+    # No shared email nor phone: a typo in the name, same organization and city
+    pair = self.pair(30, 31)
+    self.assertFalse(pair["email"] or pair["phone"])
+    self.assertTrue(pair["name"])
+    self.assertGreater(pair["similarity"], 0.6)
+
+  def test_groups(self):
+    groups = dedup.find_duplicates(sample_book())
+    self.assertEqual(sorted(groups.index), [10, 11, 20, 21, 30, 31])
+    for a, b in ((10, 11), (20, 21), (30, 31)):
+      self.assertEqual(groups.at[a, "group"], groups.at[b, "group"])
+    self.assertEqual(groups["group"].nunique(), 3)
+
+  def test_empty_rows(self):
+    # Contacts without name nor values are not duplicates of each other
+    rows = set(self.pairs["row_a"]) | set(self.pairs["row_b"])
+    self.assertNotIn(50, rows)
+    self.assertNotIn(51, rows)
+    self.assertNotIn(40, rows)
+
+  def test_empty_book(self):
+    self.assertEqual(len(dedup.find_duplicates(sample_book().iloc[:0]).index), 0)
+
+
+if __name__ == "__main__":
+  unittest.main()
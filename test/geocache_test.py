@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from data import geocache
+from data.geocache import GeoCache
+
+PARIS = [{"lat": "48.85", "lon": "2.35", "display_name": "Paris, France"}]
+LONDON = [{"lat": "51.51", "lon": "-0.13", "display_name": "London, United Kingdom"}]
+ROME = [{"lat": "41.89", "lon": "12.48", "display_name": "Roma, Italia"}]
+
+
+class GeoCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.directory.name, "geocache.sqlite")
+    self.now = int(time.time())
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def open(self, **kwargs) -> GeoCache:
+    cache = GeoCache(self.path, **kwargs)
+    self.addCleanup(cache.close)
+    return cache
+
+  def test_normalized_key(self):
+    cache = self.open()
+    self.assertIsNone(cache.get("q=Paris&format=json"))
+    cache.put("q=Paris&format=json", PARIS, self.now)
+    self.assertEqual(cache.get("format=json&q=%20paris%20%20"), PARIS)
+    self.assertEqual(len(cache), 1)
+
+  def test_persistence(self):
+    cache = GeoCache(self.path, memory_size=1)
+    cache.put("q=paris", PARIS, self.now)
+    cache.put("q=london", LONDON, self.now)
+
+    # Read back from the database once out of memory
+    self.assertEqual(cache.get("q=paris"), PARIS)
+    cache.get("q=rome")
+    cache.close()
+
+    cache = self.open()
+    self.assertEqual(cache.get("q=london"), LONDON)
+    stats = cache.stats()
+    self.assertEqual((stats["entries"], stats["hits"], stats["misses"]), (2, 2, 1))
+
+  def test_expiry(self):
+    cache = self.open(ttl=100)
+    cache.put("q=paris", PARIS, self.now - 200)
+    cache.put("q=london", LONDON, self.now)
+    self.assertEqual(cache.stats()["expired entries"], 1)
+
+    # Expired responses are still used, and queued to be fetched again once
+    self.assertEqual(cache.get("q=paris"), PARIS)
+    self.assertEqual(cache.get("q=london"), LONDON)
+    self.assertEqual(cache.stale_queries(), ["q=paris"])
+    self.assertEqual(cache.stale_queries(), [])
+    self.assertEqual(cache.stats()["stale"], 1)
+
+    # Until they are refreshed
+    cache.get("q=paris")
+    cache.put("q=paris", PARIS, self.now)
+    self.assertEqual(cache.stale_queries(), [])
+    cache.get("q=paris")
+    self.assertEqual(cache.stale_queries(), [])
+    self.assertEqual(cache.stats()["expired entries"], 0)
+
+  def test_stale_limit(self):
+    cache = self.open(ttl=100)
+    for city in ("paris", "london", "rome"):
+      cache.put("q=" + city, PARIS, self.now - 200)
+      cache.get("q=" + city)
+    self.assertEqual(cache.stale_queries(limit=2), ["q=paris", "q=london"])
+    self.assertEqual(cache.stale_queries(limit=2), ["q=rome"])
+
+  def test_negative_ttl(self):
+    cache = self.open(ttl=100, negative_ttl=10)
+    cache.put("q=nowhere", [], self.now - 20)
+    cache.put("q=paris", PARIS, self.now - 20)
+    self.assertEqual(cache.get("q=nowhere"), [])
+    self.assertEqual(cache.get("q=paris"), PARIS)
+    self.assertEqual(cache.stale_queries(), ["q=nowhere"])
+
+    # An explicit TTL wins
+    cache.put("q=nowhere", [], self.now - 20, ttl=100)
+    cache.get("q=nowhere")
+    self.assertEqual(cache.stale_queries(), [])
+
+  def test_evict_expired(self):
+    cache = self.open(ttl=100)
+    # Expired for longer than a TTL, but used since it expired
+    cache.put("q=paris", PARIS, self.now - 300)
+    cache.get("q=paris")
+    # Expired for longer than a TTL and unused
+    cache.put("q=london", LONDON, self.now - 300)
+    # Expired for less than a TTL
+    cache.put("q=rome", ROME, self.now - 150)
+
+    self.assertEqual(cache.evict(), 1)
+    self.assertIsNone(cache.get("q=london"))
+    self.assertEqual(cache.get("q=paris"), PARIS)
+    self.assertEqual(cache.get("q=rome"), ROME)
+    self.assertEqual(cache.stats()["expirations"], 1)
+
+    # Entries used after they expired are removed once unused for a TTL
+    self.assertEqual(cache.evict(now=self.now + 200), 2)
+    self.assertEqual(len(cache), 0)
+
+  def use(self, cache: GeoCache, *accesses):
+    # Look up queries at the given times
+    for query, when in accesses:
+      with mock.patch.object(geocache.time, "time", return_value=when):
+        cache.get(query)
+
+  def fill(self, cache: GeoCache):
+    cache.put("q=paris", PARIS, self.now - 300)
+    cache.put("q=london", LONDON, self.now - 200)
+    cache.put("q=rome", ROME, self.now - 100)
+    self.use(cache, ("q=paris", self.now - 50), ("q=paris", self.now - 50), ("q=london", self.now))
+
+  def test_lru(self):
+    cache = self.open(max_entries=1, policy="lru")
+    self.fill(cache)
+    self.assertEqual(cache.evict(), 2)
+    self.assertEqual(cache.get("q=london"), LONDON)
+    self.assertEqual(cache.stats()["evictions"], 2)
+
+  def test_lfu(self):
+    cache = self.open(max_entries=1, policy="lfu")
+    self.fill(cache)
+    self.assertEqual(cache.evict(), 2)
+    self.assertEqual(cache.get("q=paris"), PARIS)
+
+  def test_max_bytes(self):
+    size = len(json.dumps(PARIS))
+    cache = self.open(max_entries=None, max_bytes=2 * size, policy="lru")
+    for i, city in enumerate(("paris", "london", "rome")):
+      cache.put("q=" + city, PARIS, self.now - 300 + i)
+    self.assertEqual(cache.evict(), 1)
+    self.assertIsNone(cache.get("q=paris"))
+    self.assertEqual(cache.stats()["bytes"], 2 * size)
+
+  def test_unknown_policy(self):
+    with self.assertRaises(ValueError):
+      GeoCache(policy="fifo")
+
+  def test_outcomes(self):
+    cache = self.open(ttl=100, negative_ttl=10)
+    self.assertIsNone(cache.get_outcome("1 rue de Rivoli, Paris"))
+    cache.put_outcome("1 rue de Rivoli,  Paris ", PARIS[0], True)
+    cache.put_outcome("Nowhere", None, False)
+    self.assertEqual(cache.get_outcome("1 RUE DE RIVOLI, PARIS"), (PARIS[0], True))
+    self.assertEqual(cache.get_outcome("nowhere"), (None, False))
+
+    # Addresses not found expire sooner
+    cache.put_outcome("Nowhere", None, False, created=self.now - 20)
+    cache.put_outcome("10 Downing Street", LONDON[0], False, created=self.now - 20)
+    self.assertIsNone(cache.get_outcome("Nowhere"))
+    self.assertEqual(cache.get_outcome("10 Downing Street"), (LONDON[0], False))
+
+    # Expired outcomes are removed
+    self.assertEqual(cache.stats()["addresses"], 3)
+    cache.evict()
+    self.assertEqual(cache.stats()["addresses"], 2)
+    cache.clear()
+    self.assertIsNone(cache.get_outcome("10 Downing Street"))
+
+  def test_upgrade(self):
+    # Cache of a previous version, without expiry nor access times
+    connection = sqlite3.connect(self.path)
+    connection.execute("CREATE TABLE geocache (key TEXT PRIMARY KEY, response TEXT NOT NULL, created INTEGER NOT NULL)")
+    connection.execute("INSERT INTO geocache VALUES (?, ?, ?)", ("q=paris", json.dumps(PARIS), self.now - 300))
+    connection.commit()
+    connection.close()
+
+    # Entries expire from their creation, but are refreshed before being removed
+    cache = self.open(ttl=100)
+    self.assertEqual(cache.evict(), 0)
+    self.assertEqual(cache.get("q=paris"), PARIS)
+    self.assertEqual(cache.stale_queries(), ["q=paris"])
+    self.assertEqual(cache.stats()["bytes"], len(json.dumps(PARIS)))
+
+  def test_migrate(self):
+    legacy = os.path.join(self.directory.name, "legacy")
+    os.mkdir(legacy)
+    for name, response in (("q=Paris&format=json_1600000000", LONDON),
+                           ("q=paris&format=json_1700000000", PARIS),
+                           ("q=rome_1700000000", "not JSON"),
+                           ("README", ROME)):
+      with open(os.path.join(legacy, name), "w") as f:
+        f.write(json.dumps(response) if response != "not JSON" else response)
+
+    cache = self.open()
+    self.assertEqual(cache.migrate(legacy), 2)
+    self.assertEqual(len(cache), 1)
+    self.assertEqual(cache.get("q=paris&format=json"), PARIS)
+
+    # Only once
+    self.assertEqual(cache.migrate(legacy), 0)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+
+from data import geocoders
+from data.geocoders import FakeGeocoder, GeocodingError, StandInServer
+
+PARIS = [{"lat": "48.85", "lon": "2.35", "display_name": "Paris, France"}]
+
+
+def slow(delay: float):
+  # Responses of a server taking delay seconds to answer
+  def respond(params):
+    time.sleep(delay)
+    return PARIS
+  return respond
+
+
+class GeocoderTest(unittest.TestCase):
+
+  def test_abstract(self):
+    with self.assertRaises(TypeError):
+      geocoders.Geocoder()
+
+  def test_fake(self):
+    backend = FakeGeocoder({"paris": PARIS}, failures=1)
+    with self.assertRaises(GeocodingError):
+      backend.search("q=Paris&format=json")
+    self.assertEqual(backend.search("q=Paris&format=json"), PARIS)
+    self.assertEqual(backend.search("q=Nowhere&format=json"), [])
+    self.assertEqual(len(backend.queries), 3)
+
+  def test_public(self):
+    backend = geocoders.PublicNominatim()
+    self.assertEqual(backend.concurrency, 1)
+    self.assertEqual(backend.url, geocoders.PUBLIC_SERVER)
+    self.assertLessEqual(backend.limiter.rate, 1.)
+
+    # Its usage policy can't be bypassed
+    with self.assertRaises(ValueError):
+      geocoders.SelfHostedNominatim("https://nominatim.openstreetmap.org")
+    with self.assertRaises(ValueError):
+      geocoders.set_rate_limit(geocoders.PUBLIC_SERVER, 10.)
+
+  def test_make_geocoder(self):
+    self.assertIsInstance(geocoders.make_geocoder(), geocoders.PublicNominatim)
+    backend = geocoders.make_geocoder({"backend": "self-hosted", "url": "http://localhost:8080", "concurrency": 4})
+    self.assertIsInstance(backend, geocoders.SelfHostedNominatim)
+    self.assertEqual((backend.url, backend.concurrency), ("http://localhost:8080/search?", 4))
+    with self.assertRaises(ValueError):
+      geocoders.make_geocoder({"backend": "unknown"})
+
+
+class StandInServerTest(unittest.TestCase):
+
+  def test_search(self):
+    with StandInServer(FakeGeocoder({"paris": PARIS})) as server:
+      backend = geocoders.SelfHostedNominatim(server.url)
+      self.assertEqual(backend.search("q=paris&format=json"), PARIS)
+      self.assertEqual(backend.search("q=nowhere&format=json"), [])
+
+      # The plain HTTP backend, as used by the public server
+      backend = geocoders.HTTPGeocoder(geocoders.search_url(server.url))
+      self.assertEqual(backend.search("q=paris&format=json"), PARIS)
+      self.assertEqual(server.requests, 3)
+
+  def test_concurrency(self):
+    # Queries are answered at once over the connections of the backend
+    with StandInServer(FakeGeocoder(slow(0.2), concurrency=4)) as server:
+      backend = geocoders.SelfHostedNominatim(server.url, concurrency=4)
+      threads = [threading.Thread(target=backend.search, args=("q=paris", )) for i in range(4)]
+      start = time.monotonic()
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      self.assertLess(time.monotonic() - start, 0.6)
+      self.assertEqual(server.requests, 4)
+
+  def test_retry(self):
+    with StandInServer(FakeGeocoder({"paris": PARIS}), statuses=(503, 429, 502)) as server:
+      backend = geocoders.SelfHostedNominatim(server.url, retries=3, backoff=0)
+      self.assertEqual(backend.search("q=paris"), PARIS)
+      self.assertEqual(server.requests, 4)
+
+  def test_retry_after(self):
+    with StandInServer(FakeGeocoder({"paris": PARIS}), statuses=(429, ), retry_after=1) as server:
+      backend = geocoders.SelfHostedNominatim(server.url, retries=1, backoff=0)
+      start = time.monotonic()
+      self.assertEqual(backend.search("q=paris"), PARIS)
+      self.assertGreaterEqual(time.monotonic() - start, 0.9)
+
+  def test_backoff(self):
+    # The first retry waits too
+    with StandInServer(FakeGeocoder({"paris": PARIS}), statuses=(503, 503)) as server:
+      backend = geocoders.SelfHostedNominatim(server.url, retries=2, backoff=0.2)
+      self.assertEqual(backend.search("q=paris"), PARIS)
+      gaps = [b - a for a, b in zip(server.times, server.times[1:])]
+      self.assertGreaterEqual(gaps[0], 0.18)
+      self.assertGreaterEqual(gaps[1], 0.38)
+
+  def test_retries_are_rate_limited(self):
+    # Retries take their turn in the rate limit, even if the server asks to retry at once
+    with StandInServer(FakeGeocoder({"paris": PARIS}), statuses=(503, 429)) as server:
+      backend = geocoders.SelfHostedNominatim(server.url, rate=4., burst=1, retries=2, backoff=0)
+      self.assertEqual(backend.search("q=paris"), PARIS)
+      self.assertEqual(server.requests, 3)
+      for a, b in zip(server.times, server.times[1:]):
+        self.assertGreaterEqual(b - a, 0.23)
+
+  def test_public_spacing(self):
+    # The public server gets one request per second, retries included
+    with StandInServer(FakeGeocoder({"paris": PARIS}), statuses=(503, )) as server:
+      backend = geocoders.PublicNominatim(backoff=0)
+      backend.url = geocoders.search_url(server.url)
+      self.assertEqual(backend.search("q=paris"), PARIS)
+      self.assertEqual(backend.search("q=paris"), PARIS)
+      self.assertEqual(server.requests, 3)
+      for a, b in zip(server.times, server.times[1:]):
+        self.assertGreaterEqual(b - a, 0.95)
+
+  def test_retries_exhausted(self):
+    with StandInServer(FakeGeocoder({"paris": PARIS}), statuses=(503, ) * 3) as server:
+      backend = geocoders.SelfHostedNominatim(server.url, retries=2, backoff=0)
+      with self.assertRaises(GeocodingError):
+        backend.search("q=paris")
+      self.assertEqual(server.requests, 3)
+
+  def test_server_failure(self):
+    # Failures of the geocoder behind the stand-in are answered with 503, and retried
+    with StandInServer(FakeGeocoder({"paris": PARIS}, failures=1)) as server:
+      backend = geocoders.SelfHostedNominatim(server.url, retries=1, backoff=0)
+      self.assertEqual(backend.search("q=paris"), PARIS)
+      self.assertEqual(server.requests, 2)
+
+  def test_timeout(self):
+    with StandInServer(FakeGeocoder(slow(1.))) as server:
+      backend = geocoders.SelfHostedNominatim(server.url, read_timeout=0.2, retries=0)
+      start = time.monotonic()
+      with self.assertRaises(GeocodingError):
+        backend.search("q=paris")
+      self.assertLess(time.monotonic() - start, 0.9)
+
+  def test_timeout_retried(self):
+    with StandInServer(FakeGeocoder(slow(0.5))) as server:
+      backend = geocoders.SelfHostedNominatim(server.url, read_timeout=0.1, retries=1, backoff=0)
+      with self.assertRaises(GeocodingError):
+        backend.search("q=paris")
+      self.assertEqual(server.requests, 2)
+
+  def test_connection_refused(self):
+    server = StandInServer(FakeGeocoder())
+    url = server.url
+    server.server.server_close()
+
+    backend = geocoders.SelfHostedNominatim(url, connect_timeout=0.2, retries=0)
+    with self.assertRaises(GeocodingError):
+      backend.search("q=paris")
+
+
+if __name__ == "__main__":
+  unittest.main()
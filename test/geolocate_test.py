@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import io
+import json
+import unittest
+
+import pandas as pd
+
+from data import contact
+from data.geocache import GeoCache
+from data.geocoders import FakeGeocoder
+from data.nominatim import Nominatim
+
+RIVOLI = {"lat": "48.86", "lon": "2.34", "osm_id": 1, "display_name": "Rue de Rivoli, Paris, France"}
+ARMES = {"lat": "48.80", "lon": "2.13", "osm_id": 2, "display_name": "Place d'Armes, Versailles, France"}
+PARIS = {"lat": "48.85", "lon": "2.35", "osm_id": 3, "display_name": "Paris, France"}
+
+RESPONSES = {
+  "1 rue de rivoli, paris, france": [RIVOLI],
+  "place d'armes, versailles, france": [ARMES],
+  "paris": [PARIS],
+}
+
+
+def sample_book(streets: list) -> pd.DataFrame:
+  return pd.DataFrame({
+    "fn": ["Contact %i" % i for i in range(len(streets))],
+    "adr-street": [[street] if street is not None else None for street in streets],
+    "adr-locality": [["Paris"] if street != "Place d'Armes" else ["Versailles"] for street in streets],
+    "adr-country": [["France"]] * len(streets),
+  })
+
+
+class GeolocateTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cache = GeoCache(":memory:")
+    self.backend = FakeGeocoder(RESPONSES)
+    self.nominatim = Nominatim(cache=self.cache, backend=self.backend)
+
+  def tearDown(self):
+    self.cache.close()
+
+  def locate(self, data: pd.DataFrame) -> pd.DataFrame:
+    with contextlib.redirect_stdout(io.StringIO()):
+      return contact.get_geoID(data, nominatim=self.nominatim)
+
+  def test_normalize_hints(self):
+    hints = pd.Series(["1 Rue de Rivoli (3e étage), Paris, France;  ;Place d'Armes, Versailles", None,
+                       "12-14 [bis] Main St\nLondon"], index=[4, 5, 6])
+    self.assertEqual(contact.normalize_hints(hints).to_dict(), {
+      4: ("1 rue de rivoli, paris, france", "place d'armes, versailles"),
+      5: (),
+      6: ("12 14 bis main st, london", ),
+    })
+
+  def test_distinct_addresses(self):
+    # Contacts sharing an address cost a single lookup
+    data = sample_book(["1 rue de Rivoli", "1 Rue de  Rivoli ", "Place d'Armes"] * 100)
+    data = self.locate(data)
+
+    self.assertEqual(len(self.backend.queries), 2)
+    self.assertFalse(data["z-geoupdate"].any())
+    self.assertTrue(data["z-exactlocation"].all())
+    self.assertEqual(json.loads(data.at[1, "z-geoID"]), [RIVOLI])
+    self.assertEqual(json.loads(data.at[299, "z-geoID"]), [ARMES])
+    self.assertEqual(data.at[0, "z-geohint"], "1 rue de rivoli, paris, france")
+
+  def test_only_updated_contacts(self):
+    data = self.locate(sample_book(["1 rue de Rivoli", "Place d'Armes"]))
+    data.loc[2] = pd.Series({"fn": "New", "adr-street": ["1 rue de Rivoli"], "adr-locality": ["Paris"],
+                             "adr-country": ["France"], "z-geoupdate": True})
+    data.at[1, "z-geoID"] = "kept"
+    data = self.locate(data)
+
+    self.assertEqual(data.at[1, "z-geoID"], "kept")
+    self.assertEqual(json.loads(data.at[2, "z-geoID"]), [RIVOLI])
+    self.assertEqual(len(self.backend.queries), 2)
+
+  def test_outcomes_are_cached(self):
+    # The cascade of an address is not run again, found or not
+    data = sample_book(["1 rue de Rivoli", "Nowhere street"])
+    data = self.locate(data)
+    queries = len(self.backend.queries)
+    self.assertGreater(queries, 2)
+    self.assertEqual(data.at[1, "z-geoID"], json.dumps([PARIS]))
+    self.assertFalse(data.at[1, "z-exactlocation"])
+
+    data["z-geoupdate"] = True
+    data = self.locate(data)
+    self.assertEqual(len(self.backend.queries), queries)
+    self.assertEqual(self.cache.stats()["addresses"], 2)
+
+  def test_not_found(self):
+    self.backend.responses = dict()
+    data = self.locate(sample_book(["Nowhere street", None]))
+    self.assertEqual(data["z-geoID"].tolist(), ["not found", "not found"])
+    self.assertFalse(data["z-geoupdate"].any())
+    self.assertEqual(self.cache.get_outcome("nowhere street, paris, france"), (None, False))
+
+  def test_server_failure(self):
+    # The contacts are left to the next run, and the server is not hammered
+    self.backend.failures = 100
+    data = sample_book(["%i rue de Rivoli" % i for i in range(10)])
+    data = self.locate(data)
+
+    self.assertTrue(data["z-geoupdate"].all())
+    self.assertTrue(data["z-geoID"].isna().all())
+    self.assertLessEqual(len(self.backend.queries), contact.MAX_GEOCODING_FAILURES + self.nominatim.concurrency)
+    self.assertEqual(self.cache.stats()["addresses"], 0)
+    self.assertEqual(len(self.cache), 0)
+
+    # And located once it is back
+    self.backend.failures = 0
+    self.backend.responses = lambda params: [RIVOLI]
+    data = self.locate(data)
+    self.assertFalse(data["z-geoupdate"].any())
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+import unittest
+
+import pandas as pd
+
+from data import geoservice
+from data.geocache import GeoCache
+from data.geocoders import FakeGeocoder
+from data.nominatim import Nominatim
+
+PARIS = [{"lat": "48.85", "lon": "2.35", "osm_id": 7444, "display_name": "Paris, France"}]
+
+
+def sample_book(count: int) -> pd.DataFrame:
+  return pd.DataFrame({
+    "fn": ["Contact %i" % i for i in range(count)],
+    "adr-street": [["%i rue de Rivoli" % i] for i in range(count)],
+    "adr-locality": [["Paris"]] * count,
+    "adr-country": [["France"]] * count,
+    "z-geoupdate": True,
+  })
+
+
+class GeocodingServiceTest(unittest.TestCase):
+
+  def make_service(self, responses, callback, **kwargs):
+    nominatim = Nominatim(cache=GeoCache(":memory:"), backend=FakeGeocoder(responses))
+    kwargs.setdefault("checkpoint_delay", 0.1)
+    return geoservice.GeocodingService(callback, nominatim=nominatim, refresh=0, **kwargs)
+
+  def test_locations_are_bounded(self):
+    results = []
+    service = self.make_service(lambda params: PARIS, results.extend)
+    service._locations.maxsize = 5
+
+    data = sample_book(20)
+    service.submit(data, data.index)
+    service.start()
+    deadline = time.monotonic() + 10
+    while len(results) < 20 and time.monotonic() < deadline:
+      time.sleep(0.05)
+    results += service.stop()
+
+    self.assertEqual(sorted(result[0] for result in results), list(range(20)))
+    self.assertLessEqual(len(service._locations), 5)
+
+  def test_stop_keeps_late_results(self):
+    # A lookup still running when stop() times out is handed to the callback when it ends
+    started = threading.Event()
+
+    def slow(params):
+      started.set()
+      time.sleep(0.5)
+      return PARIS
+
+    results = []
+    service = self.make_service(slow, results.extend)
+    data = sample_book(1)
+    service.submit(data, data.index)
+    service.start()
+    self.assertTrue(started.wait(5))
+
+    self.assertEqual(service.stop(timeout=0.05), [])
+    service._thread.join(5)
+    self.assertEqual([result[0] for result in results], [0])
+
+  def test_stop_returns_pending_results(self):
+    # Results found before stopping are returned by stop(), not handed to the callback meanwhile
+    results = []
+    service = self.make_service(lambda params: PARIS, results.extend, checkpoint_size=1000, checkpoint_delay=60.)
+    data = sample_book(3)
+    service.submit(data, data.index)
+    service.start()
+    deadline = time.monotonic() + 10
+    while len(service._results) < 3 and time.monotonic() < deadline:
+      time.sleep(0.05)
+
+    self.assertEqual(sorted(result[0] for result in service.stop()), [0, 1, 2])
+    self.assertEqual(results, [])
+
+
+if __name__ == "__main__":
+  unittest.main()
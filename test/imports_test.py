@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules usable without the GUI, each imported first in a fresh interpreter
+# to catch circular imports hidden by the import order of the application
+MODULES = ["data.cache", "data.text", "data.vcard", "data.contact", "data.binary", "data.query", "data.search",
+           "data.lookup", "data.dedup", "data.addressbook", "data.store", "data.snapshot", "data.journal",
+           "data.geocache", "data.geocoders", "data.nominatim", "data.geoservice"]
+
+
+class ImportsTest(unittest.TestCase):
+
+  def test_fresh_imports(self):
+    for module in MODULES:
+      with self.subTest(module=module):
+        result = subprocess.run([sys.executable, "-c", "import " + module], cwd=ROOT,
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+  def test_helpers_dont_import_contact(self):
+    # contact imports them: importing it back would be a cycle
+    for module in ("data.cache", "data.binary", "data.text", "data.vcard"):
+      with self.subTest(module=module):
+        code = "import sys, %s; sys.exit('data.contact' in sys.modules)" % module
+        result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+
+if __name__ == "__main__":
+  unittest.main()
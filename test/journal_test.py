@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pandas as pd
+
+from data import journal
+from data.journal import Journal
+
+
+def book() -> pd.DataFrame:
+  return pd.DataFrame({"fn": ["Ada", "Alan", "Grace"], "note": ["first", "first", "first"],
+                       "z-file": ["ada.vcf", "alan.vcf", "grace.vcf"], "changed": False})
+
+
+class JournalTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.directory.name, "journal.jsonl")
+    self.journal = Journal(self.path)
+
+  def tearDown(self):
+    self.journal.close()
+    self.directory.cleanup()
+
+  def reopen(self) -> Journal:
+    # Read the journal back, as after a crash
+    self.journal.close()
+    self.journal = Journal(self.path)
+    return self.journal
+
+  def records(self) -> list:
+    with open(self.path, "rb") as f:
+      return [json.loads(line) for line in f]
+
+  def test_persistence(self):
+    self.assertEqual(self.journal.record(0, "ada.vcf", "note", "first", "second"), 1)
+    self.journal.record(0, "ada.vcf", "categories", None, ["work", "friends"])
+
+    journal = self.reopen()
+    self.assertEqual(len(journal), 2)
+    self.assertEqual(journal.seq, 2)
+    self.assertEqual([change["n"] for change in journal.history(0)], ["second", ["work", "friends"]])
+    self.assertEqual(journal.record(1, "alan.vcf", "note", "first", "second"), 3)
+
+  def test_truncated_line(self):
+    self.journal.record(0, "ada.vcf", "note", "first", "second")
+    self.journal.record(1, "alan.vcf", "note", "first", "second")
+    self.journal.close()
+    valid = os.path.getsize(self.path)
+    with open(self.path, "ab") as f:
+      f.write(b'{"t":1.0,"r":2,"f":"gra')
+
+    # The partial line is dropped from the file, and new records follow the valid ones
+    journal = self.reopen()
+    self.assertEqual(len(journal), 2)
+    self.assertEqual(os.path.getsize(self.path), valid)
+    self.assertEqual(journal.record(2, "grace.vcf", "note", "first", "second"), 3)
+    self.assertEqual(len(self.reopen()), 3)
+
+  def test_undo_redo(self):
+    self.assertFalse(self.journal.can_undo())
+    self.assertIsNone(self.journal.undo())
+    self.journal.record(0, "ada.vcf", "note", "first", "second")
+    self.journal.record(0, "ada.vcf", "note", "second", "third")
+
+    change = self.journal.undo()
+    self.assertEqual((change["op"], change["of"], change["n"]), ("undo", 2, "second"))
+    self.assertEqual(self.journal.undo()["n"], "first")
+    self.assertFalse(self.journal.can_undo())
+
+    change = self.journal.redo()
+    self.assertEqual((change["op"], change["of"], change["n"]), ("redo", 1, "second"))
+
+    # The undo and redo stacks are rebuilt from the file
+    journal = self.reopen()
+    self.assertTrue(journal.can_undo())
+    self.assertTrue(journal.can_redo())
+    self.assertEqual(journal.redo()["n"], "third")
+    self.assertFalse(journal.can_redo())
+
+    # A new edit drops what is left to redo
+    journal.undo()
+    journal.record(0, "ada.vcf", "note", "second", "fourth")
+    self.assertFalse(journal.can_redo())
+    self.assertEqual(len(journal.history(0)), 8)
+
+  def test_values_at(self):
+    with mock.patch.object(journal.time, "time", side_effect=[100., 200.]):
+      self.journal.record(0, "ada.vcf", "note", "first", "second")
+      self.journal.record(0, "ada.vcf", "fn", "Ada", "Ada Lovelace")
+    self.assertEqual(self.journal.values_at(0, 150.), {"fn": "Ada"})
+    self.assertEqual(self.journal.values_at(0, 50.), {"fn": "Ada", "note": "first"})
+    self.assertEqual(self.journal.values_at(0, 250.), {})
+
+  def test_pending(self):
+    self.journal.record(0, "ada.vcf", "note", "first", "second")
+    self.journal.record(1, "alan.vcf", "note", "first", "second")
+    self.journal.mark_commit(["alan.vcf"])
+    self.journal.record(1, "alan.vcf", "note", "second", "third")
+    self.assertEqual([change["s"] for change in self.journal.pending()], [1, 4])
+
+    self.journal.mark_snapshot()
+    self.assertEqual(self.journal.pending(), [])
+    self.assertEqual(self.reopen().pending(), [])
+
+  def test_recover(self):
+    self.journal.record(0, "ada.vcf", "note", "first", "second")
+    self.journal.record(1, "alan.vcf", "note", "first", "second")
+    self.journal.record(2, "grace.vcf", "note", "first", "second")
+    self.journal.record(0, "ada.vcf", "categories", None, "work")
+    self.journal.record(5, "linus.vcf", "note", "first", "second")
+
+    # Alan's edit is already in the data, Grace's file was modified by another app
+    data = book()
+    data.at[1, "note"] = "second"
+    data.at[2, "note"] = "edited elsewhere"
+
+    data, rows, conflicts = self.reopen().recover(data)
+    self.assertEqual(rows, [0])
+    self.assertEqual([(change["r"], change["c"]) for change in conflicts], [(2, "note"), (5, "note")])
+    self.assertEqual(data.at[0, "note"], "second")
+    self.assertEqual(data.at[0, "categories"], "work")
+    self.assertEqual(data.at[2, "note"], "edited elsewhere")
+    self.assertEqual(data["changed"].tolist(), [True, False, False])
+
+  def test_recover_moved_row(self):
+    # The row now holds another contact
+    self.journal.record(0, "ada.vcf", "note", "first", "second")
+    data = book().iloc[::-1].reset_index(drop=True)
+    data, rows, conflicts = self.journal.recover(data)
+    self.assertEqual(rows, [])
+    self.assertEqual(len(conflicts), 1)
+    self.assertEqual(data.at[0, "note"], "first")
+
+  def test_recover_categorical(self):
+    self.journal.record(0, "ada.vcf", "note", "first", "second")
+    data = book()
+    data["note"] = data["note"].astype("category")
+    data, rows, conflicts = self.journal.recover(data)
+    self.assertEqual(data.at[0, "note"], "second")
+    self.assertIsInstance(data["note"].dtype, pd.CategoricalDtype)
+
+  @mock.patch.object(journal, "RETENTION", -1)
+  @mock.patch.object(journal, "COMPACT_RECORDS", 4)
+  def test_compaction(self):
+    self.journal.record(0, "ada.vcf", "note", "first", "second")
+    self.journal.record(1, "alan.vcf", "note", "first", "second")
+    self.journal.mark_commit(["alan.vcf"])
+    self.journal.record(0, "ada.vcf", "note", "second", "third")
+    self.journal.record(2, "grace.vcf", "note", "first", "second")
+
+    # Only the changes after the snapshot and not written back are kept, with the marks
+    self.journal.mark_snapshot(upto=1)
+    records = self.records()
+    self.assertEqual([record["s"] for record in records if "op" not in record], [4, 5])
+    self.assertEqual({record["op"] for record in records if "op" in record}, {"snapshot", "commit"})
+    self.assertEqual([change["s"] for change in self.journal.pending()], [4, 5])
+    self.assertEqual(len(self.journal), 2)
+
+    journal = self.reopen()
+    self.assertEqual(journal.seq, 6)
+    self.assertEqual(journal.snapshot_seq, 1)
+    self.assertEqual([change["s"] for change in journal.pending()], [4, 5])
+    self.assertEqual(journal.record(1, "alan.vcf", "note", "second", "third"), 7)
+
+    # The kept changes are still recovered after the compaction
+    data = book()
+    data.at[0, "note"] = "second"
+    data.at[1, "note"] = "second"
+    data, rows, conflicts = self.reopen().recover(data)
+    self.assertEqual(rows, [0, 1, 2])
+    self.assertEqual(conflicts, [])
+    self.assertEqual(data["note"].tolist(), ["third", "third", "second"])
+
+  @mock.patch.object(journal, "COMPACT_RECORDS", 2)
+  def test_compaction_keeps_recent(self):
+    self.journal.record(0, "ada.vcf", "note", "first", "second")
+    self.journal.record(1, "alan.vcf", "note", "first", "second")
+    self.journal.mark_snapshot()
+
+    # Within the retention period, the history and undo survive the snapshot
+    journal = self.reopen()
+    self.assertEqual(len(journal), 2)
+    self.assertEqual(journal.pending(), [])
+    self.assertEqual(journal.undo()["n"], "first")
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from data import lookup
+from data.lookup import LookupIndex, normalize_email, normalize_phone
+
+
+def book() -> pd.DataFrame:
+  return pd.DataFrame({
+    "fn": ["Jean Müller", "Alan Turing", "Grace Hopper", "Old Version"],
+    "email": [["Jean@Müller.de"], ["alan@bletchley.uk", "turing@example.org"], np.nan, "a@old.org,b@old.org"],
+    "tel": [["+49 30 1234567"], ["+44 20 7946 0000"], ["0044 20 7946 0000"], np.nan],
+  })
+
+
+class NormalizeTest(unittest.TestCase):
+
+  def test_email(self):
+    self.assertEqual(normalize_email(" Jean@Müller.DE "), "jean@xn--mller-kva.de")
+    self.assertEqual(normalize_email("mailto:jean@xn--mller-kva.de"), "jean@xn--mller-kva.de")
+    self.assertEqual(normalize_email("Alan@Bletchley.uk"), "alan@bletchley.uk")
+    # Not an email, or a domain IDNA can't encode
+    self.assertEqual(normalize_email("Not an email"), "not an email")
+    self.assertEqual(normalize_email("a@" + "ü" * 70 + ".de"), "a@" + "ü" * 70 + ".de")
+
+  def test_phone_digits(self):
+    # Without phonenumbers, numbers are reduced to their digits and international prefix
+    with mock.patch.object(lookup, "phonenumbers", None):
+      self.assertEqual(normalize_phone("+33 6 12-34-56-78"), "+33612345678")
+      self.assertEqual(normalize_phone("tel:0033 (6) 12 34 56 78"), "+33612345678")
+      self.assertEqual(normalize_phone("06 12 34 56 78", "FR"), "0612345678")
+
+  @unittest.skipIf(lookup.phonenumbers is None, "phonenumbers is not installed")
+  def test_phone_e164(self):
+    self.assertEqual(normalize_phone("+33 6 12 34 56 78"), "+33612345678")
+    self.assertEqual(normalize_phone("06 12 34 56 78", "FR"), "+33612345678")
+    # National numbers without region can't be parsed
+    self.assertEqual(normalize_phone("06 12 34 56 78"), "0612345678")
+
+
+class LookupIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.data = book()
+    self.index = LookupIndex()
+    self.index.build(self.data)
+
+  def test_emails(self):
+    self.assertEqual(self.index.lookup_emails(["jean@xn--mller-kva.de", "TURING@example.org", "nobody@example.org"]),
+                     [[0], [1], []])
+    # Comma-separated values of older versions
+    self.assertEqual(self.index.lookup_emails(["b@old.org"]), [[3]])
+
+  def test_phones(self):
+    self.assertEqual(self.index.lookup_phones(["+442079460000", "0049 30 1234567", "12"]), [[1, 2], [0], []])
+
+  def test_lookup(self):
+    self.assertEqual(self.index.lookup(["jean@müller.de", "+49301234567"]), [[0], [0]])
+
+  def test_update(self):
+    self.data.at[1, "email"] = ["alan@example.org"]
+    self.data.at[1, "tel"] = np.nan
+    self.data = self.data.drop(index=0)
+    self.data.loc[5] = pd.Series({"fn": "Jean Müller", "email": ["jean@müller.de"]})
+    self.index.update(self.data, [0, 1, 5])
+
+    self.assertEqual(len(self.index), 4)
+    self.assertEqual(self.index.lookup(["jean@müller.de", "alan@bletchley.uk", "alan@example.org"]),
+                     [[5], [], [1]])
+    self.assertEqual(self.index.lookup(["+442079460000", "+49301234567"]), [[2], []])
+
+    self.index.remove(self.data.index)
+    self.assertEqual((len(self.index), self.index._emails, self.index._phones), (0, {}, {}))
+
+  def test_missing_columns(self):
+    index = LookupIndex()
+    index.build(pd.DataFrame({"fn": ["Ada Lovelace"]}))
+    self.assertEqual(len(index), 1)
+    self.assertEqual(index.lookup(["ada@example.org", "+441234"]), [[], []])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import re
+import unittest
+
+from data import vcard
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# Expected file in fixtures/patched -> (card in fixtures, edited values of its row)
+GOLDEN = {
+  "unknown-note": ("unknown.vcf", {"note": "Invented the first compiler, and co-designed COBOL"}),
+  "unknown-email": ("unknown.vcf", {"email": ["grace@navy.mil", "grace@example.org"],
+                                    "email-type": ["INTERNET,pref", "HOME"]}),
+  "unknown-tel": ("unknown.vcf", {"tel": ["+1 202 555 0199"]}),
+  "unknown-categories": ("unknown.vcf", {"categories": []}),
+  "unknown-org": ("unknown.vcf", {"org": "United States Navy"}),
+  "folded-note": ("folded.vcf", {"note": "Mathematician and writer."}),
+  "escaped-categories": ("escaped.vcf", {"categories": ["Clients", "VIP, platinum"]}),
+}
+
+# The golden files have a fixed revision
+REV = re.compile(r"^REV:\d{8}T\d{6}Z", re.MULTILINE)
+
+CARD = ("BEGIN:VCARD\r\nVERSION:4.0\r\nFN:Ada Lovelace\r\nN:Lovelace;Ada;;;\r\n"
+        "CATEGORIES:Clients,Friends\r\nNOTE:Analyst\r\nEND:VCARD\r\n")
+
+
+def patch(**values) -> str:
+  contents = vcard.parse_vcard(CARD)
+  row = vcard.flatten(contents)
+  row.update(values)
+  return vcard.patch_vcard(CARD, row, contents)
+
+
+class ClearedPropertiesTest(unittest.TestCase):
+
+  def assertDropped(self, name: str, output: str):
+    self.assertNotIn("\r\n%s:" % name, output)
+    self.assertTrue(output.startswith("BEGIN:VCARD\r\n") and output.endswith("END:VCARD\r\n"))
+
+  def test_empty_name(self):
+    for value in ("", "  ", None, float("nan")):
+      with self.subTest(value=value):
+        self.assertDropped("N", patch(n=value))
+
+  def test_cleared_categories(self):
+    for value in ([], [""], " , ", None, float("nan")):
+      with self.subTest(value=value):
+        self.assertDropped("CATEGORIES", patch(categories=value))
+
+  def test_cleared_text(self):
+    self.assertDropped("NOTE", patch(note=float("nan")))
+
+
+STRUCTURED_CARD = ("BEGIN:VCARD\r\nVERSION:4.0\r\nFN:Ada Lovelace\r\nN:Lovelace;Augusta Ada;;Countess of;\r\n"
+                   "ORG:Analytical Engines;;Mills;Cards\r\nNOTE:Analyst\r\nEND:VCARD\r\n")
+
+
+class StructuredPropertiesTest(unittest.TestCase):
+
+  def patch(self, **values) -> str:
+    contents = vcard.parse_vcard(STRUCTURED_CARD)
+    row = vcard.flatten(contents)
+    row.update(values)
+    return vcard.patch_vcard(STRUCTURED_CARD, row, contents)
+
+  def test_unchanged_name_keeps_its_components(self):
+    output = self.patch(note="Countess")
+    self.assertIn("\r\nN:Lovelace;Augusta Ada;;Countess of;\r\n", output)
+    self.assertIn("\r\nORG:Analytical Engines;;Mills;Cards\r\n", output)
+
+  def test_name_edited_by_components(self):
+    output = self.patch(n="King;Augusta Ada;;Countess of;")
+    self.assertIn("\r\nN:King;Augusta Ada;;Countess of;\r\n", output)
+    self.assertEqual(self.patch(n="Lovelace;Augusta Ada;;Countess of;"), STRUCTURED_CARD)
+
+  def test_name_edited_as_display_text(self):
+    # The prefix and suffix can't be told apart from the display
+    with self.assertRaises(ValueError):
+      self.patch(n="Countess of Augusta Ada King")
+
+  def test_organization_units(self):
+    output = self.patch(org="Analytical Engines, Mills, Punched cards")
+    self.assertIn("\r\nORG:Analytical Engines;Mills;Punched cards\r\n", output)
+    self.assertNotIn("\\,", output)
+
+
+def read(path: str) -> str:
+  with open(path, "r", encoding="utf-8", newline="") as f:
+    return f.read()
+
+
+class GoldenTest(unittest.TestCase):
+  """Edited cards are written like the expected files: only the edited lines change"""
+
+  def patch_fixture(self, name: str, values: dict) -> str:
+    content = read(os.path.join(FIXTURES, name))
+    contents = vcard.parse_vcard(content)
+    row = vcard.flatten(contents)
+    row.update(values)
+    return vcard.patch_vcard(content, row, contents)
+
+  def test_golden(self):
+    for expected, (name, values) in GOLDEN.items():
+      with self.subTest(expected=expected):
+        output = REV.sub("REV:20000101T000000Z", self.patch_fixture(name, values))
+        self.assertEqual(output, read(os.path.join(FIXTURES, "patched", expected + ".vcf")))
+
+  def test_unchanged(self):
+    self.assertEqual(self.patch_fixture("unknown.vcf", dict()), read(os.path.join(FIXTURES, "unknown.vcf")))
+
+  def test_unknown_properties(self):
+    # Lines the edit doesn't touch are kept byte for byte, unknown properties and parameters included
+    content = read(os.path.join(FIXTURES, "unknown.vcf"))
+    for name, values in GOLDEN.values():
+      if name != "unknown.vcf":
+        continue
+      output = self.patch_fixture(name, values)
+      for line in ('X-SOCIALPROFILE;type=twitter;x-user=grace:https://twitter.com/grace',
+                   'X-CUSTOM;X-PARAM="quoted;value":kept as-is', 'X-ABShowAs:PERSON', 'item1.X-ABLabel:Navy'):
+        self.assertIn(line + "\r\n", content)
+        self.assertIn(line + "\r\n", output)
+
+
+if __name__ == "__main__":
+  unittest.main()
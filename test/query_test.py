@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import unittest
+
+import pandas as pd
+
+from data import query as ql
+
+
+def sample_book() -> pd.DataFrame:
+  return pd.DataFrame({
+    "fn": ["Ada Lovelace", "Alan Turing", "Grace Hopper", "Jean-Paul Sartre"],
+    "org": ["Analytical Engines", None, "US Navy", None],
+    "email": [["ada@example.org"], ["alan@acme.com", "turing@example.org"], None, ["jp@acme.fr"]],
+    "categories": [["VIP", "Clients"], ["Clients"], None, ["vip"]],
+    "adr-country": [["United Kingdom"], ["United Kingdom"], ["United States"], ["France"]],
+    "photo": [None, "binary:00:0:1:alan.vcf", None, None],
+    "note": ["Écrivit le premier programme", None, "COBOL", None],
+  }, index=pd.Index([10, 20, 30, 40]))
+
+
+class ParseTest(unittest.TestCase):
+
+  def test_predicates(self):
+    for query, key in [("doe", ("contains", "*", "doe")),
+                       ("org:ACME", ("contains", "org", "acme")),
+                       ('"Jean-Paul S"', ("contains", "*", "jean-paul s")),
+                       ('note:"say \\"hi\\""', ("contains", "note", 'say "hi"')),
+                       ("adr-country=France", ("equals", "adr-country", "france")),
+                       ("category:VIP", ("equals", "categories", "vip")),
+                       ("has:Photo", ("has", "photo", "")),
+                       ("email:/@acme\\.(com|fr)/", ("regex", "email", "@acme\\.(com|fr)"))]:
+      with self.subTest(query=query):
+        node = ql.compile(query)
+        self.assertIsInstance(node, ql.Predicate)
+        self.assertEqual(node.key, key)
+
+  def test_operators(self):
+    node = ql.compile("a b OR NOT c AND -d")
+    self.assertIsInstance(node, ql.Or)
+    first, second = node.children
+    self.assertIsInstance(first, ql.And)
+    self.assertEqual([child.key for child in first.children], [("contains", "*", "a"), ("contains", "*", "b")])
+    self.assertIsInstance(second, ql.And)
+    self.assertIsInstance(second.children[0], ql.Not)
+    self.assertIsInstance(second.children[1], ql.Not)
+
+    node = ql.compile("( a OR b ) c")
+    self.assertIsInstance(node, ql.And)
+    self.assertIsInstance(node.children[0], ql.Or)
+
+  def test_empty(self):
+    self.assertIsNone(ql.compile(""))
+    self.assertIsNone(ql.compile("   "))
+
+  def test_errors(self):
+    for query in ["(a OR b", "a OR", "a )", "AND", 'org:"unclosed', "email=/x/", "email:/(/"]:
+      with self.subTest(query=query):
+        with self.assertRaises(ql.QueryError):
+          ql.compile(query)
+
+
+class EngineTest(unittest.TestCase):
+
+  def setUp(self):
+    self.data = sample_book()
+    self.engine = ql.QueryEngine(self.data)
+
+  def match(self, query: str, engine=None) -> list:
+    engine = engine or self.engine
+    mask = engine.mask(ql.compile(query))
+    return mask.index[mask.to_numpy()].tolist()
+
+  def test_masks(self):
+    for query, rows in [("ada", [10]),
+                        ("LOVELACE", [10]),
+                        ("ecrivit", [10]),
+                        ("example.org", [10, 20]),
+                        ("org:navy", [30]),
+                        ("category:vip", [10, 40]),
+                        ("category:clients -turing", [10]),
+                        ('adr-country="united kingdom"', [10, 20]),
+                        ("adr-country=united", []),
+                        ("has:photo", [20]),
+                        ("has:org", [10, 30]),
+                        ("email:/@acme\\.(com|fr)\\b/", [20, 40]),
+                        ("ada OR grace", [10, 30]),
+                        ("NOT (ada OR grace)", [20, 40]),
+                        ("unknown-field:x", []),
+                        ("", [10, 20, 30, 40])]:
+      with self.subTest(query=query):
+        self.assertEqual(self.match(query), rows)
+
+  def test_rows(self):
+    mask = self.engine.mask(ql.compile("example.org"), pd.Index([20, 30]))
+    self.assertEqual(mask.tolist(), [True, False])
+
+  def test_typing_narrows(self):
+    # Each prefix typed is cached, and narrows the rows the next one is computed on
+    for i in range(1, len("lovelace") + 1):
+      self.assertEqual(self.match("lovelace"[:i]), self.match("lovelace"[:i], ql.QueryEngine(self.data)))
+    self.assertEqual(self.match("lovelace"), [10])
+    self.assertEqual(len(self.engine._masks), len("lovelace"))
+
+  def test_cache_is_bounded(self):
+    for i in range(ql.MASKS_SIZE + 10):
+      self.match("x%i" % i)
+    self.assertEqual(len(self.engine._masks), ql.MASKS_SIZE)
+    self.assertEqual(set(self.engine._masks), set(self.engine._predicates))
+
+    # The predicates of the current query are the most recent ones
+    self.assertEqual(self.match("x0 OR ada"), [10])
+    self.assertIn(("contains", "*", "x0"), self.engine._masks)
+    self.assertNotIn(("contains", "*", "x1"), self.engine._masks)
+
+  def assertSameAsFresh(self, queries):
+    fresh = ql.QueryEngine(self.engine.data)
+    for query in queries:
+      with self.subTest(query=query):
+        self.assertEqual(self.match(query), self.match(query, fresh))
+
+  def test_update_edited_rows(self):
+    queries = ["lovelace", "category:vip", "has:org", "email:/acme/", "adr-country=france", "turing OR hopper"]
+    for query in queries:
+      self.match(query)
+
+    self.data.at[10, "fn"] = "Augusta King"
+    self.data.at[30, "categories"] = ["VIP"]
+    self.data.at[20, "org"] = "Bletchley Park"
+    self.data.at[40, "email"] = ["jp@example.fr"]
+    self.engine.update([10, 20, 30, 40])
+
+    self.assertEqual(self.match("lovelace"), [])
+    self.assertEqual(self.match("category:vip"), [10, 30, 40])
+    self.assertSameAsFresh(queries)
+
+  def test_update_added_and_removed_rows(self):
+    queries = ["alan", "category:clients", "has:photo", "example"]
+    for query in queries:
+      self.match(query)
+
+    data = pd.concat([self.data.drop(index=[20]),
+                      pd.DataFrame({"fn": ["Alan Kay"], "categories": [["Clients"]],
+                                    "email": [["alan@example.com"]]}, index=[50])])
+    self.engine.update([20, 50], data)
+
+    self.assertEqual(self.match("alan"), [50])
+    self.assertEqual(self.match("has:photo"), [])
+    self.assertSameAsFresh(queries)
+
+
+if __name__ == "__main__":
+  unittest.main()
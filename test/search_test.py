@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from data.search import SearchIndex, trigrams
+
+
+def book() -> pd.DataFrame:
+  return pd.DataFrame({
+    "fn": ["Ada Lovelace", "Alan Turing", "Grace Hopper", "Adam Smith"],
+    "org": [np.nan, "Bletchley Park", "US Navy", np.nan],
+    "email": [["ada@analytical.org"], ["alan@bletchley.uk"], np.nan, ["smith@glasgow.ac.uk"]],
+    "tel": [np.nan, ["+44 20 7946 0000"], ["06 12 34 56 78"], np.nan],
+    "adr-locality": [["London"], ["Wilmslow"], ["Arlington"], ["Kirkcaldy"]],
+    "note": ["Not indexed", np.nan, np.nan, np.nan],
+  })
+
+
+class SearchIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.data = book()
+    self.index = SearchIndex(self.data)
+
+  def test_trigrams(self):
+    self.assertEqual(trigrams("ada"), {"ada"})
+    self.assertEqual(trigrams("adam"), {"ada", "dam"})
+    self.assertEqual(trigrams("ad"), set())
+
+  def test_prefix(self):
+    # Short words are matched as prefixes only
+    self.assertEqual(self.index.search("ad"), [0, 3])
+    self.assertEqual(self.index.search("da"), [])
+    self.assertEqual(self.index.search("AL"), [1])
+
+  def test_substring(self):
+    self.assertEqual(self.index.search("velac"), [0])
+    self.assertEqual(self.index.search("ópp"), [2])
+    self.assertEqual(self.index.search("nowhere"), [])
+    # Unindexed fields are not searched
+    self.assertEqual(self.index.search("indexed"), [])
+
+  def test_all_words(self):
+    self.assertEqual(self.index.search("ada love"), [0])
+    self.assertEqual(self.index.search("ada turing"), [])
+    self.assertEqual(self.index.search("  "), [])
+
+  def test_ranking(self):
+    # Whole words first, then prefixes, then substrings, weighted by field: names before organizations
+    self.assertEqual(self.index.search("ada"), [0, 3])
+    self.assertEqual(self.index.search("bletchley"), [1])
+    self.data.loc[4] = pd.Series({"fn": "Bletchley Fan", "email": ["fan@example.org"]})
+    self.data.loc[5] = pd.Series({"fn": "Bletchleyan"})
+    self.index.update(self.data, [4, 5])
+    self.assertEqual(self.index.search("bletchley"), [4, 5, 1])
+    self.assertEqual(self.index.search("ada", limit=1), [0])
+
+  def test_phone_digits(self):
+    self.assertEqual(self.index.search("0612"), [2])
+    self.assertEqual(self.index.search("7946"), [1])
+    self.assertEqual(self.index.search("06 12"), [2])
+
+  def test_update(self):
+    self.data.at[0, "fn"] = "Augusta King"
+    self.data = self.data.drop(index=2)
+    self.data.loc[7] = pd.Series({"fn": "Linus Torvalds", "tel": ["+358 9 1234567"]})
+    self.index.update(self.data, [0, 2, 7])
+
+    self.assertEqual(len(self.index), 4)
+    self.assertNotIn(2, self.index)
+    self.assertEqual(self.index.search("lovelace"), [])
+    self.assertEqual(self.index.search("augusta"), [0])
+    # Still found through the email, after a prefix of a name
+    self.assertEqual(self.index.search("ada"), [3, 0])
+    self.assertEqual(self.index.search("hopper"), [])
+    self.assertEqual(self.index.search("0612"), [])
+    self.assertEqual(self.index.search("torv"), [7])
+    self.assertEqual(self.index.search("1234567"), [7])
+
+  def test_incremental_equals_build(self):
+    # Removing and adding rows leaves the index as if built at once
+    self.index.remove([1, 3])
+    self.index.update(self.data, [1, 3])
+    built = SearchIndex(self.data)
+    self.assertEqual(self.index._postings, built._postings)
+    self.assertEqual(self.index._vocabulary, built._vocabulary)
+    self.assertEqual(self.index._trigrams, built._trigrams)
+
+    self.index.remove(self.data.index)
+    self.assertEqual((len(self.index), self.index._vocabulary, self.index._trigrams), (0, [], {}))
+
+
+if __name__ == "__main__":
+  unittest.main()
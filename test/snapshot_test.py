@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+import unittest
+
+import pandas as pd
+
+from data.snapshot import Snapshot
+
+
+def sample_book() -> pd.DataFrame:
+  return pd.DataFrame({
+    "fn": ["Ada Lovelace", "Alan Turing", "Grace Hopper"],
+    "email": [["ada@example.org"], ["alan@example.org", "turing@example.org"], None],
+    "email-type": [[["HOME"]], [["WORK"], ["HOME"]], None],
+    "categories": [["Clients"], [], None],
+    "version": pd.Categorical(["4.0", "4.0", "3.0"]),
+    "z-hash": ["a", "b", "c"],
+    "z-geoupdate": [True, False, True],
+    "changed": [False, False, False],
+  }, index=pd.Index([10, 20, 30]))
+
+
+class SnapshotTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.snapshot = Snapshot(os.path.join(self.directory.name, "book.arrow"))
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def assertBookEqual(self, expected: pd.DataFrame, loaded: pd.DataFrame):
+    pd.testing.assert_frame_equal(expected, loaded.loc[expected.index], check_dtype=False)
+
+    # The book code tests list cells with isinstance()
+    for col in ["email", "email-type", "categories"]:
+      for value in loaded[col]:
+        self.assertTrue(value is None or isinstance(value, list), "%s holds %r" % (col, value))
+    for value in loaded["email-type"].dropna():
+      self.assertTrue(all(isinstance(elem, list) for elem in value))
+
+  def test_round_trip(self):
+    data = sample_book()
+    self.snapshot.save(data)
+    self.assertBookEqual(data, self.snapshot.load())
+
+  def test_round_trip_with_deltas(self):
+    data = sample_book()
+    self.snapshot.save(data)
+
+    data.at[20, "categories"] = ["Clients", "Suppliers"]
+    data.at[20, "changed"] = True
+    data = data.drop(index=30)
+    self.assertEqual(self.snapshot.checkpoint(data), 1)
+
+    loaded = Snapshot(self.snapshot.path).load()
+    self.assertEqual(sorted(loaded.index), [10, 20])
+    self.assertBookEqual(data, loaded)
+
+  def test_selected_columns(self):
+    data = sample_book()
+    self.snapshot.save(data)
+
+    loaded = self.snapshot.load(columns=["fn", "categories"])
+    self.assertEqual(list(loaded.columns), ["fn", "categories"])
+    self.assertEqual(loaded.at[10, "categories"], ["Clients"])
+
+
+if __name__ == "__main__":
+  unittest.main()
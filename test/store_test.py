@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from data.store import SQLiteStore
+
+
+def book() -> pd.DataFrame:
+  return pd.DataFrame({
+    "fn": ["Ada Lovelace", "Alan Turing", "Grace Hopper"],
+    "org": ["Analytical Engines", np.nan, "US Navy"],
+    "email": [["ada@example.org"], ["alan@bletchley.uk", "turing@example.org"], np.nan],
+    "tel": [np.nan, ["+44 20 7946 0000"], np.nan],
+    "adr-locality": [["London"], ["Wilmslow"], ["Arlington"]],
+    "note": ["Wrote the first program", np.nan, "Found a moth in the relay"],
+    "categories": [["friends"], ["work"], ["work"]],
+    "x-custom": [np.nan, np.nan, "only Grace"],
+    "z-file": ["ada.vcf", "alan.vcf", "grace.vcf"],
+    "z-hash": ["a", "b", "c"],
+  }, index=[3, 7, 11])
+
+
+class SQLiteStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    self.store = SQLiteStore()
+    self.data = book()
+    self.store.write(self.data)
+
+  def tearDown(self):
+    self.store.close()
+
+  def test_load(self):
+    self.assertEqual(len(self.store), 3)
+    loaded = self.store.load()
+    self.assertEqual(loaded.index.tolist(), [3, 7, 11])
+    self.assertEqual(loaded.at[7, "email"], ["alan@bletchley.uk", "turing@example.org"])
+    self.assertEqual(loaded.at[11, "x-custom"], "only Grace")
+    # Empty cells are not stored
+    self.assertTrue(pd.isna(loaded.at[3, "x-custom"]))
+
+    loaded = self.store.load([11, 3, 42])
+    self.assertEqual(loaded.index.tolist(), [11, 3])
+    self.assertEqual(loaded.at[3, "fn"], "Ada Lovelace")
+
+  def test_search(self):
+    # Words are matched as prefixes, case and accents ignored
+    self.assertEqual(self.store.search("ada"), [3])
+    self.assertEqual(self.store.search("TUR"), [7])
+    self.assertEqual(self.store.search("wilmslów"), [7])
+    self.assertEqual(sorted(self.store.search("work")), [7, 11])
+    self.assertEqual(self.store.search("moth relay"), [11])
+    self.assertEqual(sorted(self.store.search("example.org")), [3, 7])
+    self.assertEqual(self.store.search("moth ada"), [])
+    self.assertEqual(self.store.search(" -- "), [])
+    self.assertEqual(len(self.store.search("a", limit=2)), 2)
+
+  def test_set_value(self):
+    self.store.set_value(3, "note", "Notes on the engine")
+    self.assertEqual(self.store.search("engine"), [3])
+    self.assertEqual(self.store.search("program"), [])
+    self.assertEqual(self.store.load([3]).at[3, "note"], "Notes on the engine")
+
+    self.store.set_value(3, "org", np.nan)
+    self.assertNotIn("org", self.store.load([3]).columns)
+    self.assertEqual(self.store.search("analytical"), [])
+    # The other fields are still indexed
+    self.assertEqual(self.store.search("lovelace"), [3])
+
+  def test_write_rows(self):
+    self.data.at[7, "fn"] = "Alan M. Turing"
+    self.data = self.data.drop(index=11)
+    self.store.write(self.data, [7, 11])
+
+    # Written rows are replaced, rows missing from data are removed
+    self.assertEqual(self.store.load().index.tolist(), [3, 7])
+    self.assertEqual(self.store.load([7]).at[7, "fn"], "Alan M. Turing")
+    self.assertEqual(self.store.search("hopper"), [])
+    self.assertEqual(self.store.search("lovelace"), [3])
+
+  def test_sync(self):
+    self.data.at[3, "note"] = "Edited on disk"
+    self.data = self.data.drop(index=7)
+    self.data.loc[12] = pd.Series({"fn": "Linus Torvalds", "z-file": "linus.vcf"})
+    self.store.sync(self.data, {"added": ["linus.vcf"], "modified": ["ada.vcf"], "deleted": ["alan.vcf"]})
+
+    self.assertEqual(self.store.load().index.tolist(), [3, 11, 12])
+    self.assertEqual(self.store.rows_of_files(["ada.vcf", "alan.vcf", "linus.vcf"]), [3, 12])
+    self.assertEqual(self.store.search("edited"), [3])
+    self.assertEqual(self.store.search("torvalds"), [12])
+    self.assertEqual(self.store.search("turing"), [])
+
+  def test_persistence(self):
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, "book.sqlite")
+      store = SQLiteStore(path)
+      store.write(self.data)
+      store.close()
+
+      store = SQLiteStore(path)
+      self.assertEqual(len(store), 3)
+      self.assertEqual(store.search("hopper"), [11])
+      store.close()
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from data import contact
+from data.manifest import FileManifest
+
+
+def card(name: str, note: str) -> str:
+  return "BEGIN:VCARD\r\nVERSION:4.0\r\nFN:%s\r\nNOTE:%s\r\nEND:VCARD\r\n" % (name, note)
+
+
+class SyncTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.manifest = FileManifest()
+    for name in ("ada", "alan", "grace"):
+      self.write(name, "first")
+    self.data = contact.list_vcf_in_directory(self.directory.name, manifest=self.manifest)
+    self.data["changed"] = False
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def path(self, name: str) -> str:
+    return os.path.join(self.directory.name, name + ".vcf")
+
+  def write(self, name: str, note: str):
+    with open(self.path(name), "w", newline="") as f:
+      f.write(card(name.title(), note))
+    # Make sure the manifest sees the change even within the resolution of the file times
+    stat = os.stat(self.path(name))
+    os.utime(self.path(name), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+  def sync(self):
+    with contextlib.redirect_stdout(io.StringIO()):
+      return contact.sync_vcf_in_directory(self.directory.name, self.data, manifest=self.manifest)
+
+  def row(self, data, name: str):
+    return data.index[data["z-file"] == self.path(name)][0]
+
+  def test_unsaved_edit_is_kept(self):
+    ada = self.row(self.data, "ada")
+    self.data.loc[ada, ["note", "changed"]] = ["edited in the app", True]
+    hash = self.data.at[ada, "z-hash"]
+
+    self.write("ada", "edited on disk")
+    self.write("alan", "second")
+    data, changes = self.sync()
+
+    self.assertEqual(changes["conflicts"], [self.path("ada")])
+    self.assertEqual(changes["modified"], [self.path("alan")])
+    self.assertEqual(data.at[ada, "note"], "edited in the app")
+    self.assertEqual(data.at[ada, "z-hash"], hash)
+    self.assertTrue(data.at[ada, "changed"])
+
+    # Still reported until the edit is written back or dropped
+    self.data = data
+    self.assertEqual(self.sync()[1]["conflicts"], [self.path("ada")])
+
+    # Writing it back refuses to overwrite the file
+    with contextlib.redirect_stdout(io.StringIO()):
+      data, failures = contact.commit_vcf_changes(data, manifest=self.manifest, workers=1)
+    self.assertIn(self.path("ada"), failures)
+
+  def test_changed_flag(self):
+    self.write("alan", "second")
+    self.write("linus", "first")
+    data, changes = self.sync()
+
+    self.assertEqual(changes["added"], [self.path("linus")])
+    self.assertEqual(data.at[self.row(data, "alan"), "note"], "second")
+    self.assertEqual(data["changed"].dtype, bool)
+    self.assertFalse(data["changed"].any())
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import glob
+import os
+import unittest
+
+from data import contact
+from data import vcard
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def read_fixture(name: str):
+  path = os.path.join(FIXTURES, name)
+  content, hash = contact.read_vcf(path)
+  return path, content, hash
+
+
+class ParserParityTest(unittest.TestCase):
+  """The fast tokenizer and vobject build the same rows from real cards"""
+
+  def test_fixtures(self):
+    paths = sorted(glob.glob(os.path.join(FIXTURES, "*.vcf")))
+    self.assertTrue(paths)
+
+    for path in paths:
+      with self.subTest(card=os.path.basename(path)):
+        content, hash = contact.read_vcf(path)
+        self.assertEqual(contact.parse_vcf(content, path, hash, "fast"),
+                         contact.parse_vcf(content, path, hash, "vobject"))
+
+  def test_folding(self):
+    path, content, hash = read_fixture("folded.vcf")
+    row = contact.parse_vcf(content, path, hash, "fast")
+    self.assertEqual(row["note"], "Wrote the first algorithm intended to be carried out by a machine, and "
+                                  "noticed that it could go beyond mere calculation.\nSecond line of the note.")
+    self.assertEqual(row["adr-country"], ["United Kingdom"])
+
+  def test_escaped_separators(self):
+    path, content, hash = read_fixture("escaped.vcf")
+    row = contact.parse_vcf(content, path, hash, "fast")
+    self.assertEqual(row["categories"], ["Clients", "VIP, gold", "Suppliers"])
+    self.assertEqual(row["nickname"], ["Jay,Pee"])
+    self.assertEqual(row["org"], "Smith; Sons, Accounting")
+    self.assertEqual(row["adr-extended"], ["Suite 4, floor 2"])
+    self.assertEqual(row["adr-street"], ["1 Main St; Bldg A"])
+    self.assertEqual(row["note"], "Path C:\\temp; semicolons, commas and\nnew lines")
+
+  def test_groups(self):
+    path, content, hash = read_fixture("grouped.vcf")
+    fast = vcard.parse_vcard(content)
+    reference = vcard.from_vobject(contact._read_vobject(content))
+    self.assertEqual(fast, reference)
+    self.assertEqual([prop.group for prop in fast["x-ablabel"]], ["item1", "item2", "item3"])
+    self.assertEqual(fast["x-custom"][0].params, {"X-PARAM": ["quoted;value"]})
+
+  def test_empty_values(self):
+    path, content, hash = read_fixture("empty.vcf")
+    row = contact.parse_vcf(content, path, hash, "fast")
+    self.assertEqual(row["nickname"], [])
+    self.assertEqual(row["categories"], [])
+    self.assertEqual(row["note"], "")
+    self.assertEqual(row["email"], ["alan@example.org"])
+
+  def test_base64(self):
+    path, content, hash = read_fixture("photo.vcf")
+    row = contact.parse_vcf(content, path, hash, "fast")
+    self.assertTrue(row["photo"].startswith("binary:"))
+    self.assertEqual(vcard.parse_vcard(content)["photo"][0].value,
+                     vcard.from_vobject(contact._read_vobject(content))["photo"][0].value)
+
+  def test_quoted_printable(self):
+    # Left to vobject by the fast backend
+    for name, note in (("quoted-printable.vcf", "Straße und Plätze\r\nzweite Zeile"),
+                       ("quoted-printable-3.vcf", "Café crème")):
+      with self.subTest(card=name):
+        path, content, hash = read_fixture(name)
+        with self.assertRaises(vcard.Unsupported):
+          vcard.parse_vcard(content)
+        self.assertEqual(contact.parse_vcf(content, path, hash, "fast")["note"], note)
+
+  def test_several_nicknames(self):
+    # vobject keeps only the first nickname of a line: cards it parses lose the others
+    content = "BEGIN:VCARD\r\nVERSION:4.0\r\nFN:Jean-Paul\r\nNICKNAME:JP,Jay\\,Pee\r\nEND:VCARD\r\n"
+    self.assertEqual(contact.parse_vcf(content, "jp.vcf", "", "fast")["nickname"], ["JP", "Jay,Pee"])
+    self.assertEqual(contact.parse_vcf(content, "jp.vcf", "", "vobject")["nickname"], ["JP"])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+#
+# Copyright © Aurélien Pierre - 2022
+#
+# This file is part of the Open Contact Book project.
+#
+# Open Contact Book is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Open Contact Book is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Open Contact Book.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import queue
+import tempfile
+import time
+import unittest
+
+from data.watcher import DirectoryWatcher
+
+DEBOUNCE = 0.2
+
+
+class DirectoryWatcherTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.reports = queue.Queue()
+    self.watcher = DirectoryWatcher(self.directory.name, self.reports.put, debounce=DEBOUNCE,
+                                    interval=0.05, polling=True)
+
+  def tearDown(self):
+    self.watcher.stop()
+    self.directory.cleanup()
+
+  def path(self, name: str) -> str:
+    return os.path.join(self.directory.name, name)
+
+  def write(self, name: str, content="BEGIN:VCARD\r\nEND:VCARD\r\n"):
+    with open(self.path(name), "w") as f:
+      f.write(content)
+
+  def report(self, timeout=5.) -> set:
+    return self.reports.get(timeout=timeout)
+
+  def assertNoReport(self, delay=3 * DEBOUNCE):
+    with self.assertRaises(queue.Empty):
+      self.reports.get(timeout=delay)
+
+  def test_burst_is_coalesced(self):
+    # Events keep the delay restarting: one report once they stop
+    start = time.monotonic()
+    for i in range(10):
+      if i > 0:
+        time.sleep(DEBOUNCE / 4)
+      self.watcher.touch(self.path("%i.vcf" % (i % 4)))
+    last = time.monotonic()
+
+    self.assertEqual(self.report(), {self.path("%i.vcf" % i) for i in range(4)})
+    self.assertGreaterEqual(time.monotonic() - last, DEBOUNCE * 0.9)
+    self.assertGreater(last - start, DEBOUNCE)
+    self.assertNoReport()
+
+  def test_quiet_periods_split_reports(self):
+    self.watcher.touch(self.path("ada.vcf"))
+    self.assertEqual(self.report(), {self.path("ada.vcf")})
+    self.watcher.touch(self.path("alan.vcf"))
+    self.assertEqual(self.report(), {self.path("alan.vcf")})
+
+  def test_paths_are_filtered_and_normalized(self):
+    # Temporary files of atomic writes are ignored, paths are reported in the watched directory
+    self.watcher.touch(self.path(".ada.tmp"))
+    self.watcher.touch(os.path.join("elsewhere", "ada.vcf"))
+    self.assertEqual(self.report(), {self.path("ada.vcf")})
+
+  def test_stop_drops_pending_paths(self):
+    self.watcher.touch(self.path("ada.vcf"))
+    self.watcher.stop()
+    self.assertNoReport()
+
+  def test_polling(self):
+    self.write("ada.vcf")
+    self.write("alan.vcf")
+    self.watcher.start()
+    time.sleep(0.1)
+
+    self.write("grace.vcf")
+    self.write("notes.txt")
+    os.remove(self.path("alan.vcf"))
+    self.assertEqual(self.report(), {self.path("grace.vcf"), self.path("alan.vcf")})
+
+    # Modified: size and time change
+    self.write("ada.vcf", "BEGIN:VCARD\r\nFN:Ada\r\nEND:VCARD\r\n")
+    self.assertEqual(self.report(), {self.path("ada.vcf")})
+    self.assertNoReport()
+
+
+if __name__ == "__main__":
+  unittest.main()